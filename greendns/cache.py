@@ -1,40 +1,345 @@
 # -*- coding: utf-8 -*-
+import os
 import time
+import zlib
+import mmap
+import struct
+import heapq
+import itertools
+from collections import OrderedDict
 import six
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 class Cache(object):
-    def __init__(self):
-        self.m = {}
+    '''
+    LRU cache with ttl. max_entries and max_bytes are the limits, 0 means
+    unlimited. The least recently used entries are evicted when full.
+    Expired entries are found by a deadline heap, so validate() costs
+    O(expired) instead of O(entries). They are kept stale seconds more for
+    find_stale().
+    '''
+    def __init__(self, max_entries=0, max_bytes=0, stale=0):
+        self.m = OrderedDict()      # key -> (value, expire_ts, size)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale = stale
+        self.bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.deadlines = []         # heap of (expire_ts, seq, key)
+        self.seq = itertools.count()
 
     def __len__(self):
         return len(self.m)
 
     def iteritems(self):
-        return six.iteritems(self.m)
+        for k, (value, expire_ts, _) in six.iteritems(self.m):
+            yield k, (value, expire_ts)
 
-    def add(self, key, value, ttl):
-        self.m[key] = (value, time.time() + ttl)
+    def add(self, key, value, ttl, size=0):
+        self.remove(key)
+        expire_ts = time.time() + ttl
+        self.m[key] = (value, expire_ts, size)
+        self.bytes += size
+        heapq.heappush(self.deadlines, (expire_ts, next(self.seq), key))
+        while self.m and \
+                ((self.max_entries and len(self.m) > self.max_entries) or
+                 (self.max_bytes and self.bytes > self.max_bytes)):
+            _, (_, _, old_size) = self.m.popitem(last=False)
+            self.bytes -= old_size
+            self.evictions += 1
 
     def remove(self, key):
-        self.m.pop(key, None)
+        v = self.m.pop(key, None)
+        if v:
+            self.bytes -= v[2]
 
     def find(self, key):
         v = self.m.get(key)
         if v:
-            value, expire_ts = v
-            if time.time() >= expire_ts:
-                self.remove(key)
+            value, expire_ts, _ = v
+            now = time.time()
+            if now >= expire_ts:
+                if now >= expire_ts + self.stale:
+                    self.remove(key)
+                self.misses += 1
                 return None
             else:
+                # most recently used goes to the end
+                del self.m[key]
+                self.m[key] = v
+                self.hits += 1
                 return value
+        self.misses += 1
+        return None
+
+    def find_stale(self, key):
+        '''find the value even if it expired within stale seconds'''
+        v = self.m.get(key)
+        if v and time.time() < v[1] + self.stale:
+            self.stale_hits += 1
+            return v[0]
         return None
 
     def validate(self):
-        expired_key = []
-        for k, v in six.iteritems(self.m):
-            value, expire_ts = v
-            if time.time() >= expire_ts:
-                expired_key.append(k)
-        for k in expired_key:
-            self.remove(k)
+        now = time.time() - self.stale
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            expire_ts, _, key = heapq.heappop(deadlines)
+            v = self.m.get(key)
+            # skip if removed, evicted or added again
+            if v and v[1] == expire_ts:
+                self.remove(key)
+                self.expired += 1
+        if len(deadlines) > 2 * len(self.m) + 64:
+            self.__rebuild_deadlines()
+
+    def __rebuild_deadlines(self):
+        self.deadlines = [(expire_ts, next(self.seq), k)
+                          for k, (_, expire_ts, _) in six.iteritems(self.m)]
+        heapq.heapify(self.deadlines)
+
+    def stats(self):
+        return {
+            "entries": len(self.m),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
+
+
+class ShmCache(object):
+    '''
+    Cache in a file mapped by every process on the host, like one in
+    /dev/shm. It is an open addressing hash table of fixed size slots,
+    a key is in one of the PROBES slots from its hash.
+
+    Readers take no lock. Every slot has a sequence number which is odd
+    while a writer is changing it, a reader copies the slot and retries if
+    the number changed. Writers take a lockf lock on the file.
+
+    A new key takes an empty or expired slot, or else evicts the one
+    expiring first. Expired ones are kept stale seconds more for
+    find_stale(). Values are bytes, or encode and decode them.
+    '''
+    MAGIC = b"GDNSCACH"
+    VERSION = 1
+    HEADER_SIZE = 64
+    SLOT_SIZE = 1024
+    PROBES = 8
+    RETRIES = 4
+    SWEEP = 4096            # slots checked by each validate
+    _header = struct.Struct("=8sIIII")  # magic version slots slot_size entries
+    _slot = struct.Struct("=IIdHH")     # seq hash expire_ts klen vlen
+    _seq = struct.Struct("=I")
+    _entries = struct.Struct("=I")
+    ENTRIES_OFFSET = 20
+
+    def __init__(self, path, slots, slot_size=SLOT_SIZE,
+                 encode=None, decode=None, stale=0):
+        if fcntl is None:
+            raise NotImplementedError("fcntl is required")
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.encode = encode
+        self.decode = decode
+        self.stale = stale
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.oversized = 0          # entries too big for a slot, not added
+        self.sweep_pos = 0
+        size = self.HEADER_SIZE + slots * slot_size
+        expect = (self.MAGIC, self.VERSION, slots, slot_size)
+        while True:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            self.__lock()
+            header = os.read(self.fd, self._header.size)
+            if not header:
+                os.ftruncate(self.fd, size)
+                os.write(self.fd, self._header.pack(*(expect + (0,))))
+                break
+            if len(header) == self._header.size and \
+                    os.fstat(self.fd).st_size == size and \
+                    self._header.unpack(header)[:4] == expect:
+                break
+            # made with another size or version, and may be still mapped
+            # by others, so it is replaced rather than truncated
+            os.unlink(path)
+            self.__unlock()
+            os.close(self.fd)
+        try:
+            self.m = mmap.mmap(self.fd, size)
+        finally:
+            self.__unlock()
+
+    def __lock(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+
+    def __unlock(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self.m.close()
+        os.close(self.fd)
+
+    def __len__(self):
+        return self._entries.unpack_from(self.m, self.ENTRIES_OFFSET)[0]
+
+    def __add_entries(self, n):
+        self._entries.pack_into(self.m, self.ENTRIES_OFFSET, len(self) + n)
+
+    @staticmethod
+    def key_bytes(key):
+        return key if isinstance(key, bytes) else repr(key).encode()
+
+    def __offsets(self, h):
+        for i in range(self.PROBES):
+            yield self.HEADER_SIZE + ((h + i) % self.slots) * self.slot_size
+
+    def __read(self, offset):
+        '''consistent (hash, expire_ts, key, value), None if busy'''
+        m = self.m
+        for _ in range(self.RETRIES):
+            seq, h, expire_ts, klen, vlen = self._slot.unpack_from(m, offset)
+            if seq & 1:
+                continue
+            beg = offset + self._slot.size
+            key = m[beg:beg + klen]
+            value = m[beg + klen:beg + klen + vlen]
+            if self._seq.unpack_from(m, offset)[0] == seq:
+                return (h, expire_ts, key, value)
+        return None
+
+    def __write(self, offset, h, expire_ts, key, value):
+        '''with the lock held, an empty key clears the slot'''
+        m = self.m
+        seq = self._seq.unpack_from(m, offset)[0]
+        self._seq.pack_into(m, offset, (seq + 1) & 0xffffffff)
+        beg = offset + self._slot.size
+        m[beg:beg + len(key) + len(value)] = key + value
+        self._slot.pack_into(m, offset, (seq + 1) & 0xffffffff, h,
+                             expire_ts, len(key), len(value))
+        self._seq.pack_into(m, offset, (seq + 2) & 0xffffffff)
+
+    def iteritems(self):
+        for i in range(self.slots):
+            v = self.__read(self.HEADER_SIZE + i * self.slot_size)
+            if v and v[2]:
+                value = self.decode(v[3]) if self.decode else v[3]
+                yield v[2], (value, v[1])
+
+    def add(self, key, value, ttl, size=0):
+        kb = self.key_bytes(key)
+        vb = self.encode(value) if self.encode else value
+        if self._slot.size + len(kb) + len(vb) > self.slot_size:
+            self.oversized += 1
+            return
+        h = zlib.crc32(kb) & 0xffffffff
+        now = time.time()
+        self.__lock()
+        try:
+            target, victim = None, None
+            for offset in self.__offsets(h):
+                seq, sh, expire_ts, klen, _ = \
+                    self._slot.unpack_from(self.m, offset)
+                if klen and sh == h:
+                    beg = offset + self._slot.size
+                    if self.m[beg:beg + klen] == kb:
+                        target = offset
+                        break
+                if target is None and \
+                        (not klen or expire_ts + self.stale <= now):
+                    target = offset
+                if victim is None or expire_ts < victim[1]:
+                    victim = (offset, expire_ts)
+            if target is None:
+                target = victim[0]
+                self.evictions += 1
+            elif not self._slot.unpack_from(self.m, target)[3]:
+                self.__add_entries(1)
+            self.__write(target, h, now + ttl, kb, vb)
+        finally:
+            self.__unlock()
+
+    def remove(self, key):
+        kb = self.key_bytes(key)
+        h = zlib.crc32(kb) & 0xffffffff
+        self.__lock()
+        try:
+            for offset in self.__offsets(h):
+                _, sh, _, klen, _ = self._slot.unpack_from(self.m, offset)
+                beg = offset + self._slot.size
+                if klen and sh == h and self.m[beg:beg + klen] == kb:
+                    self.__write(offset, 0, 0, b"", b"")
+                    self.__add_entries(-1)
+                    break
+        finally:
+            self.__unlock()
+
+    def __find(self, key):
+        '''(expire_ts, value bytes), None if not found'''
+        kb = self.key_bytes(key)
+        h = zlib.crc32(kb) & 0xffffffff
+        for offset in self.__offsets(h):
+            v = self.__read(offset)
+            if v and v[0] == h and v[2] == kb:
+                return (v[1], v[3])
+        return None
+
+    def find(self, key):
+        v = self.__find(key)
+        if v and time.time() < v[0]:
+            self.hits += 1
+            return self.decode(v[1]) if self.decode else v[1]
+        self.misses += 1
+        return None
+
+    def find_stale(self, key):
+        '''find the value even if it expired within stale seconds'''
+        v = self.__find(key)
+        if v and time.time() < v[0] + self.stale:
+            self.stale_hits += 1
+            return self.decode(v[1]) if self.decode else v[1]
+        return None
+
+    def validate(self):
+        '''clear the expired slots, SWEEP slots each time'''
+        now = time.time()
+        self.__lock()
+        try:
+            for _ in range(min(self.SWEEP, self.slots)):
+                offset = self.HEADER_SIZE + self.sweep_pos * self.slot_size
+                self.sweep_pos = (self.sweep_pos + 1) % self.slots
+                _, _, expire_ts, klen, _ = self._slot.unpack_from(self.m, offset)
+                if klen and expire_ts + self.stale <= now:
+                    self.__write(offset, 0, 0, b"", b"")
+                    self.__add_entries(-1)
+                    self.expired += 1
+        finally:
+            self.__unlock()
+
+    def stats(self):
+        return {
+            "entries": len(self),
+            "bytes": self.slots * self.slot_size,
+            "oversized": self.oversized,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
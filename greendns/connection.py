@@ -5,9 +5,16 @@ import logging
 import errno
 from collections import namedtuple
 from greendns import ioloop
+from greendns import mmsg
 
 Addr = namedtuple("Addr", "protocol ip port")
 
+# scatter send without joining the buffers, python 3 only
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+def join_bufs(bufs):
+    return b"".join(memoryview(b).tobytes() for b in bufs)
+
 def parse_ip(name):
     return socket.gethostbyname(name)
 
@@ -68,6 +75,13 @@ class UDPConnection(Connection):
         super(UDPConnection, self).__init__(*args, **kwargs)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.recv_buffer_size = self.DEFAULT_UDP_RECV_BUFSIZE
+        self.rbuf = bytearray(self.recv_buffer_size)    # recv into it
+        self.rview = memoryview(self.rbuf)
+        # batch use
+        self.batch = 1
+        self.msgs = None            # mmsg.MsgBatch
+        self.outq = []              # [(remote_addr, data)] to flush
+        self.flushing = False
 
     def bind(self, bind_addr):
         try:
@@ -86,6 +100,63 @@ class UDPConnection(Connection):
 
     def set_recv_buffer_size(self, size):
         self.recv_buffer_size = size
+        self.rbuf = bytearray(size)
+        self.rview = memoryview(self.rbuf)
+
+    def __recvfrom(self):
+        '''recv into the reused buffer, only the datagram itself is copied'''
+        n, remote_addr = self.sock.recvfrom_into(self.rview)
+        return self.rview[:n].tobytes(), remote_addr
+
+    def set_reuse_port(self):
+        '''let several processes bind to the same addr, before bind'''
+        if not hasattr(socket, "SO_REUSEPORT"):
+            return False
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return True
+
+    def set_batch(self, size, use_mmsg=False):
+        '''
+        Read up to size datagrams each time it is readable, by recvmmsg if
+        use_mmsg and it is available. queue() sends by sendmmsg too.
+        '''
+        self.batch = size
+        self.sock.setblocking(0)
+        if use_mmsg and mmsg.available:
+            self.msgs = mmsg.MsgBatch(size, self.recv_buffer_size)
+
+    def queue(self, remote_addr, data):
+        '''send at the end of this loop round, with the others queued'''
+        self.outq.append((remote_addr, data))
+        if not self.flushing:
+            self.flushing = True
+            self.io_engine.add_callback(self.flush)
+
+    def flush(self):
+        self.flushing = False
+        outq = self.outq
+        sent = 0
+        while sent < len(outq) and not self.closed:
+            try:
+                if self.msgs:
+                    sent += self.msgs.send(self.sock.fileno(), outq[sent:])
+                    continue
+                remote_addr, data = outq[sent]
+                self.sock.sendto(data, remote_addr)
+            except socket.error as err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.io_engine.register(self.sock, ioloop.EV_WRITE,
+                                            self.__handle_flush)
+                    break
+                remote_addr = outq[sent][0]
+                self.logger.error("udp sendto %s:%d failed. error=%s",
+                                  remote_addr[0], remote_addr[1], err)
+            sent += 1
+        del outq[:sent]
+
+    def __handle_flush(self, sock):
+        self.io_engine.unregister(sock, ioloop.EV_WRITE)
+        self.flush()
 
     # only client of one connection use
     def asend(self, remote_addr, data, on_sent, *args, **kwargs):
@@ -113,6 +184,25 @@ class UDPConnection(Connection):
             cerr = ConnError(E_FAIL, str(err))
         return cerr
 
+    # client or server use, one datagram made of bufs without joining them
+    def sendv(self, remote_addr, bufs):
+        if not HAS_SENDMSG:
+            return self.send(remote_addr, join_bufs(bufs))
+        self.remote_addr = remote_addr
+        try:
+            n = self.sock.sendmsg(bufs, (), 0, remote_addr)
+            if not self.bind_addr:
+                self.bind_addr = self.sock.getsockname()
+            self.logger.debug("udp %s:%d sendto %s:%d, data len=%d",
+                              self.bind_addr[0], self.bind_addr[1],
+                              remote_addr[0], remote_addr[1], n)
+            cerr = ConnError(E_OK, "")
+        except socket.error as err:
+            self.logger.error("udp sendto %s:%d failed. error=%s",
+                              remote_addr[0], remote_addr[1], err)
+            cerr = ConnError(E_FAIL, str(err))
+        return cerr
+
     def __handle_asend(self, sock, remote_addr, data, on_sent,
                        *args, **kwargs):
         assert self.sock == sock
@@ -128,11 +218,14 @@ class UDPConnection(Connection):
 
     def __handle_arecv(self, sock, on_recved, *args, **kwargs):
         assert self.sock == sock
+        if self.batch > 1:
+            self.__handle_arecv_batch(on_recved, *args, **kwargs)
+            return
         cerr = None
         remote_addr = None
         data = None
         try:
-            data, remote_addr = self.sock.recvfrom(self.recv_buffer_size)
+            data, remote_addr = self.__recvfrom()
             self.remote_addr = remote_addr
             self.logger.debug("udp %s:%d recvfrom %s:%d, data len=%d",
                               self.bind_addr[0], self.bind_addr[1],
@@ -146,13 +239,48 @@ class UDPConnection(Connection):
         if on_recved:
             on_recved(self, remote_addr, data, cerr, *args, **kwargs)
 
+    def __handle_arecv_batch(self, on_recved, *args, **kwargs):
+        ok = ConnError(E_OK, "")
+        msgs = []
+        try:
+            if self.msgs:
+                msgs = self.msgs.recv(self.sock.fileno())
+            else:
+                for _ in range(self.batch):
+                    msgs.append(self.__recvfrom())
+        except socket.error as err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.logger.error("udp %s:%d recvfrom failed. error=%s",
+                                  self.bind_addr[0], self.bind_addr[1], err)
+                if on_recved and not msgs:
+                    on_recved(self, None, None, ConnError(E_FAIL, str(err)),
+                              *args, **kwargs)
+        for data, remote_addr in msgs:
+            if self.closed:
+                break
+            self.remote_addr = remote_addr
+            if on_recved:
+                on_recved(self, remote_addr, data, ok, *args, **kwargs)
+
 class TCPConnection(Connection):
+    DEFAULT_TCP_RECV_BUFSIZE = 65536
+    # a message is 65537 bytes at most with its length, the buffer keeps
+    # one partial message and room to recv the rest of it
+    MSG_BUFSIZE = 2 * DEFAULT_TCP_RECV_BUFSIZE
     def __init__(self, *args, **kwargs):
         super(TCPConnection, self).__init__(*args, **kwargs)
         self.sock = None
         self.sent = 0               # has sent data len
         self.send_data = b''        # data to send
-        self.recved_buf = b''       # recved data buffer
+        self.rbuf = bytearray()     # recv into it, allocated when needed
+        self.rview = memoryview(self.rbuf)
+        self.rpos = 0               # data in rbuf is [rpos, wpos)
+        self.wpos = 0
+        # pipelined use
+        self.wbuf = bytearray()     # queued data to write
+        self.writing = False
+        self.on_msg = None
+        self.on_error = None
 
     def set_keepalive(self):
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
@@ -231,6 +359,16 @@ class TCPConnection(Connection):
 
     def __handle_aconnect(self, sock, on_connected, *args, **kwargs):
         assert self.sock == sock
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.logger.error("tcp connect to %s:%d failed. error=%s",
+                              self.remote_addr[0], self.remote_addr[1],
+                              errno.errorcode.get(err, err))
+            self.__close()
+            if on_connected:
+                on_connected(self, ConnError(E_FAIL, str(err)),
+                             *args, **kwargs)
+            return
         self.logger.debug("tcp %s:%d connected to %s:%d",
                           self.bind_addr[0], self.bind_addr[1],
                           self.remote_addr[0], self.remote_addr[1])
@@ -248,7 +386,7 @@ class TCPConnection(Connection):
         assert self.sock == sock
         cerr = None
         try:
-            sent = self.sock.send(self.send_data[self.sent:])
+            sent = self.sock.send(memoryview(self.send_data)[self.sent:])
             self.sent += sent
             if self.sent == len(self.send_data):
                 self.io_engine.unregister(self.sock, ioloop.EV_WRITE)
@@ -272,7 +410,14 @@ class TCPConnection(Connection):
         if on_sent:
             on_sent(self, cerr, *args, **kwargs)
 
+    def __reserve(self, size):
+        if len(self.rbuf) < size:
+            self.rbuf = bytearray(size)
+            self.rview = memoryview(self.rbuf)
+        self.rpos = self.wpos = 0
+
     def arecv(self, want_byte, on_recved, *args, **kwargs):
+        self.__reserve(want_byte)
         self.io_engine.register(self.sock, ioloop.EV_READ,
                                 self.__handle_arecv, want_byte, on_recved,
                                 *args, **kwargs)
@@ -281,15 +426,15 @@ class TCPConnection(Connection):
         assert self.sock == sock
         cerr = None
         try:
-            data = self.sock.recv(want_byte - len(self.recved_buf))
-            self.recved_buf += data
-            if data:
-                if len(self.recved_buf) < want_byte:
+            n = self.sock.recv_into(self.rview[self.wpos:want_byte])
+            self.wpos += n
+            if n:
+                if self.wpos < want_byte:
                     return
                 self.logger.debug("tcp %s:%d recved from %s:%d data len %d",
                                   self.bind_addr[0], self.bind_addr[1],
                                   self.remote_addr[0], self.remote_addr[1],
-                                  len(self.recved_buf))
+                                  self.wpos)
                 cerr = ConnError(E_OK, "")
             else:
                 self.__close()
@@ -302,6 +447,97 @@ class TCPConnection(Connection):
                               self.remote_addr[0], self.remote_addr[1], err)
             self.__close()
             cerr = ConnError(E_FAIL, str(err))
+        data = self.rview[:self.wpos].tobytes()
+        self.wpos = 0
         if on_recved:
-            on_recved(self, self.recved_buf, cerr, *args, **kwargs)
-        self.recved_buf = b''
+            on_recved(self, data, cerr, *args, **kwargs)
+
+    # pipelined client use, bufs are sent in order as if they were joined
+    def write(self, *bufs):
+        if self.closed:
+            return False
+        if self.writing or not HAS_SENDMSG:
+            for b in bufs:
+                self.wbuf += b
+        else:
+            # send at once, only the rest is copied to wait for writable
+            try:
+                sent = self.sock.sendmsg(bufs)
+            except socket.error:
+                sent = 0        # __handle_write will get the error again
+            for b in bufs:
+                if sent >= len(b):
+                    sent -= len(b)
+                    continue
+                self.wbuf += memoryview(b)[sent:]
+                sent = 0
+            if not self.wbuf:
+                return True
+        if not self.writing:
+            self.writing = True
+            self.io_engine.register(self.sock, ioloop.EV_WRITE,
+                                    self.__handle_write)
+        return True
+
+    def __handle_write(self, sock):
+        assert self.sock == sock
+        try:
+            sent = self.sock.send(self.wbuf)
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.__stream_error(str(err))
+            return
+        del self.wbuf[:sent]
+        if not self.wbuf:
+            self.writing = False
+            self.io_engine.unregister(self.sock, ioloop.EV_WRITE)
+
+    # pipelined client use, every message is prefixed by 2 bytes length
+    def arecv_msgs(self, on_msg, on_error):
+        self.on_msg = on_msg
+        self.on_error = on_error
+        self.__reserve(self.MSG_BUFSIZE)
+        self.io_engine.register(self.sock, ioloop.EV_READ,
+                                self.__handle_arecv_msgs)
+
+    def __handle_arecv_msgs(self, sock):
+        assert self.sock == sock
+        view = self.rview
+        try:
+            n = self.sock.recv_into(view[self.wpos:])
+        except socket.error as err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.__stream_error(str(err))
+            return
+        if not n:
+            self.__stream_error("connection closed")
+            return
+        self.wpos += n
+        buf = self.rbuf
+        pos, end = self.rpos, self.wpos
+        while end - pos >= 2:
+            length = (buf[pos] << 8) | buf[pos + 1]
+            if end - pos < length + 2:
+                break
+            msg = view[pos + 2:pos + 2 + length].tobytes()
+            pos += length + 2
+            self.rpos = pos
+            self.on_msg(self, msg)
+            if self.closed:
+                return
+        if pos == end:
+            self.rpos = self.wpos = 0
+        elif pos >= self.DEFAULT_TCP_RECV_BUFSIZE:
+            # move the partial message to the head, so it fits
+            view[:end - pos] = view[pos:end].tobytes()
+            self.rpos, self.wpos = 0, end - pos
+
+    def __stream_error(self, errmsg):
+        self.logger.info("tcp %s:%d to %s:%d closed. error=%s",
+                         self.bind_addr[0], self.bind_addr[1],
+                         self.remote_addr[0], self.remote_addr[1], errmsg)
+        self.__close()
+        if self.on_error:
+            self.on_error(self, ConnError(E_FAIL, errmsg))
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+
+class DomainSuffixes(object):
+    '''
+    Domain suffixes mapped to values. A name matches the longest suffix of
+    it in the table, by one dict lookup per label.
+    '''
+    def __init__(self):
+        self.m = {}             # b"qq.com." -> value
+
+    def __len__(self):
+        return len(self.m)
+
+    @staticmethod
+    def parse_line(line):
+        '''
+        return the dotted domain bytes of a line or None. The line is a
+        domain like "qq.com" or "*.qq.com", or a dnsmasq one like
+        "server=/qq.com/114.114.114.114". "#" starts a comment.
+        '''
+        line = line.split("#", 1)[0].strip()
+        if line.startswith("server=/") or line.startswith("ipset=/"):
+            line = line.split("/")[1]
+        line = line.lstrip("*").strip(".").lower()
+        if not line:
+            return None
+        try:
+            return line.encode("idna") + b"."
+        except UnicodeError:
+            return None
+
+    def load(self, lines, value):
+        '''add the domains of lines with value, return the number added'''
+        m = self.m
+        n = 0
+        for line in lines:
+            domain = self.parse_line(line)
+            if domain:
+                m[domain] = value
+                n += 1
+        return n
+
+    def find(self, qname):
+        '''value of the longest suffix of dotted qname, None if no one'''
+        m = self.m
+        if not m:
+            return None
+        pos, end = 0, len(qname) - 1
+        while pos < end:
+            value = m.get(qname[pos:] if pos else qname)
+            if value is not None:
+                return value
+            pos = qname.find(b".", pos) + 1
+            if not pos:
+                break
+        return None
@@ -1,22 +1,86 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 import sys
-import time
 import logging
-import struct
 from greendns import connection
+from greendns import upstream
+from greendns import wire
+from greendns import session
+from greendns import scoreboard
+from greendns import health
 
 
 class Forwarder(object):
-    def __init__(self, io_engine, upstreams, listen, timeout, handler):
+    HEDGE_SAMPLES = 8           # min rtts of the preferred upstream to hedge
+    HEDGE_MIN_DELAY = 0.005
+    DEGRADE_AFTER = 2           # failures in a row of a degraded upstream
+
+    def __init__(self, io_engine, upstreams, listen, timeout, handler,
+                 udp_sockets=4, tcp_conns=2, tcp_inflight=64, tcp_idle=10,
+                 reuse_port=False, batch_size=1, use_mmsg=False,
+                 coalesce=True, max_prefetches=8, stale_timeout=0, hedge=0,
+                 open_failures=5, probe_interval=5, probe_name="example.com"):
         self.logger = logging.getLogger()
         self.io_engine = io_engine
         self.handler = handler
         self.upstreams = upstreams
         self.timeout = timeout
-        # Connection -> Session, multi conn using the same Session object
+        # upstream.Query -> Session, multi queries using the same Session
+        # object. Each query has its own deadline timer.
         self.sessions = {}
+        # (qname, qtype, qclass, cd, edns) -> Session being resolved,
+        # identical requests wait for its answer instead of querying again
+        self.inflight = {}
+        self.coalesce = coalesce
+        # (client_addr, txid) -> (Session, req_data) of the requests not
+        # answered yet, to drop the retransmits of them
+        self.client_reqs = {}
+        # Session refreshing the cache, no client is waiting for them
+        self.prefetches = set()
+        self.max_prefetches = max_prefetches
+        # answer stale if the upstreams have not answered by then, 0 is
+        # only when all of them failed
+        self.stale_timeout = stale_timeout
+        # ask the best scored upstream first, and the others only if it has
+        # not answered by this percentile of its rtt, 0 is all at once
+        self.hedge = hedge
+        self.scores = scoreboard.Scoreboard()
+        handler.use_scores(self.scores)
+        # Addr -> health.UpstreamHealth. An upstream failed open_failures
+        # times in a row is not asked but probed by a query of probe_name
+        # every probe_interval until it answers, 0 is always asking it.
+        self.health = {}
+        self.open_failures = open_failures
+        self.probe_data = wire.make_query(probe_name)
+        self.probe_qname = wire.parse_question(self.probe_data).qname
+        self.probes = {}            # upstream.Query -> Addr
+        # Addr -> upstream.UDPUpstream or TCPUpstream, created when first used
+        self.upstream_pools = {}
+        self.udp_sockets = udp_sockets
+        self.tcp_conns = tcp_conns
+        self.tcp_inflight = tcp_inflight
+        self.tcp_idle = tcp_idle
+        self.requests = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.coalesced = 0
+        self.retransmits = 0
+        self.prefetched = 0
+        self.stale_answers = 0
+        self.fanouts = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.opened = 0
+        self.probed = 0
+        if open_failures:
+            io_engine.add_timer(False, probe_interval, self.probe_upstreams)
         self.server = connection.UDPConnection(io_engine=self.io_engine)
+        if reuse_port and not self.server.set_reuse_port():
+            print("SO_REUSEPORT is not supported", file=sys.stderr)
+            sys.exit(1)
+        self.batch_size = batch_size
+        if batch_size > 1:
+            self.server.set_batch(batch_size, use_mmsg)
         try:
             ip, port = listen.split(':')
             self.logger.info("binding to udp %s", listen)
@@ -27,123 +91,414 @@ class Forwarder(object):
             sys.exit(1)
 
     def send_response(self, client_addr, resp):
-        self.server.send(client_addr, resp)
+        self.responses += 1
+        if self.batch_size > 1:
+            self.server.queue(client_addr, resp)
+        else:
+            self.server.send(client_addr, resp)
+
+    def stats(self):
+        s = {
+            "requests": self.requests,
+            "responses": self.responses,
+            "timeouts": self.timeouts,
+            "coalesced": self.coalesced,
+            "retransmits": self.retransmits,
+            "prefetched": self.prefetched,
+            "stale_answers": self.stale_answers,
+            "fanouts": self.fanouts,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "opened": self.opened,
+            "probed": self.probed,
+            "upstreams_open": sum(1 for h in self.health.values()
+                                  if h.state == health.OPEN),
+            "inflight": len(self.sessions),
+        }
+        s.update(self.handler.stats())
+        return s
+
+    def dump(self):
+        '''lines of the upstream health and what the handler learned'''
+        return ["health %s:%s:%d %s failures=%d" %
+                (addr[0], addr[1], addr[2], h.state, h.failures)
+                for addr, h in self.health.items()] + self.handler.dump()
+
+    def state(self, addr):
+        h = self.health.get(addr)
+        return h.state if h else health.HEALTHY
+
+    def available(self, addrs):
+        '''addrs not open, or all of them if they are all open'''
+        up = [addr for addr in addrs if self.state(addr) != health.OPEN]
+        return up or addrs
+
+    def upstream_done(self, addr, ok):
+        '''update the health of addr by one query, ok if answered'''
+        if not self.open_failures:
+            return
+        h = self.health.get(addr)
+        if h is None:
+            h = self.health[addr] = health.UpstreamHealth(
+                min(self.DEGRADE_AFTER, self.open_failures),
+                self.open_failures)
+        if not (h.succeeded() if ok else h.failed()):
+            return
+        if h.state == health.OPEN:
+            self.opened += 1
+            self.logger.warning("upstream %s:%s:%d is down, %d failures",
+                                addr[0], addr[1], addr[2], h.failures)
+        else:
+            self.logger.info("upstream %s:%s:%d is %s",
+                             addr[0], addr[1], addr[2], h.state)
+        self.handler.on_upstream_state(addr, h.state)
+
+    def probe_upstreams(self):
+        '''ask the open upstreams the probe query'''
+        for addr, h in self.health.items():
+            if h.state != health.OPEN or h.probe:
+                continue
+            query = self.get_upstream(addr).query(session.Session(),
+                                                  self.probe_data,
+                                                  self.probe_qname)
+            if not query:
+                continue
+            self.probed += 1
+            h.probe = query
+            self.probes[query] = addr
+            query.timer = self.io_engine.add_timer(
+                True, self.timeout, self.handle_probe_timeout, query)
+
+    def handle_probe_response(self, query):
+        addr = self.probes.pop(query)
+        self.io_engine.cancel_timer(query.timer)
+        self.health[addr].probe = None
+        self.upstream_done(addr, True)
+
+    def handle_probe_timeout(self, query):
+        addr = self.probes.pop(query, None)
+        if addr is None:
+            return
+        query.close()
+        self.health[addr].probe = None
+        self.upstream_done(addr, False)
+
+    def respond(self, sess, resp):
+        '''answer the client of sess and the ones waiting for it'''
+        if not sess.prefetch:
+            self.send_response(sess.client_addr, resp)
+        for client_addr, req_data, qend in sess.waiters:
+            self.send_response(client_addr,
+                               wire.reply_to(resp, req_data, qend))
 
     def should_response(self, sess, addr):
         if not sess.responsed:
             resp = self.handler.on_upstream_response(sess, addr)
             if resp:
-                self.send_response(sess.client_addr, resp)
+                self.respond(sess, resp)
                 sess.responsed = True
+                if addr in sess.hedged:
+                    self.hedge_wins += 1
+                self.end_session(sess)
 
-    def check_timeout(self):
-        '''this is not accurate, max delay is 2 * timeout'''
-        to_delete = []
-        now = time.time()
-        for conn, sess in self.sessions.items():
-            if now < sess.send_ts + self.timeout:
-                continue
-            if conn.bind_addr and conn.remote_addr:
-                self.logger.warning("[sid=%d] %s:%d request %s:%d to upstream timeout",
-                                    sess.sid,
-                                    conn.bind_addr[0], conn.bind_addr[1],
-                                    conn.remote_addr[0], conn.remote_addr[1])
-                conn.close()
-            else:
-                self.logger.warning("[sid=%d] no bind addr", sess.sid)
-            to_delete.append(conn)
-        for conn in to_delete:
-            del self.sessions[conn]
-        if to_delete:
-            self.logger.debug("remaining client request size=%d", len(self.sessions))
+    def handle_client_deadline(self, sess):
+        sess.timer = None
+        self.serve_stale(sess)
+
+    def serve_stale(self, sess):
+        '''
+        No answer by the client deadline or from any upstream. Answer the
+        clients with the stale one of the handler if any, and sess goes on
+        without client to refresh the cache.
+        '''
+        if sess.responsed or sess.prefetch:
+            return
+        resp = self.handler.on_timeout(sess)
+        if not resp:
+            return
+        self.stale_answers += 1
+        self.respond(sess, resp)
+        self.end_session(sess)
+        sess.prefetch = True
+
+    def end_session(self, sess):
+        '''no more answer, later identical requests make a new session'''
+        if sess.timer:
+            self.io_engine.cancel_timer(sess.timer)
+            sess.timer = None
+        if sess.hedge_timer:
+            self.io_engine.cancel_timer(sess.hedge_timer)
+            sess.hedge_timer = None
+        sess.hedges = []
+        if sess.key is not None and self.inflight.get(sess.key) is sess:
+            del self.inflight[sess.key]
+        self.prefetches.discard(sess)
+        clients = [(client_addr, req_data)
+                   for client_addr, req_data, _ in sess.waiters]
+        if not sess.prefetch:
+            clients.append((sess.client_addr, sess.req_data))
+        for client_addr, req_data in clients:
+            ckey = (client_addr, req_data[:2])
+            if self.client_reqs.get(ckey, (None,))[0] is sess:
+                del self.client_reqs[ckey]
+        sess.waiters = []
+
+    def handle_timeout(self, query):
+        '''called by the deadline of the query'''
+        sess = self.sessions.pop(query, None)
+        if not sess:
+            return
+        self.timeouts += 1
+        sess.queries -= 1
+        elapsed = self.io_engine.time() - query.send_ts
+        self.scores.timed_out(query.addr, elapsed)
+        self.upstream_done(query.addr, False)
+        self.handler.on_query_done(sess, query.addr, elapsed, False)
+        if not sess.queries:
+            self.finish(sess)
+        if query.bind_addr and query.remote_addr:
+            self.logger.warning("[sid=%d] %s:%d request %s:%d to upstream timeout",
+                                sess.sid,
+                                query.bind_addr[0], query.bind_addr[1],
+                                query.remote_addr[0], query.remote_addr[1])
+        else:
+            self.logger.warning("[sid=%d] no bind addr", sess.sid)
+        query.close()
+        self.logger.debug("remaining client request size=%d", len(self.sessions))
 
     def handle_request_from_client(self, conn, remote_addr, data, err):
         if err.errcode != connection.E_OK or not data:
             return
+        self.requests += 1
+        ckey = (remote_addr, data[:2])
+        req = self.client_reqs.get(ckey)
+        if req and req[1] == data:
+            self.retransmits += 1
+            self.logger.debug("[sid=%d] retransmit from %s:%d",
+                              req[0].sid, remote_addr[0], remote_addr[1])
+            return
         sess = self.handler.new_session()
         sess.client_addr = remote_addr
-        sess.send_ts = time.time()
+        sess.send_ts = self.io_engine.time()
         sess.req_data = data
         is_continue, resp = self.handler.on_client_request(sess)
         if resp:
             self.send_response(sess.client_addr, resp)
+            if sess.refresh:
+                self.prefetch(sess)
             return
         if not is_continue:
             self.logger.error("[sid=%d] invalid request from client", sess.sid)
             return
-        for addr in self.upstreams:
-            remote_addr = addr[1], addr[2]
-            if addr.protocol == 'udp':
-                conn = connection.UDPConnection(io_engine=self.io_engine)
-                conn.asend(remote_addr, sess.req_data, self.handle_udp_request)
-            elif addr.protocol == 'tcp':
-                conn = connection.TCPConnection(io_engine=self.io_engine)
-                conn.aconnect(remote_addr, self.handle_tcp_connected)
-            else:
+        self.resolve(sess)
+
+    def prefetch(self, sess):
+        '''resolve the request of sess again without client, to refresh
+        the cache before it expires'''
+        if len(self.prefetches) >= self.max_prefetches:
+            return
+        p = self.handler.new_session()
+        p.prefetch = True
+        p.send_ts = self.io_engine.time()
+        p.req_data = sess.req_data
+        is_continue, _ = self.handler.on_client_request(p)
+        if not is_continue:
+            return
+        self.logger.debug("[sid=%d] prefetch for sid=%d", p.sid, sess.sid)
+        self.resolve(p)
+
+    def resolve(self, sess):
+        '''query the upstreams for sess, or wait for the same request'''
+        qname, key = None, None
+        try:
+            header, question = wire.parse_request(sess.req_data)
+            if question:
+                qname = question.qname
+                # the answers differ by the cd bit and the edns of requests
+                edns = wire.edns(sess.req_data, header, question.end)
+                if edns is not None:
+                    edns = (wire.payload_class(edns.payload), edns.do)
+                key = (qname, question.qtype, question.qclass,
+                       bool(header.flags & wire.FLAG_CD), edns)
+        except wire.WireError:
+            pass
+        ckey = (sess.client_addr, sess.req_data[:2])
+        if key is not None and self.coalesce:
+            leader = self.inflight.get(key)
+            if leader:
+                if sess.prefetch:
+                    # the answer being resolved refreshes the cache too
+                    return
+                leader.waiters.append((sess.client_addr, sess.req_data,
+                                       question.end))
+                self.coalesced += 1
+                self.client_reqs[ckey] = (leader, sess.req_data)
+                self.logger.debug("[sid=%d] wait for the same request sid=%d",
+                                  sess.sid, leader.sid)
+                return
+            sess.key = key
+            self.inflight[key] = sess
+        if sess.prefetch:
+            self.prefetches.add(sess)
+            self.prefetched += 1
+        else:
+            self.client_reqs[ckey] = (sess, sess.req_data)
+        sess.qname = qname
+        addrs = self.available(self.handler.route(sess) or self.upstreams)
+        if self.hedge and len(addrs) > 1:
+            addrs = self.start_hedge(sess, addrs)
+        self.send_queries(sess, addrs)
+        if not sess.queries:
+            self.finish(sess)
+        elif self.stale_timeout and not sess.prefetch:
+            sess.timer = self.io_engine.add_timer(
+                True, self.stale_timeout, self.handle_client_deadline, sess)
+
+    def start_hedge(self, sess, addrs):
+        '''
+        return the addrs to ask now, the best scored one of each group of
+        interchangeable addrs by the handler. The others of a group are
+        asked if the best one has not answered by the hedge percentile of
+        its rtt, the longest one of the groups.
+        '''
+        now, delays = [], []
+        groups = [g for g in self.handler.hedge_groups(sess, addrs) if g]
+        for group in groups:
+            group = self.scores.best(group, len(group))
+            group.sort(key=lambda addr: self.state(addr) != health.HEALTHY)
+            delay = None
+            if len(group) > 1:
+                delay = self.scores.percentile(group[0], self.hedge,
+                                               self.HEDGE_SAMPLES)
+            if delay is None:
+                now.extend(group)
+                continue
+            now.append(group[0])
+            sess.hedges.extend(group[1:])
+            delays.append(delay)
+        if delays:
+            delay = min(max(max(delays), self.HEDGE_MIN_DELAY), self.timeout)
+            sess.hedge_groups = groups
+            sess.hedge_timer = self.io_engine.add_timer(
+                True, delay, self.handle_hedge_deadline, sess)
+        return now
+
+    def hedge_answered(self, sess, addr):
+        '''
+        addr answered but sess is not answered yet. Its answer can not be
+        used if all the upstreams are interchangeable, ask the hedges now.
+        Otherwise the handler waits for another group, the hedges of the
+        group of addr are not needed.
+        '''
+        if len(sess.hedge_groups) <= 1:
+            self.send_hedges(sess)
+            return
+        for group in sess.hedge_groups:
+            if addr in group:
+                sess.hedges = [a for a in sess.hedges if a not in group]
+        if not sess.hedges and sess.hedge_timer:
+            self.io_engine.cancel_timer(sess.hedge_timer)
+            sess.hedge_timer = None
+
+    def handle_hedge_deadline(self, sess):
+        sess.hedge_timer = None
+        self.send_hedges(sess)
+
+    def send_hedges(self, sess):
+        '''no usable answer yet, ask the hedges of sess now'''
+        if sess.hedge_timer:
+            self.io_engine.cancel_timer(sess.hedge_timer)
+            sess.hedge_timer = None
+        addrs, sess.hedges = sess.hedges, []
+        if not addrs:
+            return
+        self.hedged += 1
+        self.logger.debug("[sid=%d] hedge to %d upstreams", sess.sid,
+                          len(addrs))
+        sess.hedged = addrs
+        self.send_queries(sess, addrs)
+
+    def send_queries(self, sess, addrs):
+        for addr in addrs:
+            if addr.protocol not in ('udp', 'tcp'):
                 self.logger.error("[sid=%d] invalid protocol %s", sess.sid, addr.protocol)
                 continue
-            if conn:
-                self.sessions[conn] = sess
+            sess.upstreams.append(addr)
+            query = self.get_upstream(addr).query(sess, sess.req_data,
+                                                  sess.qname)
+            if query:
+                self.sessions[query] = sess
+                sess.queries += 1
+                query.timer = self.io_engine.add_timer(
+                    True, self.timeout, self.handle_timeout, query)
+            else:
+                self.logger.error("[sid=%d] send to %s:%d failed",
+                                  sess.sid, addr[1], addr[2])
 
-    def handle_udp_request(self, conn, _, err):
-        if err.errcode == connection.E_OK:
-            conn.arecv(self.handle_udp_response)
-        else:
-            conn.close()
-            del self.sessions[conn]
-
-    def handle_udp_response(self, conn, remote_addr, data, err):
-        sess = self.sessions.get(conn)
-        assert sess
-        conn.close()
-        del self.sessions[conn]
-        if err.errcode == connection.E_OK and data:
-            self.logger.debug("remaining client request size=%d",
-                              len(self.sessions))
-            addr = connection.Addr('udp', remote_addr[0], remote_addr[1])
-            sess.server_resps[addr] = data
-            self.should_response(sess, addr)
-
-    def handle_tcp_connected(self, conn, err):
-        sess = self.sessions.get(conn)
-        assert sess
-        if err.errcode == connection.E_OK:
-            data = struct.pack(">H%us" % len(sess.req_data),
-                               len(sess.req_data), sess.req_data)
-            conn.asend(data, self.handle_tcp_sent)
-        else:
-            conn.close()
-            del self.sessions[conn]
+    def finish(self, sess):
+        '''
+        all queries of sess finished. If there is no answer, ask the hedges
+        not asked yet, or the others if the handler routed it to some of
+        the upstreams.
+        '''
+        if not sess.responsed:
+            if sess.hedges:
+                self.send_hedges(sess)
+                if sess.queries:
+                    return
+            rest = [addr for addr in self.upstreams
+                    if addr not in sess.upstreams and
+                    self.state(addr) != health.OPEN]
+            if rest:
+                self.fanouts += 1
+                self.logger.info("[sid=%d] no answer, ask the other upstreams",
+                                 sess.sid)
+                self.send_queries(sess, rest)
+                if sess.queries:
+                    return
+            self.serve_stale(sess)
+        self.end_session(sess)
 
-    def handle_tcp_sent(self, conn, err):
-        if err.errcode == connection.E_OK:
-            payload_length_bytes = 2
-            conn.arecv(payload_length_bytes, self.handle_length_recved)
-        else:
-            conn.close()
-            del self.sessions[conn]
+    def get_upstream(self, addr):
+        u = self.upstream_pools.get(addr)
+        # not "if not u", an idle pool has no query and is false by __len__
+        if u is None:
+            if addr.protocol == 'udp':
+                u = upstream.UDPUpstream(self.io_engine, addr,
+                                         self.handle_upstream_response,
+                                         self.udp_sockets)
+            else:
+                u = upstream.TCPUpstream(self.io_engine, addr,
+                                         self.handle_upstream_response,
+                                         self.tcp_conns, self.tcp_inflight,
+                                         self.tcp_idle)
+            self.upstream_pools[addr] = u
+        return u
 
-    def handle_length_recved(self, conn, data, err):
-        if err.errcode == connection.E_OK:
-            payload_length = struct.unpack(">H", data)[0]
-            conn.arecv(payload_length, self.handle_payload_recved)
-        else:
-            conn.close()
-            del self.sessions[conn]
-
-    def handle_payload_recved(self, conn, data, err):
-        sess = self.sessions.get(conn)
-        assert sess
-        conn.close()
-        del self.sessions[conn]
-        if err.errcode == connection.E_OK:
-            self.logger.debug("remaining client request size=%d", len(self.sessions))
-            addr = connection.Addr('tcp', conn.remote_addr[0], conn.remote_addr[1])
-            sess.server_resps[addr] = data
-            self.should_response(sess, addr)
+    def handle_upstream_response(self, query, data):
+        if query in self.probes:
+            self.handle_probe_response(query)
+            return
+        sess = self.sessions.pop(query, None)
+        if not sess:
+            return
+        if query.timer:
+            self.io_engine.cancel_timer(query.timer)
+        self.logger.debug("remaining client request size=%d",
+                          len(self.sessions))
+        sess.queries -= 1
+        sess.server_resps[query.addr] = data
+        rtt = self.io_engine.time() - query.send_ts
+        self.scores.answered(query.addr, rtt)
+        self.upstream_done(query.addr, True)
+        self.handler.on_query_done(sess, query.addr, rtt, True)
+        self.should_response(sess, query.addr)
+        if sess.hedges:
+            self.hedge_answered(sess, query.addr)
+        if not sess.queries:
+            self.finish(sess)
 
     def run_forever(self):
-        self.io_engine.add_timer(False, self.timeout, self.check_timeout)
         self.server.arecv(self.handle_request_from_client)
         self.logger.info("waiting for requests")
         self.server.run()
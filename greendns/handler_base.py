@@ -12,6 +12,10 @@ class HandlerBase(object):
     def parse_arg(self, parser, remaining_argv):
         pass
 
+    def load(self):
+        '''load data, called once before forking the workers'''
+        pass
+
     def init(self, io_engine):
         return []
 
@@ -21,8 +25,41 @@ class HandlerBase(object):
     def on_client_request(self, sess):
         return (True, None)
 
+    def route(self, sess):
+        '''return the upstreams to query for sess, None is all of them'''
+        return None
+
+    def hedge_groups(self, sess, addrs):
+        '''
+        return lists of addrs whose answers are interchangeable, the hedging
+        is within each of them
+        '''
+        return [addrs]
+
     def on_upstream_response(self, sess, addr):
         return None
 
+    def use_scores(self, scores):
+        '''scoreboard.Scoreboard of the upstreams fed by the forwarder'''
+        pass
+
+    def on_query_done(self, sess, addr, rtt, ok):
+        '''
+        the query of sess to upstream addr got an answer or timed out (not
+        ok) after rtt seconds, answers after the response of sess included
+        '''
+        pass
+
+    def on_upstream_state(self, addr, state):
+        '''upstream addr becomes health.HEALTHY, DEGRADED or OPEN'''
+        pass
+
     def on_timeout(self, sess):
         return None
+
+    def stats(self):
+        return {}
+
+    def dump(self):
+        '''lines of the learned state to inspect'''
+        return []
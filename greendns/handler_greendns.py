@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
+import time
 import logging
 import argparse
-import random
+from collections import OrderedDict
 import dnslib
 from pkg_resources import resource_filename
 from greendns import session
@@ -10,17 +11,35 @@ from greendns import connection
 from greendns import localnet
 from greendns import handler_base
 from greendns import cache
+from greendns import wire
+from greendns import domains
+from greendns import health
+
+ROUTE_LOCAL = "local"
+ROUTE_FOREIGN = "foreign"
+# second level domains of country code tlds, like com.cn
+CC_SLDS = frozenset([b"com", b"net", b"org", b"gov", b"edu", b"ac", b"co"])
+
+
+def registrable_domain(qname):
+    '''approximate registrable domain of dotted qname, like b"qq.com."'''
+    labels = qname.rstrip(b".").split(b".")
+    n = 3 if len(labels) > 2 and len(labels[-1]) == 2 and \
+        labels[-2] in CC_SLDS else 2
+    return b".".join(labels[-n:]) + b"."
 
 
 class GreenDNSSession(session.Session):
     def __init__(self):
         super(GreenDNSSession, self).__init__()
         self.qtype = 0
-        self.qname = ""
+        self.qname = b""
         self.is_poisoned = False
         self.local_result = None
         self.unpoisoned_result = None
         self.matrix = [[0, 0], [0, 0]]
+        self.route = None           # only the servers of it are queried
+        self.static_route = False   # route by the domain lists
 
 
 class GreenDNSHandler(handler_base.HandlerBase):
@@ -47,6 +66,29 @@ class GreenDNSHandler(handler_base.HandlerBase):
         self.rds = None
         self.cache_enabled = False
         self.cache = cache.Cache()
+        self.stale_ttl = 0
+        self.neg_ttl = 0
+        self.neg_hits = 0       # NXDOMAIN or NODATA answered by cache
+        self.neg_misses = 0     # NXDOMAIN or NODATA from upstreams
+        self.prefetch_ratio = 0
+        self.prefetch_hits = 0
+        # cache key -> [ts, hits] of the entry, expiring with it
+        self.hot = cache.Cache()
+        # registrable domain -> (ROUTE_*, confidence, expire_ts), the servers
+        # whose answer of A record was used last time
+        self.routes = OrderedDict()
+        self.route_ttl = 0
+        self.route_confidence = 0
+        self.route_size = 0
+        self.routed = 0
+        self.f_local_domains = None
+        self.f_foreign_domains = None
+        self.domains = domains.DomainSuffixes()     # domain -> ROUTE_*
+        self.static_routed = 0
+        self.down = set()           # upstream Addr known to be down
+        self.local_fallbacks = 0
+        self.unpoisoned_fallbacks = 0
+        self.route_changes = 0
         self.local_servers = []
         self.unpoisoned_servers = []
 
@@ -69,6 +111,59 @@ class GreenDNSHandler(handler_base.HandlerBase):
                             help="Specify if rfc1918 ip is local")
         parser.add_argument("--cache", dest="cache", action="store_true",
                             help="Specify if cache is enabled")
+        parser.add_argument("--cache-size", dest="cache_size", type=int,
+                            default=10000,
+                            help="Specify max cache entries, 0 is unlimited "
+                                 "except for shm")
+        parser.add_argument("--cache-bytes", dest="cache_bytes", type=int,
+                            default=0,
+                            help="Specify max cache bytes, 0 is unlimited")
+        parser.add_argument("--cache-backend", dest="cache_backend",
+                            choices=["memory", "shm"], default="memory",
+                            help="Specify cache backend, shm is shared by "
+                                 "all processes on the host")
+        parser.add_argument("--cache-shm", dest="cache_shm",
+                            default="/dev/shm/greendns-cache",
+                            help="Specify file of the shm cache")
+        parser.add_argument("--cache-neg-ttl", dest="cache_neg_ttl", type=int,
+                            default=300,
+                            help="Specify max ttl of cached NXDOMAIN and "
+                                 "NODATA answers, 0 is not cached")
+        parser.add_argument("--cache-stale", dest="cache_stale", type=float,
+                            default=0,
+                            help="Specify seconds to keep expired cache "
+                                 "entries to answer when upstreams fail, "
+                                 "0 is never")
+        parser.add_argument("--stale-ttl", dest="stale_ttl", type=int,
+                            default=30,
+                            help="Specify ttl of stale answers")
+        parser.add_argument("--local-domains", dest="local_domains",
+                            type=argparse.FileType('r'),
+                            help="Specify file of domains to ask the local "
+                                 "servers only, one domain or dnsmasq "
+                                 "server=/domain/ line each")
+        parser.add_argument("--foreign-domains", dest="foreign_domains",
+                            type=argparse.FileType('r'),
+                            help="Specify file of domains to ask the "
+                                 "unpoisoned servers only")
+        parser.add_argument("--route-ttl", dest="route_ttl", type=float,
+                            default=600,
+                            help="Specify seconds to remember which servers "
+                                 "answer a domain, 0 is always asking all")
+        parser.add_argument("--route-confidence", dest="route_confidence",
+                            type=int, default=3,
+                            help="Specify times of the same servers "
+                                 "answering a domain to ask only them")
+        parser.add_argument("--route-size", dest="route_size", type=int,
+                            default=10000,
+                            help="Specify max domains remembered")
+        parser.add_argument("--prefetch-ratio", dest="prefetch_ratio",
+                            type=float, default=0.9,
+                            help="Specify share of ttl passed to prefetch "
+                                 "a hot cache entry, 0 is never")
+        parser.add_argument("--prefetch-hits", dest="prefetch_hits", type=int,
+                            default=3,
+                            help="Specify min hits of a hot cache entry")
 
     def parse_arg(self, parser, remaining_argv):
         myargs = parser.parse_args(remaining_argv)
@@ -76,13 +171,58 @@ class GreenDNSHandler(handler_base.HandlerBase):
         self.f_blacklist = myargs.blacklist
         self.using_rfc1918 = myargs.rfc1918
         self.cache_enabled = myargs.cache
+        if self.cache_enabled and myargs.cache_backend == "shm":
+            if cache.fcntl is None:
+                parser.error("--cache-backend shm is not supported on "
+                             "this platform")
+            slot_size = cache.ShmCache.SLOT_SIZE
+            # the shm table is of fixed size
+            if myargs.cache_bytes:
+                slots = myargs.cache_bytes // slot_size
+                if slots <= 0:
+                    parser.error("--cache-bytes of at least %d is required "
+                                 "by the shm cache" % slot_size)
+            else:
+                slots = myargs.cache_size
+                if slots <= 0:
+                    parser.error("--cache-size of at least 1 is required "
+                                 "by the shm cache")
+            self.cache = cache.ShmCache(myargs.cache_shm, slots,
+                                        encode=wire.PackedResponse.tobytes,
+                                        decode=wire.PackedResponse.frombytes,
+                                        stale=myargs.cache_stale)
+        else:
+            self.cache = cache.Cache(myargs.cache_size, myargs.cache_bytes,
+                                     myargs.cache_stale)
+        self.hot.max_entries = myargs.cache_size
+        self.stale_ttl = myargs.stale_ttl
+        self.neg_ttl = myargs.cache_neg_ttl
+        self.f_local_domains = myargs.local_domains
+        self.f_foreign_domains = myargs.foreign_domains
+        self.route_ttl = myargs.route_ttl
+        self.route_confidence = myargs.route_confidence
+        self.route_size = myargs.route_size
+        self.prefetch_ratio = myargs.prefetch_ratio
+        self.prefetch_hits = myargs.prefetch_hits
         self.lds = myargs.lds
         self.rds = myargs.rds
 
-    def init(self, io_engine):
+    def load(self):
+        # shared by the workers copy-on-write
         self.cnet = localnet.LocalNet(self.f_localroute,
                                       self.f_blacklist,
                                       self.using_rfc1918)
+        # the longer suffix wins if a domain is in both
+        for f, group in ((self.f_local_domains, ROUTE_LOCAL),
+                         (self.f_foreign_domains, ROUTE_FOREIGN)):
+            if f:
+                n = self.domains.load(f, group)
+                self.logger.info("loaded %d %s domains from %s",
+                                 n, group, f.name)
+
+    def init(self, io_engine):
+        if self.cnet is None:
+            self.load()
         for l in self.lds.split(','):
             addr = connection.parse_addr(l)
             if addr is None:
@@ -95,7 +235,7 @@ class GreenDNSHandler(handler_base.HandlerBase):
             self.unpoisoned_servers.append(addr)
 
         if self.cache_enabled:
-            io_engine.add_timer(False, 1, self.__decrease_ttl_one)
+            io_engine.add_timer(False, 1, self.validate)
 
         self.logger.info("using local servers: %s", self.local_servers)
         self.logger.info("using unpoisoned servers: %s", self.unpoisoned_servers)
@@ -104,31 +244,135 @@ class GreenDNSHandler(handler_base.HandlerBase):
     def new_session(self):
         return GreenDNSSession()
 
+    def validate(self):
+        self.cache.validate()
+        self.hot.validate()
+
+    def __is_hot(self, key, packed, now):
+        '''count the hit, return True if the entry should be prefetched'''
+        if not self.prefetch_ratio:
+            return False
+        ttl = packed.min_ttl()
+        h = self.hot.find(key)
+        if h is None or h[0] != packed.ts:
+            h = [packed.ts, 0]
+            self.hot.add(key, h, packed.ts + ttl - now)
+        h[1] += 1
+        return h[1] >= self.prefetch_hits and \
+            now - packed.ts >= ttl * self.prefetch_ratio
+
+    def stats(self):
+        s = {
+            "routes": len(self.routes),
+            "routed": self.routed,
+            "static_routed": self.static_routed,
+            "local_fallbacks": self.local_fallbacks,
+            "unpoisoned_fallbacks": self.unpoisoned_fallbacks,
+            "route_changes": self.route_changes,
+        }
+        if self.cache_enabled:
+            c = self.cache.stats()
+            c["neg_hits"] = self.neg_hits
+            c["neg_misses"] = self.neg_misses
+            s.update(("cache_" + k, v) for k, v in c.items())
+        return s
+
+    def dump(self):
+        now = time.time()
+        return ["route %s %s confidence=%d ttl=%d" %
+                (domain.decode("ascii", "replace"), group, confidence,
+                 expire_ts - now)
+                for domain, (group, confidence, expire_ts)
+                in self.routes.items()]
+
+    def __servers(self, group):
+        if group == ROUTE_LOCAL:
+            return self.local_servers
+        return self.unpoisoned_servers
+
+    def route(self, sess):
+        group = self.domains.find(sess.qname)
+        if group:
+            sess.route, sess.static_route = group, True
+            self.static_routed += 1
+            return self.__servers(group)
+        if not self.route_ttl or sess.qtype != dnslib.QTYPE.A:
+            return None
+        domain = registrable_domain(sess.qname)
+        r = self.routes.get(domain)
+        if not r:
+            return None
+        group, confidence, expire_ts = r
+        if time.time() >= expire_ts:
+            del self.routes[domain]
+            return None
+        if confidence < self.route_confidence:
+            return None
+        sess.route = group
+        self.routed += 1
+        self.logger.info("[sid=%d] ask %s servers only", sess.sid, group)
+        return self.__servers(group)
+
+    def hedge_groups(self, sess, addrs):
+        '''the answers of both the local and the unpoisoned are needed'''
+        return [[addr for addr in addrs if addr in self.local_servers],
+                [addr for addr in addrs if addr in self.unpoisoned_servers]]
+
+    def __learn(self, sess, group):
+        if not self.route_ttl or sess.static_route:
+            return
+        domain = registrable_domain(sess.qname)
+        r = self.routes.get(domain)
+        if r and r[0] != group:
+            # forget it, all servers are asked until learned again
+            del self.routes[domain]
+            self.route_changes += 1
+            self.logger.info("[sid=%d] answer of %s changed to %s servers",
+                             sess.sid, domain.decode("ascii", "replace"),
+                             group)
+            return
+        if sess.route:
+            # only the servers of the route were asked, it can not confirm
+            # itself. It expires route_ttl after the last full fan-out.
+            return
+        self.routes.pop(domain, None)
+        confidence = r[1] + 1 if r else 1
+        self.routes[domain] = (group, confidence, time.time() + self.route_ttl)
+        while len(self.routes) > self.route_size:
+            self.routes.popitem(last=False)
+
     def on_client_request(self, sess):
         is_continue, raw_resp = False, ""
         try:
-            d = dnslib.DNSRecord.parse(sess.req_data)
-        except Exception as e:
+            header, question = wire.parse_request(sess.req_data)
+        except wire.WireError as e:
             self.logger.error("[sid=%d] parse request error, msg=%s, data=%s",
                               sess.sid, e, sess.req_data)
             return (is_continue, raw_resp)
-        self.logger.debug("[sid=%d] request detail,\n%s", sess.sid, d)
-        if not d.questions:
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.__dump(sess.sid, "request detail", sess.req_data)
+        if not question:
             return (is_continue, raw_resp)
-        qtype = d.questions[0].qtype
-        qname = str(d.questions[0].qname)
-        tid = d.header.id
-        self.logger.info("[sid=%d] received request, name=%s, type=%s, id=%d",
-                         sess.sid, qname, dnslib.QTYPE.get(qtype), tid)
-        if self.cache_enabled:
-            resp = self.cache.find((qname, qtype))
-            if resp:
-                self.__replace_id(resp.header, tid)
-                if qtype == dnslib.QTYPE.A:
-                    self.__shuffer_A(resp)
+        qtype = question.qtype
+        qname = question.qname
+        tid = header.id
+        self.logger.info("[sid=%d] %s request, name=%s, type=%s, id=%d",
+                         sess.sid, "prefetch" if sess.prefetch else "received",
+                         qname.decode("ascii", "replace"),
+                         dnslib.QTYPE.get(qtype), tid)
+        if self.cache_enabled and not sess.prefetch:
+            key = (qname, qtype)
+            packed = self.cache.find(key)
+            if packed:
+                now = time.time()
+                resp = packed.make(tid, now, rotate=qtype == dnslib.QTYPE.A)
+                sess.refresh = self.__is_hot(key, packed, now)
+                if packed.is_negative():
+                    self.neg_hits += 1
                 self.logger.info("[sid=%d] cache hit", sess.sid)
-                self.logger.debug("[sid=%d] response detail,\n%s", sess.sid, resp)
-                return (is_continue, bytes(resp.pack()))
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.__dump(sess.sid, "response detail", resp)
+                return (is_continue, resp)
         sess.qtype, sess.qname = qtype, qname
         is_continue = True
         return (is_continue, raw_resp)
@@ -139,61 +383,111 @@ class GreenDNSHandler(handler_base.HandlerBase):
             resp = self.__handle_A(sess, addr)
         else:
             #using the first answer from local server for other qtype
-            if addr in self.local_servers:
+            if addr in self.local_servers or sess.route == ROUTE_FOREIGN or \
+                    self.__all_down(self.local_servers):
                 self.logger.info("[sid=%d] %s:%s:%d answer used",
                                  sess.sid, addr[0], addr[1], addr[2])
                 resp = self.__handle_other(sess, addr)
         if resp:
-            if self.cache_enabled and resp.rr:
-                for answer in resp.rr:
-                    if answer.rtype == sess.qtype:
-                        ttl = answer.ttl
-                        self.cache.add((sess.qname, sess.qtype), resp, ttl)
-                        self.logger.info(
-                            "[sid=%d] add to cache, key=(%s, %s), ttl=%d",
-                            sess.sid, sess.qname, dnslib.QTYPE.get(sess.qtype),
-                            ttl)
-                        break
-            return bytes(resp.pack())
+            if self.cache_enabled:
+                self.__add_cache(sess, resp)
+            # the upstream answer is forwarded as is
+            return resp
         return ""
 
+    def on_upstream_state(self, addr, state):
+        if state == health.OPEN:
+            self.down.add(addr)
+        else:
+            self.down.discard(addr)
+
+    def __all_down(self, servers):
+        return bool(servers) and self.down.issuperset(servers)
+
+    def on_timeout(self, sess):
+        '''no answer in time, use the stale one in cache if any'''
+        if not self.cache_enabled or not self.cache.stale or not sess.qname:
+            return None
+        packed = self.cache.find_stale((sess.qname, sess.qtype))
+        if not packed:
+            return None
+        self.logger.info("[sid=%d] using stale answer", sess.sid)
+        return packed.make(wire.parse_header(sess.req_data).id,
+                           rotate=sess.qtype == dnslib.QTYPE.A,
+                           ttl=self.stale_ttl)
+
+    def __add_cache(self, sess, data):
+        try:
+            _, rrs = wire.scan_answers(data)
+            packed = wire.PackedResponse(data, time.time())
+            neg_ttl = wire.negative_ttl(data)
+        except wire.WireError as e:
+            self.logger.error("[sid=%d] parse response error, msg=%s, data=%s",
+                              sess.sid, e, data)
+            return
+        if neg_ttl is not None:
+            self.neg_misses += 1
+            if self.neg_ttl:
+                ttl = min(neg_ttl, self.neg_ttl)
+                self.cache.add((sess.qname, sess.qtype), packed, ttl,
+                               packed.size())
+                self.logger.info(
+                    "[sid=%d] add negative answer to cache, key=(%s, %s), "
+                    "ttl=%d", sess.sid, sess.qname.decode("ascii", "replace"),
+                    dnslib.QTYPE.get(sess.qtype), ttl)
+            return
+        for answer in rrs:
+            if answer.rtype == sess.qtype:
+                # expires when any rr expires
+                ttl = packed.min_ttl()
+                self.cache.add((sess.qname, sess.qtype), packed, ttl,
+                               packed.size())
+                self.logger.info(
+                    "[sid=%d] add to cache, key=(%s, %s), ttl=%d",
+                    sess.sid, sess.qname.decode("ascii", "replace"),
+                    dnslib.QTYPE.get(sess.qtype),
+                    ttl)
+                break
+
     def __handle_other(self, sess, addr):
         data = sess.server_resps.get(addr)
         if not data:
             return None
         try:
-            d = dnslib.DNSRecord.parse(data)
-            self.logger.debug("[sid=%d] %s:%s:%d response detail,\n%s",
-                              sess.sid, addr[0], addr[1], addr[2], d)
-            return d
-        except Exception as e:
+            wire.scan_answers(data)
+        except wire.WireError as e:
             self.logger.error("[sid=%d] parse response error, msg=%s, data=%s",
                               sess.sid, e, data)
             return None
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.__dump(sess.sid, "%s:%s:%d response detail" % addr, data)
+        return data
 
     def __handle_A(self, sess, addr):
         data = sess.server_resps.get(addr)
         if not data:
             return None
         try:
-            d = dnslib.DNSRecord.parse(data)
-        except Exception as e:
+            ips = wire.scan_A(data)
+        except wire.WireError as e:
             self.logger.error("[sid=%d] parse response error, err=%s, data=%s",
                               sess.sid, e, data)
             return None
-        str_ip = self.__parse_A(d)
+        ip = self.__parse_A(ips)
+        str_ip = wire.ip_to_str(ip) if ip is not None else ""
         self.logger.info("[sid=%d] %s:%s:%d answered ip=%s", sess.sid, addr[0], addr[1], addr[2], str_ip)
-        self.logger.debug("[sid=%d] %s:%s:%d response detail,\n%s", sess.sid, addr[0], addr[1], addr[2], d)
-        if self.cnet.is_in_blacklist(str_ip):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.__dump(sess.sid, "%s:%s:%d response detail" % addr, data)
+        if ip is not None and self.cnet.is_ip_in_blacklist(ip):
             self.logger.info("[sid=%d] ip %s is in blacklist", sess.sid, str_ip)
             sess.is_poisoned = True
             return None
         if addr in self.local_servers:
             if sess.local_result:
                 return None
-            sess.local_result = d
-            if str_ip:
-                if self.cnet.is_in_local(str_ip):
+            sess.local_result = data
+            if ip is not None:
+                if self.cnet.is_ip_in_local(ip):
                     sess.matrix[0][0] = 1
                     self.logger.info(
                         "[sid=%d] local server %s:%s:%d returned local addr %s",
@@ -206,16 +500,42 @@ class GreenDNSHandler(handler_base.HandlerBase):
         elif addr in self.unpoisoned_servers:
             if sess.unpoisoned_result:
                 return None
-            sess.unpoisoned_result = d
+            sess.unpoisoned_result = data
+            if sess.route == ROUTE_FOREIGN:
+                # the local servers are not asked
+                is_local = ip is not None and self.cnet.is_ip_in_local(ip)
+                self.__learn(sess, ROUTE_LOCAL if is_local else ROUTE_FOREIGN)
+                self.logger.info("[sid=%d] using unpoisoned result", sess.sid)
+                return data
+            if self.__all_down(self.local_servers):
+                # the local servers are not asked either
+                self.unpoisoned_fallbacks += 1
+                self.logger.info("[sid=%d] local servers are down, "
+                                 "using unpoisoned result", sess.sid)
+                return data
         else:
             self.logger.warning(
                 "[sid=%d] unexpected answer from unknown server", sess.sid)
             return None
-        return self.__make_response(sess.sid,
+        resp = self.__make_response(sess.sid,
                                     sess.local_result,
                                     sess.unpoisoned_result,
                                     sess.matrix,
                                     sess.is_poisoned)
+        if not resp and sess.local_result and not sess.is_poisoned and \
+                self.__all_down(self.unpoisoned_servers):
+            # no one to wait for, the foreign answer of the local server
+            # is the best one can get
+            self.local_fallbacks += 1
+            self.logger.info("[sid=%d] unpoisoned servers are down, "
+                             "using local result", sess.sid)
+            resp = sess.local_result
+        if resp:
+            if sess.matrix[0][0]:
+                self.__learn(sess, ROUTE_LOCAL)
+            elif sess.matrix[0][1] or sess.is_poisoned:
+                self.__learn(sess, ROUTE_FOREIGN)
+        return resp
 
     def __make_response(self, sid, local_result, unpoisoned_result, m, is_poisoned):
         # calculate
@@ -232,45 +552,19 @@ class GreenDNSHandler(handler_base.HandlerBase):
             self.logger.info("[sid=%d] using unpoisoned result", sid)
         return resp
 
-    def __parse_A(self, record):
-        '''parse a proper A record'''
-        str_ip = ""
-        local_ip = ""
-        for rr in record.rr:
-            if rr.rtype == dnslib.QTYPE.A:
-                str_ip = str(rr.rdata)
-                if self.cnet.is_in_local(str_ip):
-                    local_ip = str_ip
-        if local_ip:
-            return local_ip
-        return str_ip
-
-    def __replace_id(self, header, new_tid):
-        header.id = new_tid
-
-    def __shuffer_A(self, resp):
-        beg, end = -1, 0
-        rr_A, rr_other = [], []
-        for idx, rr in enumerate(resp.rr):
-            if rr.rtype == dnslib.QTYPE.A:
-                rr_A.append(rr)
-                if beg < 0:
-                    beg = idx
-                else:
-                    end = idx
-            else:
-                rr_other.append(rr)
-        if len(rr_A) > 1 and beg >= 0 and end == len(resp.rr) - 1:
-            random.shuffle(rr_A)
-            resp.rr = rr_other + rr_A
-
-    def __decrease_ttl_one(self):
-        l = []
-        for k, (v, _) in self.cache.iteritems():
-            for rr in v.rr:
-                if rr.ttl <= 1:
-                    l.append(k)
-                else:
-                    rr.ttl -= 1
-        for k in l:
-            self.cache.remove(k)
+    def __parse_A(self, ips):
+        '''pick a proper A record ip, local one first'''
+        ip = None
+        for ip in ips:
+            if self.cnet.is_ip_in_local(ip):
+                return ip
+        return ip
+
+    def __dump(self, sid, title, data):
+        '''only for debug log, dnslib is slow'''
+        try:
+            d = dnslib.DNSRecord.parse(data)
+        except Exception as e:
+            self.logger.debug("[sid=%d] %s, parse error=%s", sid, title, e)
+            return
+        self.logger.debug("[sid=%d] %s,\n%s", sid, title, d)
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
+import random
 import logging
 from greendns import handler_base
 from greendns import session
 from greendns import connection
+from greendns import scoreboard
 
 
 class QuickestSession(session.Session):
@@ -15,15 +17,30 @@ class QuickestHandler(handler_base.HandlerBase):
         self.logger = logging.getLogger()
         self.upstreams = ""
         self.servers = []
+        self.top = 1
+        self.explore = 0.0
+        self.scores = scoreboard.Scoreboard()
+        self.explored = 0
+        self.rand = random.Random()
 
     def add_arg(self, parser):
         parser.add_argument("--upstreams",
                             help="Specify upstream dns servers",
                             default="223.6.6.6:53,114.114.114.114:53")
+        parser.add_argument("--top", type=int,
+                            help="Specify number of the best scored upstreams "
+                                 "to ask, 0 is all",
+                            default=1)
+        parser.add_argument("--explore", type=float,
+                            help="Specify probability to ask one more random "
+                                 "upstream to keep the scores fresh",
+                            default=0.05)
 
     def parse_arg(self, parser, remaining_argv):
         myargs = parser.parse_args(remaining_argv)
         self.upstreams = myargs.upstreams
+        self.top = myargs.top
+        self.explore = myargs.explore
 
     def init(self, io_engine):
         for upstream in self.upstreams.split(','):
@@ -36,7 +53,26 @@ class QuickestHandler(handler_base.HandlerBase):
     def new_session(self):
         return QuickestSession()
 
+    def route(self, sess):
+        if self.top <= 0 or self.top >= len(self.servers):
+            return None
+        addrs = self.scores.best(self.servers, self.top)
+        if self.explore and self.rand.random() < self.explore:
+            self.explored += 1
+            addrs.append(self.rand.choice(
+                [addr for addr in self.servers if addr not in addrs]))
+        return addrs
+
+    def use_scores(self, scores):
+        self.scores = scores
+
     def on_upstream_response(self, sess, addr):
         for _, data in sess.server_resps.items():
             return data
         return ""
+
+    def stats(self):
+        return {"explored": self.explored}
+
+    def dump(self):
+        return self.scores.dump()
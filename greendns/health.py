@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+HEALTHY = "healthy"
+DEGRADED = "degraded"           # failing, asked after the healthy ones
+OPEN = "open"                   # down, only probed until it answers
+
+
+class UpstreamHealth(object):
+    '''
+    Health of one upstream by its queries in a row, a circuit breaker.
+    It is degraded after degrade_after failures and open after open_after
+    ones. Any answer makes it healthy again.
+    '''
+    def __init__(self, degrade_after, open_after):
+        self.degrade_after = degrade_after
+        self.open_after = open_after
+        self.state = HEALTHY
+        self.failures = 0           # in a row
+        self.probe = None           # upstream.Query of the probe in flight
+
+    def succeeded(self):
+        '''return True if the state is changed'''
+        self.failures = 0
+        return self.__set(HEALTHY)
+
+    def failed(self):
+        '''return True if the state is changed'''
+        self.failures += 1
+        if self.failures >= self.open_after:
+            return self.__set(OPEN)
+        if self.failures >= self.degrade_after:
+            return self.__set(DEGRADED)
+        return False
+
+    def __set(self, state):
+        if self.state == state:
+            return False
+        self.state = state
+        return True
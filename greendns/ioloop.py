@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 import select
+try:
+    import selectors
+except ImportError:
+    selectors = None
 from greendns import timer
 
 EV_READ = 1
@@ -7,14 +11,13 @@ EV_WRITE = 2
 
 
 class IOLoop(object):
-    MIN_INTERVAL = 0.05
-
     def __init__(self):
         self.rd_socks = {}    # sock -> callback
         self.wr_socks = {}
         self.err_callback = None
         self.running = True
         self.tm = timer.TimerManager()
+        self.callbacks = []   # run once at the end of this loop round
 
     def register(self, sock, events, callback, *args, **kwargs):
         if events & EV_READ:
@@ -47,125 +50,247 @@ class IOLoop(object):
         self.tm.check_timer()
 
     def add_timer(self, is_once, seconds, callback, *args, **kwargs):
-        self.tm.add_timer(is_once, seconds, callback, *args, **kwargs)
+        return self.tm.add_timer(is_once, seconds, callback, *args, **kwargs)
+
+    def cancel_timer(self, t):
+        self.tm.cancel_timer(t)
+
+    def time(self):
+        '''monotonic time, cached once per wakeup'''
+        return self.tm.now
+
+    def update_time(self):
+        self.tm.update_now()
+
+    def poll_timeout(self):
+        '''wait until the next timer, None is forever'''
+        if self.callbacks:
+            return 0
+        return self.tm.next_timeout()
+
+    def add_callback(self, callback, *args):
+        self.callbacks.append((callback, args))
+
+    def run_callbacks(self):
+        while self.callbacks:
+            callbacks, self.callbacks = self.callbacks, []
+            for callback, args in callbacks:
+                callback(*args)
 
 
 class Select(IOLoop):
+    '''
+    rd_socks and wr_socks are passed to select directly, so registering
+    is O(1). esocks are the socks in any of them.
+    '''
     def __init__(self):
         super(Select, self).__init__()
-        self.rlist = []
-        self.wlist = []
-        self.elist = []
-
-    def __make_list(self):
-        self.rlist = list(self.rd_socks)
-        self.wlist = list(self.wr_socks)
-        s = set(self.rlist + self.wlist)
-        self.elist = list(s)
+        self.esocks = set()
 
     def register(self, sock, events, callback, *args, **kwargs):
         super(Select, self).register(sock, events, callback, *args, **kwargs)
-        self.__make_list()
+        self.esocks.add(sock)
         return True
 
     def unregister(self, sock, events=EV_READ | EV_WRITE):
         super(Select, self).unregister(sock, events)
-        self.__make_list()
+        if sock not in self.rd_socks and sock not in self.wr_socks:
+            self.esocks.discard(sock)
         return True
 
     def on_close_sock(self, sock):
         self.unregister(sock)
 
     def run(self):
-        if not self.rlist and not self.wlist:
+        if not self.esocks:
             return
         while self.running:
             self.check_timer()
-            (rl, wl, el) = select.select(self.rlist, self.wlist,
-                                         self.elist, self.MIN_INTERVAL)
+            if not self.running:
+                break
+            (rl, wl, el) = select.select(self.rd_socks, self.wr_socks,
+                                         self.esocks, self.poll_timeout())
+            self.update_time()
             for sock in rl:
-                callback, args, kwargs = self.rd_socks.get(sock)
+                # may be unregistered by a former callback
+                result = self.rd_socks.get(sock)
+                if not result:
+                    continue
+                callback, args, kwargs = result
                 if callback:
                     callback(sock, *args, **kwargs)
             for sock in wl:
-                callback, args, kwargs = self.wr_socks.get(sock)
+                result = self.wr_socks.get(sock)
+                if not result:
+                    continue
+                callback, args, kwargs = result
                 if callback:
                     callback(sock, *args, **kwargs)
             if self.err_callback:
                 for sock in el:
                     self.err_callback[0](sock, *self.err_callback[1],
                                          **self.err_callback[2])
+            self.run_callbacks()
 
 
-class Epoll(IOLoop):
+class Poll(IOLoop):
+    '''select.poll, Epoll only differs in the poller'''
     def __init__(self):
-        super(Epoll, self).__init__()
-        self.epoll = select.epoll()
+        super(Poll, self).__init__()
+        self.ev_in, self.ev_out, self.ev_err = 0, 0, 0
+        self.poller = self.new_poller()
         self.fd2socks = {}
 
+    def new_poller(self):
+        self.ev_in = select.POLLIN
+        self.ev_out = select.POLLOUT
+        self.ev_err = select.POLLERR | select.POLLHUP
+        return select.poll()
+
+    def poll(self, timeout):
+        return self.poller.poll(None if timeout is None else timeout * 1000)
+
+    def __events(self, sock, events=0):
+        # keep the events registered before
+        ev = self.ev_err
+        if events & EV_READ or sock in self.rd_socks:
+            ev |= self.ev_in
+        if events & EV_WRITE or sock in self.wr_socks:
+            ev |= self.ev_out
+        return ev
+
     def register(self, sock, events, callback, *args, **kwargs):
-        ev = select.EPOLLERR | select.EPOLLHUP
-        need_modify = False
+        ev = self.__events(sock, events)
         if sock.fileno() in self.fd2socks:
-            need_modify = True
-        if events & EV_READ:
-            ev |= select.EPOLLIN
-        if events & EV_WRITE:
-            ev |= select.EPOLLOUT
-        if need_modify:
-            self.epoll.modify(sock.fileno(), ev)
+            self.poller.modify(sock.fileno(), ev)
         else:
             try:
-                self.epoll.register(sock.fileno(), ev)
+                self.poller.register(sock.fileno(), ev)
             except (IOError, OSError):
                 return False
             else:
                 self.fd2socks[sock.fileno()] = sock
-        return super(Epoll, self).register(sock, events, callback, *args, **kwargs)
+        return super(Poll, self).register(sock, events, callback, *args, **kwargs)
 
     def unregister(self, sock, events=EV_READ | EV_WRITE):
-        if not super(Epoll, self).unregister(sock, events):
+        if not super(Poll, self).unregister(sock, events):
             return False
-        ev = select.EPOLLERR | select.EPOLLHUP | \
-            select.EPOLLIN | select.EPOLLOUT
-        if events & EV_READ:
-            ev ^= select.EPOLLIN
-        if events & EV_WRITE:
-            ev ^= select.EPOLLOUT
-        self.epoll.modify(sock.fileno(), ev)
+        if sock.fileno() not in self.fd2socks:
+            return True
+        self.poller.modify(sock.fileno(), self.__events(sock))
         return True
 
     def on_close_sock(self, sock):
-        super(Epoll, self).unregister(sock)
-        self.epoll.unregister(sock)
-        self.fd2socks.pop(sock.fileno())
+        super(Poll, self).unregister(sock)
+        if self.fd2socks.pop(sock.fileno(), None):
+            self.poller.unregister(sock)
 
     def run(self):
         while self.running:
             self.check_timer()
-            events = self.epoll.poll(self.MIN_INTERVAL)
+            if not self.running:
+                break
+            events = self.poll(self.poll_timeout())
+            self.update_time()
             for fd, event in events:
                 sock = self.fd2socks.get(fd)
                 if not sock:
                     continue
-                if event & select.EPOLLERR or event & select.EPOLLHUP:
+                if event & self.ev_err:
                     if self.err_callback:
                         self.err_callback[0](sock, *self.err_callback[1],
                                              **self.err_callback[2])
-                if event & select.EPOLLIN:
+                if event & self.ev_in:
                     result = self.rd_socks.get(sock)
                     if not result:
                         continue
                     callback, args, kwargs = result
                     if callback:
                         callback(sock, *args, **kwargs)
-                if event & select.EPOLLOUT:
+                if event & self.ev_out:
                     result = self.wr_socks.get(sock)
                     if not result:
                         continue
                     callback, args, kwargs = result
                     if callback:
                         callback(sock, *args, **kwargs)
+            self.run_callbacks()
+
+
+class Epoll(Poll):
+    def new_poller(self):
+        self.ev_in = select.EPOLLIN
+        self.ev_out = select.EPOLLOUT
+        self.ev_err = select.EPOLLERR | select.EPOLLHUP
+        return select.epoll()
+
+    def poll(self, timeout):
+        return self.poller.poll(-1 if timeout is None else timeout)
+
+
+class Selectors(IOLoop):
+    '''selectors.DefaultSelector, the best one of the platform'''
+    def __init__(self):
+        super(Selectors, self).__init__()
+        self.selector = selectors.DefaultSelector()
+
+    def __events(self, sock, events=0):
+        ev = 0
+        if events & EV_READ or sock in self.rd_socks:
+            ev |= selectors.EVENT_READ
+        if events & EV_WRITE or sock in self.wr_socks:
+            ev |= selectors.EVENT_WRITE
+        return ev
+
+    def register(self, sock, events, callback, *args, **kwargs):
+        ev = self.__events(sock, events)
+        if sock in self.rd_socks or sock in self.wr_socks:
+            self.selector.modify(sock, ev)
+        else:
+            try:
+                self.selector.register(sock, ev)
+            except (IOError, OSError, ValueError, KeyError):
+                return False
+        return super(Selectors, self).register(sock, events, callback,
+                                               *args, **kwargs)
+
+    def unregister(self, sock, events=EV_READ | EV_WRITE):
+        super(Selectors, self).unregister(sock, events)
+        ev = self.__events(sock)
+        try:
+            if ev:
+                self.selector.modify(sock, ev)
+            else:
+                self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        return True
+
+    def on_close_sock(self, sock):
+        self.unregister(sock)
+
+    def run(self):
+        while self.running:
+            self.check_timer()
+            if not self.running:
+                break
+            events = self.selector.select(self.poll_timeout())
+            self.update_time()
+            for key, event in events:
+                sock = key.fileobj
+                if event & selectors.EVENT_READ:
+                    result = self.rd_socks.get(sock)
+                    if result:
+                        callback, args, kwargs = result
+                        if callback:
+                            callback(sock, *args, **kwargs)
+                if event & selectors.EVENT_WRITE:
+                    result = self.wr_socks.get(sock)
+                    if result:
+                        callback, args, kwargs = result
+                        if callback:
+                            callback(sock, *args, **kwargs)
+            self.run_callbacks()
 
 
 def get_ioloop(name="select"):
@@ -173,4 +298,8 @@ def get_ioloop(name="select"):
         return Epoll()
     if name == "select":
         return Select()
+    if name == "poll" and hasattr(select, "poll"):
+        return Poll()
+    if name == "selectors" and selectors:
+        return Selectors()
     return None
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import struct
 import socket
+import bisect
 
 
 class LocalNet(object):
@@ -22,6 +23,14 @@ class LocalNet(object):
             self.local_subs.append(self.convert("10.0.0.0/8"))
             self.local_subs.append(self.convert("172.16.0.0/12"))
         self.local_subs.sort()
+        # merged ranges, so that one bisect is enough
+        self.lows, self.highs = [], []
+        for (l, h) in self.local_subs:
+            if self.highs and l <= self.highs[-1] + 1:
+                self.highs[-1] = max(self.highs[-1], h)
+            else:
+                self.lows.append(l)
+                self.highs.append(h)
 
     def convert(self, net):
         parts = net.split('/')
@@ -46,25 +55,19 @@ class LocalNet(object):
             ip = struct.unpack('>I', socket.inet_aton(str_ip))[0]
         except socket.error:
             return False
-        if ip in self.blackips:
-            return True
-        else:
-            return False
+        return self.is_ip_in_blacklist(ip)
+
+    def is_ip_in_blacklist(self, ip):
+        return ip in self.blackips
 
     def is_in_local(self, str_ip):
-        '''binary search'''
         try:
             ip = struct.unpack('>I', socket.inet_aton(str_ip))[0]
         except socket.error:
             return False
-        i = 0
-        j = len(self.local_subs) - 1
-        while (i <= j):
-            k = (i + j) // 2
-            if ip > self.local_subs[k][1]:
-                i = k + 1
-            elif ip < self.local_subs[k][0]:
-                j = k - 1
-            else:
-                return True
-        return False
+        return self.is_ip_in_local(ip)
+
+    def is_ip_in_local(self, ip):
+        '''binary search'''
+        k = bisect.bisect_right(self.lows, ip) - 1
+        return k >= 0 and ip <= self.highs[k]
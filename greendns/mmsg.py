@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+'''
+recvmmsg and sendmmsg of linux by ctypes, for ipv4 udp sockets.
+available is False if they can not be used.
+'''
+import errno
+import socket
+import struct
+import ctypes
+import ctypes.util
+
+MSG_DONTWAIT = 0x40
+SOCKADDR_IN_LEN = 16
+
+_sockaddr_in = struct.Struct("=H2s4s8x")
+_port = struct.Struct(">H")
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None, None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr),
+                         ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr),
+                         ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+
+_recvmmsg, _sendmmsg = _load()
+available = _recvmmsg is not None
+
+
+class MsgBatch(object):
+    '''buffers of size datagrams, allocated once and reused by every call'''
+    def __init__(self, size, bufsize):
+        self.size = size
+        self.bufsize = bufsize
+        self.msgs = (mmsghdr * size)()
+        self.iovs = (iovec * size)()
+        self.names = ctypes.create_string_buffer(SOCKADDR_IN_LEN * size)
+        self.bufs = ctypes.create_string_buffer(bufsize * size)
+        self.used = 0
+        names = ctypes.addressof(self.names)
+        bufs = ctypes.addressof(self.bufs)
+        for i in range(size):
+            self.iovs[i].iov_base = bufs + i * bufsize
+            self.iovs[i].iov_len = bufsize
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = names + i * SOCKADDR_IN_LEN
+            hdr.msg_namelen = SOCKADDR_IN_LEN
+            hdr.msg_iov = ctypes.pointer(self.iovs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self, fd):
+        '''return [(data, (ip, port))], raise socket.error if failed'''
+        msgs = self.msgs
+        # only the namelen of the used ones were changed by the kernel
+        for i in range(self.used):
+            msgs[i].msg_hdr.msg_namelen = SOCKADDR_IN_LEN
+        n = _recvmmsg(fd, msgs, self.size, MSG_DONTWAIT, None)
+        if n < 0:
+            self.used = 0
+            err = ctypes.get_errno()
+            raise socket.error(err, errno.errorcode.get(err, str(err)))
+        self.used = n
+        names = ctypes.string_at(self.names, n * SOCKADDR_IN_LEN)
+        bufs = ctypes.addressof(self.bufs)
+        string_at = ctypes.string_at
+        result = []
+        for i in range(n):
+            _, port, ip = _sockaddr_in.unpack_from(names, i * SOCKADDR_IN_LEN)
+            result.append((string_at(bufs + i * self.bufsize, msgs[i].msg_len),
+                           (socket.inet_ntoa(ip), _port.unpack(port)[0])))
+        return result
+
+    def send(self, fd, items):
+        '''
+        send [(addr, data)] from the head, at most size of them.
+        return the number sent, raise socket.error if failed.
+        '''
+        n = min(len(items), self.size)
+        msgs, iovs = self.msgs, self.iovs
+        names = ctypes.addressof(self.names)
+        keep = []
+        for i in range(n):
+            addr, data = items[i]
+            ctypes.memmove(names + i * SOCKADDR_IN_LEN, _sockaddr_in.pack(
+                socket.AF_INET, _port.pack(addr[1]), socket.inet_aton(addr[0])),
+                SOCKADDR_IN_LEN)
+            buf = ctypes.c_char_p(data)
+            keep.append(buf)
+            iovs[i].iov_base = ctypes.cast(buf, ctypes.c_void_p).value
+            iovs[i].iov_len = len(data)
+            msgs[i].msg_hdr.msg_namelen = SOCKADDR_IN_LEN
+        sent = _sendmmsg(fd, msgs, n, MSG_DONTWAIT)
+        # back to the receive buffers
+        bufs = ctypes.addressof(self.bufs)
+        for i in range(n):
+            iovs[i].iov_base = bufs + i * self.bufsize
+            iovs[i].iov_len = self.bufsize
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise socket.error(err, errno.errorcode.get(err, str(err)))
+        return sent
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from collections import deque
+
+
+class UpstreamScore(object):
+    '''smoothed rtt and loss rate of one upstream, like the tcp rto'''
+    ALPHA = 0.125
+    BETA = 0.25
+    SAMPLES = 64                # recent rtts kept for the percentiles
+
+    def __init__(self):
+        self.rtts = deque(maxlen=self.SAMPLES)
+        self.srtt = 0.0
+        self.rttvar = 0.0
+        self.loss = 0.0             # ewma of 1 for a timeout, 0 for an answer
+        self.answers = 0
+        self.timeouts = 0
+        self.timeout = 0.0          # seconds a lost query cost
+
+    def answered(self, rtt):
+        if not self.answers:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.ALPHA * (rtt - self.srtt)
+        self.loss -= self.ALPHA * self.loss
+        self.answers += 1
+        self.rtts.append(rtt)
+
+    def timed_out(self, elapsed):
+        self.loss += self.ALPHA * (1 - self.loss)
+        self.timeout = max(self.timeout, elapsed)
+        self.timeouts += 1
+
+    def score(self):
+        '''expected seconds to get the answer, 0 if never asked'''
+        return self.srtt * (1 - self.loss) + self.timeout * self.loss
+
+    def percentile(self, p):
+        '''the p-th percentile of the recent rtts, None if there is none'''
+        if not self.rtts:
+            return None
+        rtts = sorted(self.rtts)
+        return rtts[min(len(rtts) - 1, int(len(rtts) * p / 100.0))]
+
+
+class Scoreboard(object):
+    '''
+    Scores of the upstreams by the answers and timeouts of their queries.
+    The lower the better, an upstream never asked is the best.
+    '''
+    def __init__(self):
+        self.scores = OrderedDict()     # addr -> UpstreamScore
+
+    def __getitem__(self, addr):
+        return self.scores[addr]
+
+    def __get(self, addr):
+        s = self.scores.get(addr)
+        if s is None:
+            s = self.scores[addr] = UpstreamScore()
+        return s
+
+    def answered(self, addr, rtt):
+        self.__get(addr).answered(rtt)
+
+    def timed_out(self, addr, elapsed):
+        self.__get(addr).timed_out(elapsed)
+
+    def score(self, addr):
+        s = self.scores.get(addr)
+        return s.score() if s else 0.0
+
+    def percentile(self, addr, p, min_samples=1):
+        '''None if there are less than min_samples rtts of addr'''
+        s = self.scores.get(addr)
+        if s is None or len(s.rtts) < min_samples:
+            return None
+        return s.percentile(p)
+
+    def best(self, addrs, k):
+        '''k of addrs of the lowest scores, in the order given if the same'''
+        return sorted(addrs, key=self.score)[:k]
+
+    def dump(self):
+        return ["upstream %s:%s:%d srtt=%.1fms rttvar=%.1fms loss=%.3f "
+                "answers=%d timeouts=%d score=%.1fms" %
+                (addr[0], addr[1], addr[2], s.srtt * 1000, s.rttvar * 1000,
+                 s.loss, s.answers, s.timeouts, s.score() * 1000)
+                for addr, s in self.scores.items()]
@@ -2,11 +2,13 @@
 from __future__ import print_function
 import sys
 import os
+import signal
 import logging
 import inspect
 import argparse
 from greendns import forwarder
 from greendns import ioloop
+from greendns import supervisor
 from greendns import __version__
 
 
@@ -27,6 +29,13 @@ def check_loglevel(value):
     return value
 
 
+def check_cpus(value):
+    try:
+        return [int(c) for c in value.split(',') if c]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is an invalid cpu list" % value)
+
+
 def load_mod(mod, submod):
     n = ".".join([mod, submod]) if mod else submod
     try:
@@ -69,6 +78,7 @@ class GreenDNS(object):
     def __init__(self):
         self.args = None
         self.logger = None
+        self.report = None      # send stats to the master of the workers
 
     def parse_config(self, argv):
         parser = argparse.ArgumentParser(
@@ -94,8 +104,63 @@ class GreenDNS(object):
                             help="Specify log level, debug|info|warning|error",
                             default="info")
         parser.add_argument("-m", "--mode", dest="mode",
-                            help="Specify io loop mode, select|epoll",
+                            help="Specify io loop mode, select|epoll|poll|selectors",
                             default="select")
+        parser.add_argument("--tcp-conns", dest="tcp_conns", type=int,
+                            help="Specify max connections per tcp upstream",
+                            default=2)
+        parser.add_argument("--tcp-inflight", dest="tcp_inflight", type=int,
+                            help="Specify max in-flight queries per tcp connection",
+                            default=64)
+        parser.add_argument("--tcp-idle", dest="tcp_idle", type=float,
+                            help="Specify idle timeout of tcp upstream connections",
+                            default=10)
+        parser.add_argument("--prefetch-max", dest="prefetch_max", type=int,
+                            help="Specify max concurrent prefetches of "
+                                 "hot cache entries",
+                            default=8)
+        parser.add_argument("--stale-timeout", dest="stale_timeout",
+                            type=float,
+                            help="Specify seconds to wait for upstreams "
+                                 "before a stale answer, 0 is until all of "
+                                 "them fail",
+                            default=0)
+        parser.add_argument("--hedge", dest="hedge", type=float,
+                            help="Specify percentile of the rtt of the best "
+                                 "upstream to wait before asking the others, "
+                                 "0 is asking all at once",
+                            default=0)
+        parser.add_argument("--open-failures", dest="open_failures",
+                            type=int,
+                            help="Specify timeouts in a row of an upstream "
+                                 "to stop asking it until a probe is "
+                                 "answered, 0 is never",
+                            default=5)
+        parser.add_argument("--probe-interval", dest="probe_interval",
+                            type=float,
+                            help="Specify seconds between probes of the "
+                                 "upstreams down",
+                            default=5)
+        parser.add_argument("--probe-name", dest="probe_name",
+                            help="Specify domain of the A query to probe "
+                                 "the upstreams down",
+                            default="example.com")
+        parser.add_argument("--batch-size", dest="batch_size", type=int,
+                            help="Specify max requests read at once and "
+                                 "responses sent at once",
+                            default=32)
+        parser.add_argument("--mmsg", dest="mmsg", action="store_true",
+                            help="Specify if recvmmsg and sendmmsg are used")
+        parser.add_argument("-w", "--workers", dest="workers", type=int,
+                            help="Specify worker processes sharing the listen port",
+                            default=1)
+        parser.add_argument("--cpus", dest="cpus", type=check_cpus,
+                            help="Specify cpus to pin the workers, like 0,1,2,3",
+                            default="")
+        parser.add_argument("--stats-interval", dest="stats_interval",
+                            type=float,
+                            help="Specify seconds to log stats, 0 is never",
+                            default=0)
         _, remaining_argv = parser.parse_known_args(
                             remaining_argv, namespace=args)
         args.handler.add_arg(parser)
@@ -122,7 +187,7 @@ class GreenDNS(object):
         logger.setLevel(str2level[loglevel])
         self.logger = logger
 
-    def init_forwarder(self):
+    def init_forwarder(self, reuse_port=False):
         self.logger.info("GreenDNS %s", __version__)
         io_engine = ioloop.get_ioloop(self.args.mode)
         h = self.args.handler
@@ -134,16 +199,76 @@ class GreenDNS(object):
                                              upstreams,
                                              self.args.listen,
                                              self.args.timeout,
-                                             h)
+                                             h,
+                                             tcp_conns=self.args.tcp_conns,
+                                             tcp_inflight=self.args.tcp_inflight,
+                                             tcp_idle=self.args.tcp_idle,
+                                             reuse_port=reuse_port,
+                                             batch_size=self.args.batch_size,
+                                             use_mmsg=self.args.mmsg,
+                                             max_prefetches=self.args.prefetch_max,
+                                             stale_timeout=self.args.stale_timeout,
+                                             hedge=self.args.hedge,
+                                             open_failures=self.args.open_failures,
+                                             probe_interval=self.args.probe_interval,
+                                             probe_name=self.args.probe_name)
+        if self.args.stats_interval:
+            io_engine.add_timer(False, self.args.stats_interval,
+                                self.report_stats)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self.dump_state)
+
+    def dump_state(self, *args):
+        '''log the upstream health and what is learned, by SIGUSR1'''
+        lines = self.forwarder.dump()
+        self.logger.info("dump %d lines", len(lines))
+        for line in lines:
+            self.logger.info("%s", line)
+
+    def report_stats(self):
+        s = self.forwarder.stats()
+        if self.report:
+            self.report(s)
+            return
+        self.logger.info("stats: %s", " ".join(
+            "%s=%s" % kv for kv in sorted(s.items())))
 
     def run_forwarder(self):
         self.forwarder.run_forever()
 
+    def run_worker(self, wid, report):
+        self.report = report
+        self.init_forwarder(reuse_port=True)
+        self.forwarder.io_engine.add_timer(False, 1, self.check_master,
+                                           os.getppid())
+        self.run_forwarder()
+
+    def check_master(self, ppid):
+        if os.getppid() != ppid:
+            self.logger.error("master is gone, exit")
+            self.forwarder.io_engine.stop()
+
+    def run_workers(self):
+        '''
+        Fork the workers, each one has its own io loop and forwarder
+        on the same listen port by SO_REUSEPORT.
+        '''
+        self.args.handler.load()
+        sup = supervisor.Supervisor(self.args.workers, self.run_worker,
+                                    self.args.cpus, self.args.stats_interval)
+        return sup.run()
+
 
 def run(argv):
     dns = GreenDNS()
     dns.parse_config(argv)
     dns.setup_logger()
+    if dns.args.workers > 1:
+        if not supervisor.available:
+            print("workers are not supported on this platform",
+                  file=sys.stderr)
+            sys.exit(1)
+        sys.exit(dns.run_workers())
     dns.init_forwarder()
     dns.run_forwarder()
 
@@ -9,5 +9,17 @@ class Session(object):
         self.req_data = None             # client request
         self.send_ts = 0                 # ts to send to upstream
         self.server_resps = {}           # upstream Addr -> data
+        self.qname = None                # answers must be of this name
+        self.upstreams = []              # upstream Addr queried
+        self.queries = 0                 # upstream queries not finished
+        self.key = None                  # key in the in-flight table
+        self.waiters = []                # [(client_addr, req_data, qend)]
+        self.refresh = False             # the cached answer needs prefetch
+        self.prefetch = False            # refresh the cache, no client
+        self.timer = None                # client deadline for stale answer
+        self.hedges = []                 # upstream Addr asked if no answer
+        self.hedge_timer = None          # deadline to ask the hedges
+        self.hedged = []                 # hedges asked
+        self.hedge_groups = []           # [[upstream Addr]] interchangeable
         self.sid = self.__class__.ID     # session id
         self.__class__.ID += 1
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import json
+import errno
+import select
+import signal
+import logging
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# the workers are forked, not on windows
+available = fcntl is not None and hasattr(os, "fork")
+
+STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+class Worker(object):
+    '''one forked worker process'''
+    def __init__(self, wid):
+        self.wid = wid
+        self.pid = 0
+        self.rfd = -1               # read end of the stats pipe
+        self.rbuf = b""
+        self.start_ts = 0
+        self.restart_ts = 0         # when to restart, 0 if running
+        self.failures = 0           # continuous quick deaths
+        self.stats = {}
+
+
+class Supervisor(object):
+    '''
+    Fork workers, restart the crashed ones and aggregate their stats.
+    run_worker(wid, report) is called in the child, report(stats) sends
+    a dict of counters to the master. A worker dying within MIN_UPTIME
+    seconds MAX_FAILURES times in a row is a fatal error.
+    '''
+    MIN_UPTIME = 1
+    MAX_FAILURES = 5
+    RESTART_DELAY = 1
+
+    def __init__(self, workers, run_worker, cpus=None, stats_interval=0):
+        self.logger = logging.getLogger()
+        self.run_worker = run_worker
+        self.cpus = cpus or []
+        self.stats_interval = stats_interval
+        self.workers = [Worker(i) for i in range(workers)]
+        self.running = True
+        self.failed = False
+        self.last_stats_ts = time.time()
+
+    def stop(self, *args):
+        self.running = False
+
+    def stats(self):
+        '''sum of the latest stats of all workers'''
+        total = {}
+        for w in self.workers:
+            for k, v in w.stats.items():
+                total[k] = total.get(k, 0) + v
+        return total
+
+    def run(self):
+        '''return the exit code'''
+        old_handlers = {}
+        for sig in STOP_SIGNALS:
+            old_handlers[sig] = signal.signal(sig, self.stop)
+        if hasattr(signal, "SIGUSR1"):
+            # for the workers only
+            old_handlers[signal.SIGUSR1] = signal.signal(signal.SIGUSR1,
+                                                         signal.SIG_IGN)
+        try:
+            for w in self.workers:
+                self.__spawn(w)
+            while self.running and self.__alive():
+                self.__wait()
+        finally:
+            for sig, handler in old_handlers.items():
+                signal.signal(sig, handler)
+            self.__shutdown()
+        return 1 if self.failed else 0
+
+    def __alive(self):
+        return any(w.pid or w.restart_ts for w in self.workers)
+
+    def __spawn(self, w):
+        rfd, wfd = os.pipe()
+        # the child must not run the handlers of the master
+        self.__block_signals(True)
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            self.__run_child(w, wfd)
+        self.__block_signals(False)
+        os.close(wfd)
+        fl = fcntl.fcntl(rfd, fcntl.F_GETFL)
+        fcntl.fcntl(rfd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        w.pid, w.rfd, w.rbuf = pid, rfd, b""
+        w.start_ts, w.restart_ts = time.time(), 0
+        self.logger.info("worker %d started, pid=%d", w.wid, pid)
+
+    def __run_child(self, w, wfd):
+        code = 0
+        try:
+            for sig in STOP_SIGNALS:
+                signal.signal(sig, signal.SIG_DFL)
+            self.__block_signals(False)
+            for o in self.workers:
+                if o.rfd >= 0:
+                    os.close(o.rfd)
+            fl = fcntl.fcntl(wfd, fcntl.F_GETFL)
+            fcntl.fcntl(wfd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+            if self.cpus:
+                self.__pin(w.wid)
+
+            def report(stats):
+                try:
+                    os.write(wfd, json.dumps(stats).encode() + b"\n")
+                except OSError as e:
+                    # the master is slow, drop this one
+                    if e.errno != errno.EAGAIN:
+                        raise
+            self.run_worker(w.wid, report)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            self.logger.exception("worker %d crashed", w.wid)
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    @staticmethod
+    def __block_signals(block):
+        if hasattr(signal, "pthread_sigmask"):
+            signal.pthread_sigmask(
+                signal.SIG_BLOCK if block else signal.SIG_UNBLOCK,
+                STOP_SIGNALS)
+
+    def __pin(self, wid):
+        cpu = self.cpus[wid % len(self.cpus)]
+        if not hasattr(os, "sched_setaffinity"):
+            self.logger.warning("cpu affinity is not supported")
+            return
+        try:
+            os.sched_setaffinity(0, [cpu])
+        except OSError as e:
+            self.logger.warning("worker %d pin to cpu %d failed, error=%s",
+                                wid, cpu, e)
+
+    def __wait(self):
+        fds = [w.rfd for w in self.workers if w.rfd >= 0]
+        try:
+            rl, _, _ = select.select(fds, [], [], 0.5)
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            rl = []
+        for w in self.workers:
+            if w.rfd in rl:
+                self.__read_stats(w)
+        self.__reap()
+        now = time.time()
+        for w in self.workers:
+            if w.restart_ts and now >= w.restart_ts and self.running:
+                self.__spawn(w)
+        if self.stats_interval and \
+                now - self.last_stats_ts >= self.stats_interval:
+            self.last_stats_ts = now
+            self.logger.info("stats: %s", " ".join(
+                "%s=%s" % kv for kv in sorted(self.stats().items())))
+
+    def __read_stats(self, w):
+        '''return False if there is nothing more to read now'''
+        try:
+            data = os.read(w.rfd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return False
+            data = b""
+        if not data:
+            self.__close_pipe(w)
+            return False
+        lines = (w.rbuf + data).split(b"\n")
+        w.rbuf = lines.pop()
+        for line in lines:
+            try:
+                w.stats = json.loads(line.decode())
+            except ValueError:
+                self.logger.error("worker %d invalid stats %r", w.wid, line)
+        return True
+
+    def __close_pipe(self, w):
+        if w.rfd >= 0:
+            os.close(w.rfd)
+            w.rfd = -1
+
+    def __reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            if pid == 0:
+                return
+            for w in self.workers:
+                if w.pid == pid:
+                    self.__on_exit(w, status)
+                    break
+
+    def __on_exit(self, w, status):
+        # the last stats of a dead worker are kept in the total
+        while self.__read_stats(w):
+            pass
+        self.__close_pipe(w)
+        w.pid = 0
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            self.logger.info("worker %d exited", w.wid)
+            return
+        if os.WIFSIGNALED(status):
+            reason = "killed by signal %d" % os.WTERMSIG(status)
+        else:
+            reason = "exited with %d" % os.WEXITSTATUS(status)
+        if not self.running:
+            return
+        now = time.time()
+        if now - w.start_ts < self.MIN_UPTIME:
+            w.failures += 1
+        else:
+            w.failures = 0
+        if w.failures >= self.MAX_FAILURES:
+            self.logger.error("worker %d %s, failed too quickly, give up",
+                              w.wid, reason)
+            self.failed = True
+            self.running = False
+            return
+        delay = self.RESTART_DELAY if w.failures else 0
+        self.logger.error("worker %d %s, restart in %ds",
+                          w.wid, reason, delay)
+        w.restart_ts = now + delay
+
+    def __shutdown(self):
+        for w in self.workers:
+            w.restart_ts = 0
+            if w.pid:
+                try:
+                    os.kill(w.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        for w in self.workers:
+            while w.pid:
+                try:
+                    os.waitpid(w.pid, 0)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                w.pid = 0
+            self.__close_pipe(w)
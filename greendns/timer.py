@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import time
-from six.moves import queue
+import heapq
+
+monotonic = getattr(time, "monotonic", time.time)
 
 
 class Timer(object):
@@ -11,6 +13,7 @@ class Timer(object):
         self.args = args
         self.kwargs = kwargs
         self.next_run_ts = now_ts + interval
+        self.cancelled = False
 
     def __lt__(self, other):
         return self.next_run_ts < other.next_run_ts
@@ -21,23 +24,84 @@ class Timer(object):
 
 
 class TimerManager(object):
+    '''
+    heapq of Timer. Cancelled timers are dropped when they reach the top,
+    or all at once when they are more than half of the heap, but not
+    while check_timer is running the callbacks.
+    now is the monotonic time cached once per wakeup of the io loop.
+    '''
     def __init__(self):
-        self.timers = queue.PriorityQueue()
+        self.timers = []
+        self.cancelled = 0
+        self.checking = False
+        self.now = monotonic()
 
     def add_timer(self, is_once, interval, callback, *args, **kwargs):
-        t = Timer(time.time(), is_once, interval, callback, *args, **kwargs)
-        self.timers.put(t)
+        t = Timer(monotonic(), is_once, interval, callback, *args, **kwargs)
+        heapq.heappush(self.timers, t)
+        return t
+
+    def cancel_timer(self, t):
+        if t.cancelled:
+            return
+        t.cancelled = True
+        self.cancelled += 1
+        if not self.checking:
+            self.__compact()
+
+    def __compact(self):
+        if self.cancelled > 64 and self.cancelled * 2 > len(self.timers):
+            # in place, the list may be referred by the caller
+            self.timers[:] = [t for t in self.timers if not t.cancelled]
+            heapq.heapify(self.timers)
+            self.cancelled = 0
+
+    def __pop(self):
+        t = heapq.heappop(self.timers)
+        if t.cancelled:
+            self.cancelled -= 1
+        return t
+
+    def update_now(self):
+        self.now = monotonic()
+        return self.now
 
     def check_timer(self):
-        now_ts = time.time()
+        now_ts = self.update_now()
         readd = []
-        while not self.timers.empty():
-            t = self.timers.queue[0]
-            if now_ts < t.next_run_ts:
+        timers = self.timers
+        self.checking = True
+        try:
+            self.__run_expired(timers, now_ts, readd)
+        finally:
+            self.checking = False
+        for t in readd:
+            heapq.heappush(timers, t)
+        self.__compact()
+
+    def __run_expired(self, timers, now_ts, readd):
+        while timers:
+            t = timers[0]
+            if not t.cancelled and now_ts < t.next_run_ts:
                 break
-            self.timers.get()
+            self.__pop()
+            if t.cancelled:
+                continue
             t.run()
-            if not t.is_once:
+            if t.cancelled:
+                # cancelled by its own callback, it is out of the heap
+                self.cancelled -= 1
+            elif t.is_once:
+                # so that a later cancel_timer does nothing
+                t.cancelled = True
+            else:
                 readd.append(t)
-        for t in readd:
-            self.timers.put(t)
+
+    def next_timeout(self):
+        '''seconds to the next timer, None if there is no timer'''
+        timers = self.timers
+        while timers and timers[0].cancelled:
+            self.__pop()
+        if not timers:
+            return None
+        return max(timers[0].next_run_ts - monotonic(), 0)
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+import random
+import struct
+import logging
+from collections import deque
+from greendns import connection
+from greendns import wire
+
+_id = struct.Struct(">H")
+_len_id = struct.Struct(">HH")
+_rand = random.SystemRandom()
+
+
+class Query(object):
+    '''one in-flight query to one upstream'''
+    __slots__ = ("upstream", "sess", "conn", "txid", "orig_txid", "qname",
+                 "send_ts", "data", "retried", "timer")
+
+    def __init__(self, upstream, sess, conn, txid, orig_txid, qname,
+                 data=None):
+        self.upstream = upstream
+        self.sess = sess
+        self.conn = conn
+        self.txid = txid
+        self.orig_txid = orig_txid
+        self.qname = qname
+        self.send_ts = upstream.io_engine.time()
+        self.data = data            # kept only if it may be sent again
+        self.retried = False
+        self.timer = None           # deadline on the io loop
+
+    @property
+    def addr(self):
+        return self.upstream.addr
+
+    @property
+    def bind_addr(self):
+        return self.conn.bind_addr if self.conn else None
+
+    @property
+    def remote_addr(self):
+        return self.upstream.remote_addr
+
+    def close(self):
+        self.upstream.cancel(self)
+
+
+class UDPUpstream(object):
+    '''
+    Udp sockets to one upstream. Every query gets a random unused txid on
+    a random socket of the pool, and the reply is matched back by
+    (upstream, txid, qname). A socket is replaced by one of a new random
+    port after rotate_after queries, so that the ports can not be learned
+    by whoever makes us query. It is closed once its queries finish.
+    '''
+    BIND_RETRIES = 8
+
+    def __init__(self, io_engine, addr, on_response, pool_size=4,
+                 rotate_after=100):
+        self.logger = logging.getLogger()
+        self.io_engine = io_engine
+        self.addr = addr
+        self.remote_addr = (addr.ip, addr.port)
+        self.on_response = on_response
+        self.rotate_after = rotate_after
+        self.conns = []             # the ones to send new queries
+        self.pending = {}           # conn -> {txid: Query}, retired included
+        self.sent = {}              # conn -> queries sent
+        self.rotated = 0
+        for _ in range(pool_size):
+            self.conns.append(self.__new_conn())
+
+    def __new_conn(self):
+        '''bind to a random source port'''
+        conn = None
+        for _ in range(self.BIND_RETRIES):
+            conn = connection.UDPConnection(io_engine=self.io_engine)
+            try:
+                conn.bind(("0.0.0.0", _rand.randint(1025, 65535)))
+                break
+            except connection.BindException:
+                conn = None
+        if conn is None:
+            conn = connection.UDPConnection(io_engine=self.io_engine)
+            conn.bind(("0.0.0.0", 0))
+        conn.arecv(self.__handle_response)
+        self.pending[conn] = {}
+        self.sent[conn] = 0
+        return conn
+
+    def __rotate(self, conn):
+        '''replace conn by a new one, close it if nothing is pending'''
+        i = self.conns.index(conn)
+        self.conns[i] = self.__new_conn()
+        self.rotated += 1
+        self.__close_retired(conn)
+
+    def __close_retired(self, conn):
+        if conn not in self.conns and not self.pending.get(conn, True):
+            del self.pending[conn]
+            del self.sent[conn]
+            conn.close()
+
+    def query(self, sess, data, qname=None):
+        '''return the Query, or None if failed to send'''
+        if len(data) < 2:
+            return None
+        conn = _rand.choice(self.conns)
+        pending = self.pending[conn]
+        txid = _rand.getrandbits(16)
+        while txid in pending:
+            txid = _rand.getrandbits(16)
+        q = Query(self, sess, conn, txid, data[:2], qname)
+        err = conn.sendv(self.remote_addr,
+                         (_id.pack(txid), memoryview(data)[2:]))
+        if err.errcode != connection.E_OK:
+            return None
+        pending[txid] = q
+        self.sent[conn] += 1
+        if self.rotate_after and self.sent[conn] >= self.rotate_after:
+            self.__rotate(conn)
+        return q
+
+    def cancel(self, q):
+        pending = self.pending.get(q.conn)
+        if pending and pending.get(q.txid) is q:
+            del pending[q.txid]
+            self.__close_retired(q.conn)
+
+    def close(self):
+        for conn in self.pending:
+            conn.close()
+        self.conns = []
+        self.pending = {}
+        self.sent = {}
+
+    def __len__(self):
+        return sum(len(p) for p in self.pending.values())
+
+    def __handle_response(self, conn, remote_addr, data, err):
+        if err.errcode != connection.E_OK or not data or len(data) < 2:
+            return
+        if remote_addr != self.remote_addr:
+            self.logger.warning("unexpected udp response from %s:%d",
+                                remote_addr[0], remote_addr[1])
+            return
+        pending = self.pending.get(conn)
+        txid = _id.unpack_from(data, 0)[0]
+        q = pending.get(txid) if pending else None
+        if not q:
+            self.logger.debug("udp response from %s:%d with unknown id %d",
+                              remote_addr[0], remote_addr[1], txid)
+            return
+        if q.qname is not None:
+            try:
+                qname = wire.parse_question(data).qname
+            except wire.WireError:
+                qname = None
+            if qname != q.qname:
+                self.logger.warning(
+                    "[sid=%d] udp response from %s:%d with wrong name",
+                    q.sess.sid, remote_addr[0], remote_addr[1])
+                return
+        del pending[txid]
+        self.__close_retired(conn)
+        self.on_response(q, q.orig_txid + data[2:])
+
+
+class TCPStream(object):
+    '''one pipelined tcp connection of a TCPUpstream'''
+    def __init__(self, conn, now):
+        self.conn = conn
+        self.connected = False
+        self.pending = {}           # txid -> Query
+        self.backlog = []           # [bufs] to write once connected
+        self.last_active = now
+        self.connect_timer = None
+
+    @property
+    def bind_addr(self):
+        return self.conn.bind_addr
+
+    def new_txid(self):
+        txid = _rand.getrandbits(16)
+        while txid in self.pending:
+            txid = _rand.getrandbits(16)
+        return txid
+
+    def send(self, *bufs):
+        if self.connected:
+            self.conn.write(*bufs)
+        else:
+            self.backlog.append(bufs)
+
+
+class TCPUpstream(object):
+    '''
+    Long-lived tcp connections to one upstream, pipelining many length
+    prefixed queries on each of them and matching the out-of-order replies
+    by txid (RFC 7766). Queries wait in a queue when every connection is
+    full, or while reconnecting with backoff after failures. A connection
+    not established in connect_timeout seconds is a failure too.
+    '''
+    BACKOFF_MIN = 0.5
+    BACKOFF_MAX = 30
+
+    def __init__(self, io_engine, addr, on_response, max_conns=2,
+                 max_inflight=64, idle_timeout=10, connect_timeout=3):
+        self.logger = logging.getLogger()
+        self.io_engine = io_engine
+        self.addr = addr
+        self.remote_addr = (addr.ip, addr.port)
+        self.on_response = on_response
+        self.max_conns = max_conns
+        self.max_inflight = max_inflight
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.streams = []
+        self.waiting = deque()      # Query not sent yet
+        self.failures = 0           # continuous connect failures
+        self.next_connect_ts = 0
+        self.reconnecting = False
+        self.io_engine.add_timer(False, 1, self.__check_idle)
+
+    def __len__(self):
+        return sum(len(st.pending) for st in self.streams) + len(self.waiting)
+
+    def query(self, sess, data, qname=None):
+        if len(data) < 2:
+            return None
+        q = Query(self, sess, None, 0, data[:2], qname, data)
+        if not self.__dispatch(q):
+            self.waiting.append(q)
+            self.__schedule_connect()
+        return q
+
+    def cancel(self, q):
+        if q.conn is None:
+            try:
+                self.waiting.remove(q)
+            except ValueError:
+                pass
+        elif q.conn.pending.get(q.txid) is q:
+            del q.conn.pending[q.txid]
+
+    def close(self):
+        for st in self.streams:
+            self.__cancel_connect_timer(st)
+            st.conn.close()
+        self.streams = []
+        self.waiting.clear()
+
+    def __pick_stream(self):
+        best = None
+        for st in self.streams:
+            if len(st.pending) < self.max_inflight and \
+                    (best is None or len(st.pending) < len(best.pending)):
+                best = st
+        if best is None and len(self.streams) < self.max_conns and \
+                self.io_engine.time() >= self.next_connect_ts:
+            best = self.__connect()
+        return best
+
+    def __dispatch(self, q):
+        st = self.__pick_stream()
+        if st is None:
+            return False
+        q.conn = st
+        q.txid = st.new_txid()
+        st.pending[q.txid] = q
+        st.send(_len_id.pack(len(q.data), q.txid), memoryview(q.data)[2:])
+        return True
+
+    def __dispatch_waiting(self):
+        while self.waiting:
+            if not self.__dispatch(self.waiting[0]):
+                self.__schedule_connect()
+                break
+            self.waiting.popleft()
+
+    def __connect(self):
+        conn = connection.TCPConnection(io_engine=self.io_engine)
+        st = TCPStream(conn, self.io_engine.time())
+        self.streams.append(st)
+        conn.aconnect(self.remote_addr, self.__handle_connected, st)
+        if conn.closed:
+            # failed at once, __handle_connected has been called
+            return None
+        st.connect_timer = self.io_engine.add_timer(
+            True, self.connect_timeout, self.__handle_connect_timeout, st)
+        return st
+
+    def __schedule_connect(self):
+        if self.reconnecting or not self.waiting:
+            return
+        delay = self.next_connect_ts - self.io_engine.time()
+        if delay <= 0:
+            return
+        self.reconnecting = True
+        self.io_engine.add_timer(True, delay, self.__reconnect)
+
+    def __reconnect(self):
+        self.reconnecting = False
+        self.__dispatch_waiting()
+
+    def __connect_failed(self, st, reason):
+        self.failures += 1
+        backoff = min(self.BACKOFF_MIN * (2 ** (self.failures - 1)),
+                      self.BACKOFF_MAX)
+        self.next_connect_ts = self.io_engine.time() + backoff
+        self.logger.warning("tcp connect to %s:%d %s, retry in %.1fs",
+                            self.remote_addr[0], self.remote_addr[1],
+                            reason, backoff)
+        self.__remove(st)
+
+    def __cancel_connect_timer(self, st):
+        if st.connect_timer is not None:
+            self.io_engine.cancel_timer(st.connect_timer)
+            st.connect_timer = None
+
+    def __handle_connect_timeout(self, st):
+        st.connect_timer = None
+        if st.connected or st not in self.streams:
+            return
+        self.__connect_failed(st, "timed out")
+
+    def __handle_connected(self, conn, err, st):
+        self.__cancel_connect_timer(st)
+        if err.errcode != connection.E_OK:
+            self.__connect_failed(st, "failed")
+            return
+        self.failures = 0
+        st.connected = True
+        st.last_active = self.io_engine.time()
+        conn.arecv_msgs(self.__handle_msg, self.__handle_error)
+        for bufs in st.backlog:
+            conn.write(*bufs)
+        st.backlog = []
+
+    def __handle_error(self, conn, err):
+        for st in self.streams:
+            if st.conn is conn:
+                self.__remove(st)
+                break
+
+    def __remove(self, st):
+        '''remove a broken stream, its queries are retried once'''
+        if st in self.streams:
+            self.streams.remove(st)
+        st.conn.close()
+        retry = []
+        for q in st.pending.values():
+            if not q.retried:
+                q.retried = True
+                q.conn = None
+                retry.append(q)
+        st.pending = {}
+        self.waiting.extendleft(reversed(retry))
+        self.__dispatch_waiting()
+
+    def __handle_msg(self, conn, data):
+        st = None
+        for s in self.streams:
+            if s.conn is conn:
+                st = s
+                break
+        if st is None or len(data) < 2:
+            return
+        st.last_active = self.io_engine.time()
+        txid = _id.unpack_from(data, 0)[0]
+        q = st.pending.get(txid)
+        if not q:
+            self.logger.debug("tcp response from %s:%d with unknown id %d",
+                              self.remote_addr[0], self.remote_addr[1], txid)
+            return
+        if q.qname is not None:
+            try:
+                qname = wire.parse_question(data).qname
+            except wire.WireError:
+                qname = None
+            if qname != q.qname:
+                self.logger.warning(
+                    "[sid=%d] tcp response from %s:%d with wrong name",
+                    q.sess.sid, self.remote_addr[0], self.remote_addr[1])
+                return
+        del st.pending[txid]
+        self.on_response(q, q.orig_txid + data[2:])
+        self.__dispatch_waiting()
+
+    def __check_idle(self):
+        now = self.io_engine.time()
+        for st in list(self.streams):
+            if st.connected and not st.pending and \
+                    now - st.last_active >= self.idle_timeout:
+                self.logger.debug("close idle tcp connection to %s:%d",
+                                  self.remote_addr[0], self.remote_addr[1])
+                self.streams.remove(st)
+                st.conn.close()
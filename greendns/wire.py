@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+import sys
+import random
+import struct
+import socket
+from array import array
+from collections import namedtuple
+import six
+
+HEADER_LEN = 12
+MAX_POINTERS = 64
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_OPT = 41
+CLASS_IN = 1
+RCODE_NXDOMAIN = 3
+FLAG_CD = 0x0010
+PAYLOAD_CLASSES = (512, 1232, 4096)
+A_RR_LEN = 16   # pointer, type, class, ttl, rdlength and ip
+
+Header = namedtuple("Header", "id flags qdcount ancount nscount arcount")
+Question = namedtuple("Question", "qname qtype qclass end")
+RR = namedtuple("RR", "rtype rclass ttl rdata rdlength")
+Edns = namedtuple("Edns", "payload do")
+
+_header = struct.Struct(">HHHHHH")
+_qtail = struct.Struct(">HH")
+_rr = struct.Struct(">HHIH")
+_ip = struct.Struct(">I")
+_id = struct.Struct(">H")
+_ttl = struct.Struct(">I")
+_packed = struct.Struct("=dHHH")
+_indexbytes = six.indexbytes
+_rand = random.Random()
+if six.PY2:
+    _array_tobytes = array.tostring
+    _array_frombytes = array.fromstring
+else:
+    _array_tobytes = array.tobytes
+    _array_frombytes = array.frombytes
+
+
+class WireError(Exception):
+    pass
+
+
+def parse_header(data):
+    if len(data) < HEADER_LEN:
+        raise WireError("message too short")
+    return Header(*_header.unpack_from(data, 0))
+
+
+def read_name(data, offset):
+    '''
+    return (name, end). name is lowercased and dotted bytes like b"qq.com.",
+    end is the offset right after the name in the original position.
+    '''
+    labels = []
+    end = -1
+    jumps = 0
+    length = len(data)
+    while True:
+        if offset >= length:
+            raise WireError("name out of range")
+        n = _indexbytes(data, offset)
+        if n >= 0xc0:
+            if offset + 1 >= length:
+                raise WireError("pointer out of range")
+            if end < 0:
+                end = offset + 2
+            jumps += 1
+            if jumps > MAX_POINTERS:
+                raise WireError("too many pointers")
+            offset = ((n & 0x3f) << 8) | _indexbytes(data, offset + 1)
+            continue
+        if n > 63:
+            raise WireError("invalid label type")
+        offset += 1
+        if n == 0:
+            break
+        if offset + n > length:
+            raise WireError("label out of range")
+        labels.append(data[offset:offset + n])
+        offset += n
+    if end < 0:
+        end = offset
+    return (b".".join(labels).lower() + b".", end)
+
+
+def parse_question(data, offset=HEADER_LEN):
+    qname, offset = read_name(data, offset)
+    if offset + 4 > len(data):
+        raise WireError("question out of range")
+    qtype, qclass = _qtail.unpack_from(data, offset)
+    return Question(qname, qtype, qclass, offset + 4)
+
+
+def parse_request(data):
+    '''return (header, question), question is None if there is none'''
+    header = parse_header(data)
+    if not header.qdcount:
+        return (header, None)
+    return (header, parse_question(data))
+
+
+def make_query(qname, qtype=TYPE_A, txid=0):
+    '''return a recursive query of qname like "qq.com", without edns'''
+    labels = [l for l in qname.lower().encode("idna").split(b".") if l]
+    name = b"".join(six.int2byte(len(l)) + l for l in labels) + b"\0"
+    return (_header.pack(txid, 0x0100, 1, 0, 0, 0) + name +
+            _qtail.pack(qtype, CLASS_IN))
+
+
+def edns(data, header, offset):
+    '''
+    return Edns of the OPT rr, None if there is none. offset is the end of
+    the question section
+    '''
+    length = len(data)
+    for _ in range(header.ancount + header.nscount + header.arcount):
+        offset = skip_name(data, offset)
+        if offset + 10 > length:
+            raise WireError("rr out of range")
+        rtype, rclass, ttl, rdlength = _rr.unpack_from(data, offset)
+        if rtype == TYPE_OPT:
+            return Edns(rclass, bool(ttl & 0x8000))
+        offset += 10 + rdlength
+    return None
+
+
+def payload_class(payload):
+    '''
+    return the least of PAYLOAD_CLASSES not less than payload, the answers
+    truncated to the same class are the same
+    '''
+    for n in PAYLOAD_CLASSES:
+        if payload <= n:
+            return n
+    return 65535
+
+
+def reply_to(resp, req, end):
+    '''
+    return resp with the id and the question of req, whose question
+    section ends at end. The name case of the question is kept this way.
+    '''
+    if len(resp) < end or resp[HEADER_LEN:end].lower() != \
+            req[HEADER_LEN:end].lower():
+        return req[:2] + resp[2:]
+    return req[:2] + resp[2:HEADER_LEN] + req[HEADER_LEN:end] + resp[end:]
+
+
+def skip_name(data, offset):
+    '''return the offset right after the name, pointers are not followed'''
+    length = len(data)
+    while True:
+        if offset >= length:
+            raise WireError("name out of range")
+        n = _indexbytes(data, offset)
+        if n >= 0xc0:
+            offset += 2
+            break
+        if n > 63:
+            raise WireError("invalid label type")
+        offset += n + 1
+        if n == 0:
+            break
+    if offset > length:
+        raise WireError("name out of range")
+    return offset
+
+
+def scan_answers(data):
+    '''return (header, answer section rrs), rdata is not parsed'''
+    header = parse_header(data)
+    length = len(data)
+    offset = HEADER_LEN
+    for _ in range(header.qdcount):
+        offset = skip_name(data, offset) + 4
+    rrs = []
+    for _ in range(header.ancount):
+        offset = skip_name(data, offset)
+        if offset + 10 > length:
+            raise WireError("rr out of range")
+        rtype, rclass, ttl, rdlength = _rr.unpack_from(data, offset)
+        offset += 10
+        if offset + rdlength > length:
+            raise WireError("rdata out of range")
+        rrs.append(RR(rtype, rclass, ttl, offset, rdlength))
+        offset += rdlength
+    return (header, rrs)
+
+
+def scan_A(data):
+    '''return the A record ips in answer section as 32-bit integers'''
+    header = parse_header(data)
+    length = len(data)
+    offset = HEADER_LEN
+    for _ in range(header.qdcount):
+        offset = skip_name(data, offset) + 4
+    ips = []
+    for _ in range(header.ancount):
+        offset = skip_name(data, offset)
+        if offset + 10 > length:
+            raise WireError("rr out of range")
+        rtype, rclass, _, rdlength = _rr.unpack_from(data, offset)
+        offset += 10
+        if offset + rdlength > length:
+            raise WireError("rdata out of range")
+        if rtype == TYPE_A and rclass == CLASS_IN and rdlength == 4:
+            ips.append(_ip.unpack_from(data, offset)[0])
+        offset += rdlength
+    return ips
+
+
+def negative_ttl(data):
+    '''
+    return the ttl to cache a NXDOMAIN or NODATA response by RFC 2308, the
+    smaller one of the ttl and the minimum field of the SOA in authority
+    section. None if it is not such one or there is no SOA.
+    '''
+    header = parse_header(data)
+    rcode = header.flags & 0xf
+    if rcode != RCODE_NXDOMAIN and (rcode or header.ancount):
+        return None
+    length = len(data)
+    offset = HEADER_LEN
+    for _ in range(header.qdcount):
+        offset = skip_name(data, offset) + 4
+    for i in range(header.ancount + header.nscount):
+        offset = skip_name(data, offset)
+        if offset + 10 > length:
+            raise WireError("rr out of range")
+        rtype, _, ttl, rdlength = _rr.unpack_from(data, offset)
+        offset += 10 + rdlength
+        if offset > length:
+            raise WireError("rdata out of range")
+        if i >= header.ancount and rtype == TYPE_SOA:
+            if rdlength < 22:
+                raise WireError("invalid SOA")
+            return min(ttl, _ttl.unpack_from(data, offset - 4)[0])
+    return None
+
+
+def ip_to_str(ip):
+    return socket.inet_ntoa(_ip.pack(ip))
+
+
+class PackedResponse(object):
+    '''
+    A response kept in wire format. Offsets of the ttl fields and of the
+    trailing A records in answer section are found once, so that it can be
+    served again without any parsing. ttls are the original ones, the
+    remaining ttls are computed from ts only when served.
+    '''
+    __slots__ = ("data", "ts", "offsets", "ttls", "a_beg", "a_count",
+                 "rotation")
+
+    def __init__(self, data, ts=0):
+        header = parse_header(data)
+        length = len(data)
+        offset = HEADER_LEN
+        for _ in range(header.qdcount):
+            offset = skip_name(data, offset) + 4
+        self.data = bytes(data)
+        self.ts = ts
+        self.offsets = array("H")
+        self.ttls = array("I")
+        self.a_beg, self.a_count = 0, 0
+        self.rotation = 0
+        for i in range(header.ancount + header.nscount + header.arcount):
+            beg = offset
+            offset = skip_name(data, offset)
+            if offset + 10 > length:
+                raise WireError("rr out of range")
+            rtype, rclass, ttl, rdlength = _rr.unpack_from(data, offset)
+            if offset + 10 + rdlength > length:
+                raise WireError("rdata out of range")
+            if rtype != TYPE_OPT:
+                self.offsets.append(offset + 4)
+                self.ttls.append(ttl)
+            if i < header.ancount:
+                if rtype == TYPE_A and rclass == CLASS_IN \
+                        and offset + 10 + rdlength - beg == A_RR_LEN \
+                        and _indexbytes(data, beg) >= 0xc0:
+                    if not self.a_count:
+                        self.a_beg = beg
+                    self.a_count += 1
+                else:
+                    self.a_count = 0
+            offset += 10 + rdlength
+
+    def tobytes(self):
+        '''serialize with the offsets, for the same host only'''
+        return _packed.pack(self.ts, self.a_beg, self.a_count,
+                            len(self.offsets)) + \
+            _array_tobytes(self.offsets) + _array_tobytes(self.ttls) + \
+            self.data
+
+    @classmethod
+    def frombytes(cls, buf):
+        '''the reverse of tobytes, nothing is parsed again'''
+        self = cls.__new__(cls)
+        self.ts, self.a_beg, self.a_count, n = _packed.unpack_from(buf, 0)
+        offset = _packed.size
+        self.offsets = array("H")
+        _array_frombytes(self.offsets, bytes(buf[offset:offset + n * 2]))
+        offset += n * 2
+        self.ttls = array("I")
+        end = offset + n * self.ttls.itemsize
+        _array_frombytes(self.ttls, bytes(buf[offset:end]))
+        self.data = bytes(buf[end:])
+        # not shared, so start from anywhere
+        self.rotation = _rand.randrange(self.a_count) if self.a_count else 0
+        return self
+
+    def size(self):
+        '''approximate memory used in bytes'''
+        return sys.getsizeof(self) + sys.getsizeof(self.data) + \
+            sys.getsizeof(self.offsets) + sys.getsizeof(self.ttls)
+
+    def min_ttl(self):
+        return min(self.ttls) if self.ttls else 0
+
+    def is_negative(self):
+        '''NXDOMAIN or no answer'''
+        header = parse_header(self.data)
+        return header.flags & 0xf == RCODE_NXDOMAIN or not header.ancount
+
+    def make(self, txid, now=None, rotate=False, ttl=None):
+        '''
+        return a copy with txid, remaining ttls and rotated A records.
+        every ttl is set to ttl if it is given, like for a stale answer.
+        '''
+        buf = bytearray(self.data)
+        _id.pack_into(buf, 0, txid)
+        elapsed = int(now - self.ts) if now is not None else 0
+        if ttl is not None:
+            for offset in self.offsets:
+                _ttl.pack_into(buf, offset, ttl)
+        elif elapsed > 0:
+            for offset, ttl in zip(self.offsets, self.ttls):
+                _ttl.pack_into(buf, offset, ttl - elapsed if ttl > elapsed else 0)
+        if rotate and self.a_count > 1:
+            self.rotation = (self.rotation + 1) % self.a_count
+            beg = self.a_beg
+            mid = beg + self.rotation * A_RR_LEN
+            end = beg + self.a_count * A_RR_LEN
+            buf[beg:end] = buf[mid:end] + buf[beg:mid]
+        return bytes(buf)
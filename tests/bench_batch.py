@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+'''
+Cost per request of the listening socket, reading a burst of requests and
+sending back one response to each, one by one against batched.
+
+PYTHONPATH=. python tests/bench_batch.py
+'''
+from __future__ import print_function
+import time
+import socket
+from greendns import ioloop
+from greendns import connection
+from greendns import mmsg
+
+BURST = 32
+ROUNDS = 300
+
+
+def bench(batch, use_mmsg):
+    io_engine = ioloop.get_ioloop("epoll")
+    server = connection.UDPConnection(io_engine=io_engine)
+    server.bind(("127.0.0.1", 0))
+    server.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    if batch > 1:
+        server.set_batch(batch, use_mmsg)
+        respond = server.queue
+    else:
+        respond = server.send
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    client.bind(("127.0.0.1", 0))
+    client.settimeout(1)
+    counter = [0]
+
+    def on_recved(conn, remote_addr, data, err):
+        respond(remote_addr, data)
+        counter[0] += 1
+        if counter[0] == BURST:
+            io_engine.stop()
+    server.arecv(on_recved)
+    cost = 0
+    for _ in range(ROUNDS):
+        for i in range(BURST):
+            client.sendto(b"x" * 40, server.bind_addr)
+        counter[0] = 0
+        io_engine.running = True
+        beg = time.time()
+        io_engine.run()
+        io_engine.run_callbacks()
+        cost += time.time() - beg
+        for i in range(BURST):
+            client.recvfrom(2048)
+    server.close()
+    client.close()
+    return cost / ROUNDS / BURST
+
+
+def main():
+    print("burst of %d requests" % BURST)
+    modes = [("one by one", 1, False), ("batch", BURST, False)]
+    if mmsg.available:
+        modes.append(("batch mmsg", BURST, True))
+    for name, batch, use_mmsg in modes:
+        print("%-12s %6.2f us/request" % (name, bench(batch, use_mmsg) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
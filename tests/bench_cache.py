@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+Compare a cache hit and the memory of a cache entry, dnslib.DNSRecord
+against greendns.wire.PackedResponse, and a find in the memory cache
+against the shm cache.
+
+PYTHONPATH=. python tests/bench_cache.py
+'''
+from __future__ import print_function
+import os
+import random
+import timeit
+import tempfile
+import tracemalloc
+import dnslib
+from greendns import wire
+from greendns import cache
+
+N = 20000
+
+
+def make_response():
+    r = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, ra=1),
+                         q=dnslib.DNSQuestion("www.qq.com"))
+    for i in range(4):
+        r.add_answer(dnslib.RR("www.qq.com", rdata=dnslib.A("1.2.3.%d" % i)))
+    for i in range(4):
+        ns = "ns%d.qq.com" % i
+        r.add_auth(dnslib.RR("qq.com", dnslib.QTYPE.NS, rdata=dnslib.NS(ns)))
+        r.add_ar(dnslib.RR(ns, rdata=dnslib.A("2.2.2.%d" % i)))
+    return bytes(r.pack())
+
+
+def hit_by_dnslib(d):
+    d.header.id = 1234
+    random.shuffle(d.rr)
+    return bytes(d.pack())
+
+
+def hit_by_wire(p):
+    return p.make(1234, rotate=True)
+
+
+def memory(factory, data, n=1000):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    # a fresh copy, like the bytes received from upstream
+    entries = [factory(bytes(bytearray(data))) for _ in range(n)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, "filename"))
+    del entries
+    return size // n
+
+
+def main():
+    data = make_response()
+    d = dnslib.DNSRecord.parse(data)
+    p = wire.PackedResponse(data)
+    print("response %d bytes" % len(data))
+    for name, func in (("dnslib", lambda: hit_by_dnslib(d)),
+                       ("wire", lambda: hit_by_wire(p))):
+        cost = min(timeit.repeat(func, number=N, repeat=3)) / N
+        print("hit    %-8s %8.2f us" % (name, cost * 1e6))
+    for name, factory in (("dnslib", dnslib.DNSRecord.parse),
+                          ("wire", wire.PackedResponse)):
+        print("memory %-8s %8d bytes/entry" % (name, memory(factory, data)))
+    path = os.path.join(tempfile.mkdtemp(), "cache")
+    caches = (("memory", cache.Cache(10000)),
+              ("shm", cache.ShmCache(path, 10000,
+                                     encode=wire.PackedResponse.tobytes,
+                                     decode=wire.PackedResponse.frombytes)))
+    for name, c in caches:
+        for i in range(5000):
+            c.add((b"www%d.qq.com." % i, 1), p, 100)
+        key = (b"www100.qq.com.", 1)
+        cost = min(timeit.repeat(lambda: c.find(key).make(1234, rotate=True),
+                                 number=N, repeat=3)) / N
+        print("find   %-8s %8.2f us" % (name, cost * 1e6))
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
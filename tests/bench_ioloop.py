@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+'''
+Dispatch cost of every io loop engine against the number of registered
+sockets. One socket is always readable, the others are idle.
+
+PYTHONPATH=. python tests/bench_ioloop.py
+'''
+from __future__ import print_function
+import sys
+import time
+import socket
+from greendns import ioloop
+
+ROUNDS = 2000
+CHURN = 2000
+SIZES = (1, 10, 100, 500)
+
+
+def bench(engine, n):
+    iol = ioloop.get_ioloop(engine)
+    if iol is None:
+        return None
+    idle = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(n)]
+    for sock in idle:
+        iol.register(sock, ioloop.EV_READ, lambda s: None)
+    ready = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    ready.bind(("127.0.0.1", 0))
+    ready.sendto(b"x", ready.getsockname())
+    counter = [0]
+
+    def on_ready(sock):
+        counter[0] += 1
+        if counter[0] >= ROUNDS:
+            iol.stop()
+    iol.register(ready, ioloop.EV_READ, on_ready)
+    beg = time.time()
+    iol.run()
+    dispatch = (time.time() - beg) / ROUNDS
+
+    # register and unregister a socket, like a per query upstream socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    beg = time.time()
+    for _ in range(CHURN):
+        iol.register(sock, ioloop.EV_READ, on_ready)
+        iol.on_close_sock(sock)
+    churn = (time.time() - beg) / CHURN
+    for s in idle + [ready, sock]:
+        s.close()
+    return dispatch, churn
+
+
+def main():
+    engines = ["select", "poll", "epoll", "selectors"]
+    print("%-10s %8s %14s %16s" % ("engine", "sockets", "dispatch(us)",
+                                   "reg+unreg(us)"))
+    for engine in engines:
+        for n in SIZES:
+            result = bench(engine, n)
+            if result is None:
+                print("%-10s not available on %s" % (engine, sys.platform))
+                break
+            print("%-10s %8d %14.2f %16.2f" % (engine, n + 1,
+                                              result[0] * 1e6,
+                                              result[1] * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
+import os
 import time
 import pytest
-from greendns.cache import Cache
+from greendns.cache import Cache, ShmCache
 
 
 @pytest.fixture
@@ -62,3 +63,167 @@ def test_cache(cache):
     assert len(cache) == old_len - 2
     cache.validate()
     assert len(cache) == 0
+
+
+def test_lru_max_entries():
+    c = Cache(max_entries=2)
+    c.add(1, "11", 10)
+    c.add(2, "22", 10)
+    assert c.find(1) == "11"
+    c.add(3, "33", 10)
+    assert len(c) == 2
+    assert c.find(2) is None
+    assert c.find(1) == "11"
+    assert c.find(3) == "33"
+    assert c.evictions == 1
+
+
+def test_lru_max_bytes():
+    c = Cache(max_bytes=100)
+    c.add(1, "11", 10, 40)
+    c.add(2, "22", 10, 40)
+    assert c.bytes == 80
+    c.add(1, "11", 10, 50)
+    assert c.bytes == 90
+    c.add(3, "33", 10, 30)
+    assert c.find(2) is None
+    assert c.bytes == 80
+    c.remove(1)
+    assert c.bytes == 30
+    c.add(4, "44", 10, 200)
+    assert len(c) == 0
+    assert c.bytes == 0
+
+
+def test_stats(cache):
+    cache.find(1)
+    cache.find(4)
+    s = cache.stats()
+    assert s["entries"] == 3
+    assert s["hits"] == 1
+    assert s["misses"] == 1
+    assert s["evictions"] == 0
+    assert s["bytes"] == 0
+
+
+def test_validate_deadlines():
+    c = Cache()
+    for i in range(100):
+        c.add(i, i, 100)
+    c.add(1, 1, 0)
+    c.remove(2)
+    c.validate()
+    assert len(c) == 98
+    assert c.expired == 1
+    assert len(c.deadlines) == 100
+    for i in range(3, 100):
+        c.remove(i)
+    c.validate()
+    assert len(c) == 1
+    assert len(c.deadlines) == 1
+
+
+def test_stale():
+    c = Cache(stale=10)
+    c.add(1, "11", -1)      # expired a second ago
+    c.add(2, "22", -20)
+    assert c.find(1) is None
+    assert c.find_stale(1) == "11"
+    assert c.find_stale(2) is None
+    assert c.find_stale(3) is None
+    c.validate()
+    assert len(c) == 1
+    assert c.stats()["stale_hits"] == 1
+
+
+@pytest.fixture
+def shm_path(tmpdir):
+    return str(tmpdir.join("cache"))
+
+
+def test_shm(shm_path):
+    c = ShmCache(shm_path, 64, 128)
+    c.add(1, b"11", 10)
+    c.add((b"qq.com.", 1), b"22", 10)
+    assert len(c) == 2
+    assert c.find(1) == b"11"
+    assert c.find((b"qq.com.", 1)) == b"22"
+    assert c.find(2) is None
+    c.add(1, b"111", 10)
+    assert c.find(1) == b"111"
+    assert len(c) == 2
+    c.remove(1)
+    assert c.find(1) is None
+    assert len(c) == 1
+    c.add(3, b"x" * 200, 10)
+    assert c.find(3) is None
+    s = c.stats()
+    assert (s["hits"], s["misses"], s["entries"]) == (3, 3, 1)
+    c.close()
+
+
+def test_shm_oversized(shm_path):
+    c = ShmCache(shm_path, 64, 128)
+    c.add(1, b"x" * 100, 10)
+    c.add(2, b"x" * 200, 10)
+    assert c.find(1) == b"x" * 100
+    assert c.find(2) is None
+    assert len(c) == 1
+    assert c.stats()["oversized"] == 1
+    c.close()
+
+
+def test_shm_expire(shm_path):
+    c = ShmCache(shm_path, 64, 128)
+    c.add(1, b"11", 0)
+    c.add(2, b"22", 10)
+    assert c.find(1) is None
+    assert len(c) == 2
+    c.validate()
+    assert len(c) == 1
+    assert c.expired == 1
+    assert c.find(2) == b"22"
+    c.close()
+
+
+def test_shm_evict(shm_path):
+    c = ShmCache(shm_path, 4, 128)
+    for i in range(8):
+        c.add(i, b"v", 10 + i)
+    assert len(c) == 4
+    assert c.evictions == 4
+    assert [c.find(i) for i in range(4, 8)] == [b"v"] * 4
+
+
+def test_shm_shared(shm_path):
+    c1 = ShmCache(shm_path, 64, 128)
+    c1.add(1, b"11", 10)
+    c2 = ShmCache(shm_path, 64, 128)
+    assert c2.find(1) == b"11"
+    pid = os.fork()
+    if pid == 0:
+        c1.add(2, b"22", 10)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert c2.find(2) == b"22"
+    assert len(c2) == 2
+    # another geometry starts empty
+    c3 = ShmCache(shm_path, 32, 128)
+    assert len(c3) == 0
+    assert c3.find(1) is None
+    assert c1.find(1) == b"11"
+    for c in (c1, c2, c3):
+        c.close()
+
+
+def test_shm_stale(shm_path):
+    c = ShmCache(shm_path, 64, 128, stale=10)
+    c.add(1, b"11", -1)
+    c.add(2, b"22", -20)
+    assert c.find(1) is None
+    assert c.find_stale(1) == b"11"
+    assert c.find_stale(2) is None
+    c.validate()
+    assert len(c) == 1
+    assert c.stats()["stale_hits"] == 1
+    c.close()
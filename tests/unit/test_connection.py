@@ -6,11 +6,12 @@ import time
 import random
 import socket
 import logging
-from multiprocessing import Process
+from multiprocessing import Process, Event
 import pytest
 from six.moves import socketserver
 from greendns import connection
 from greendns import ioloop
+from greendns import mmsg
 
 logger = logging.getLogger()
 ch = logging.StreamHandler()
@@ -85,9 +86,16 @@ def my_udp_server():
         assert err.errcode == connection.E_OK
         server.asend(remote_addr, data, on_sent)
 
+    def run(ready):
+        ready.set()
+        server.run()
+
     server.arecv(on_recved)
-    p = Process(target=server.run)
+    # SIGINT may be lost if it comes before the child is ready
+    ready = Event()
+    p = Process(target=run, args=(ready,))
     p.start()
+    assert ready.wait(5)
     yield server.bind_addr
     os.kill(p.pid, signal.SIGINT)
     p.join()
@@ -231,3 +239,72 @@ def test_arecv_zero():
     time.sleep(1)
     client.aconnect(server_addr, on_connected)
     client.run()
+
+@pytest.mark.parametrize("use_mmsg", [False, True])
+def test_udp_batch(use_mmsg):
+    if use_mmsg and not mmsg.available:
+        pytest.skip("no recvmmsg")
+    io_engine = ioloop.get_ioloop("select")
+    server = connection.UDPConnection(io_engine=io_engine)
+    server.bind(("127.0.0.1", 0))
+    server.set_batch(4, use_mmsg)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(("127.0.0.1", 0))
+    client.settimeout(1)
+    for i in range(6):
+        client.sendto(b'%d' % i, server.bind_addr)
+    rounds = []
+
+    def on_recved(conn, remote_addr, data, err):
+        assert err.errcode == connection.E_OK
+        assert remote_addr == client.getsockname()
+        rounds.append(data)
+        server.queue(remote_addr, data * 2)
+        if len(rounds) == 4:
+            # responses are sent at the end of the round
+            client.setblocking(False)
+            with pytest.raises(socket.error):
+                client.recvfrom(1024)
+            client.settimeout(1)
+        if len(rounds) == 6:
+            server.stop()
+    server.arecv(on_recved)
+    io_engine.add_timer(True, 1, server.stop)
+    server.run()
+    assert rounds == [b'%d' % i for i in range(6)]
+    assert [client.recvfrom(1024)[0] for _ in range(6)] == \
+        [b'%d' % i * 2 for i in range(6)]
+    assert not server.outq
+    server.close()
+    client.close()
+
+def test_tcp_msgs():
+    io_engine = ioloop.get_ioloop("select")
+    conns = []
+    for sock in socket.socketpair():
+        conn = connection.TCPConnection(io_engine=io_engine)
+        conn.sock = sock
+        conn.sock.setblocking(0)
+        conn.bind_addr = conn.remote_addr = ("127.0.0.1", 0)
+        conns.append(conn)
+    reader, writer = conns
+    # long ones are split by recv and cross the middle of the buffer
+    msgs = [b'a' * 10, b'b' * 65535, b'c' * 3, b'd' * 65535, b'e' * 65535,
+            b'f' * 40000, b'g']
+    got = []
+
+    def on_msg(conn, msg):
+        got.append(msg)
+        if len(got) == len(msgs):
+            io_engine.stop()
+    reader.arecv_msgs(on_msg, None)
+    for msg in msgs:
+        writer.write(bytearray([len(msg) >> 8, len(msg) & 0xff]),
+                     memoryview(msg))
+    io_engine.add_timer(True, 2, io_engine.stop)
+    io_engine.run()
+    assert got == msgs
+    assert not writer.wbuf
+    assert reader.rpos == reader.wpos == 0
+    reader.close()
+    writer.close()
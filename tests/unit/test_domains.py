@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import time
+import pytest
+from greendns.domains import DomainSuffixes
+
+
+@pytest.mark.parametrize("line, domain", [
+    ("qq.com", b"qq.com."),
+    ("  *.QQ.com.  # tencent", b"qq.com."),
+    ("server=/qq.com/114.114.114.114", b"qq.com."),
+    ("ipset=/qq.com/local", b"qq.com."),
+    (u"例子.测试", b"xn--fsqu00a.xn--0zwm56d."),
+    ("# comment", None),
+    ("", None),
+])
+def test_parse_line(line, domain):
+    assert DomainSuffixes.parse_line(line) == domain
+
+
+def test_find():
+    d = DomainSuffixes()
+    assert d.find(b"qq.com.") is None
+    assert d.load(["qq.com", "mail.qq.com", "#", "com.cn"], "local") == 3
+    assert d.load(["a.mail.qq.com"], "foreign") == 1
+    assert len(d) == 4
+    assert d.find(b"qq.com.") == "local"
+    assert d.find(b"www.qq.com.") == "local"
+    assert d.find(b"a.mail.qq.com.") == "foreign"
+    assert d.find(b"b.a.mail.qq.com.") == "foreign"
+    assert d.find(b"xqq.com.") is None
+    assert d.find(b"com.") is None
+    assert d.find(b".") is None
+    assert d.find(b"") is None
+
+
+def test_load_large():
+    d = DomainSuffixes()
+    lines = ["server=/d%d.example%d.com/114.114.114.114" % (i, i % 100)
+             for i in range(100000)]
+    beg = time.time()
+    assert d.load(lines, "local") == 100000
+    assert time.time() - beg < 1
+    assert d.find(b"www.d99999.example99.com.") == "local"
@@ -3,14 +3,17 @@ from multiprocessing import Process
 import socket
 import random
 import os
+import gc
 import signal
 import time
 import logging
 import pytest
+import dnslib
 from six.moves import socketserver
 from greendns.forwarder import Forwarder
 from greendns.handler_quickest import QuickestHandler
 from greendns import ioloop
+from greendns import connection
 from greendns.connection import Addr
 
 
@@ -122,3 +125,401 @@ def test_forwarder_bind(forwarder):
     handler.init(io_engine)
     with pytest.raises(SystemExit):
         f = Forwarder(io_engine, upstreams, listen, timeout, handler)
+
+
+OK = connection.ConnError(connection.E_OK, "")
+NOBODY = [Addr("udp", "127.0.0.1", 1234), Addr("udp", "127.0.0.1", 1235)]
+
+
+def make_request(qname="qq.com", txid=1, qtype="A"):
+    q = dnslib.DNSRecord.question(qname, qtype)
+    q.header.id = txid
+    return bytes(q.pack())
+
+
+def run_for(f, seconds):
+    '''run the io loop of f for seconds'''
+    f.io_engine.running = True
+    f.io_engine.add_timer(True, seconds, f.io_engine.stop)
+    f.io_engine.run()
+
+
+@pytest.fixture
+def make_forwarder():
+    '''
+    make a Forwarder on its own io loop, the upstream is nobody listening
+    unless given
+    '''
+    def make(handler=None, upstreams=NOBODY[:1], timeout=1, **kwargs):
+        io_engine = ioloop.get_ioloop("select")
+        return Forwarder(io_engine, list(upstreams), "127.0.0.1:0", timeout,
+                         handler or QuickestHandler(), **kwargs)
+    return make
+
+
+@pytest.fixture
+def client():
+    '''the client socket of the requests'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(0.5)
+    yield sock
+    sock.close()
+
+
+def test_forwarder_deadline(make_forwarder):
+    f = make_forwarder(timeout=0.2)
+    f.handle_request_from_client(None, ("127.0.0.1", 1), b"hello\n", OK)
+    f.handle_request_from_client(None, ("127.0.0.1", 2), b"hello\n", OK)
+    assert len(f.sessions) == 2
+    query = list(f.sessions)[0]
+    query.close()   # as the upstream does before the callback
+    f.handle_upstream_response(query, b"hello\n")
+    assert query.timer.cancelled
+    assert len(f.sessions) == 1
+    f.server.arecv(f.handle_request_from_client)
+    run_for(f, 0.3)
+    assert not f.sessions
+    assert not len(f.get_upstream(f.upstreams[0]))
+
+
+def test_forwarder_coalesce(make_forwarder, client):
+    f = make_forwarder()
+    for qname, qtype, txid in (("qq.com", "A", 1), ("QQ.com", "A", 2),
+                               ("qq.com", "AAAA", 3), ("qq.com", "A", 4)):
+        f.handle_request_from_client(None, client.getsockname(),
+                                     make_request(qname, txid, qtype), OK)
+    # one upstream query for each of A and AAAA
+    assert len(f.sessions) == 2
+    assert f.coalesced == 2
+    query = [q for q, sess in f.sessions.items()
+             if sess.key[1] == dnslib.QTYPE.A][0]
+    query.close()
+    a = dnslib.DNSRecord.question("qq.com").reply()
+    a.header.id = 1     # restored by the upstream
+    a.add_answer(dnslib.RR("qq.com", rdata=dnslib.A("1.2.3.4")))
+    f.handle_upstream_response(query, bytes(a.pack()))
+    got = {}
+    for _ in range(3):
+        d = dnslib.DNSRecord.parse(client.recvfrom(1024)[0])
+        got[d.header.id] = str(d.q.qname)
+    assert got == {1: "qq.com.", 2: "QQ.com.", 4: "qq.com."}
+    assert len(f.inflight) == 1
+    f.server.arecv(f.handle_request_from_client)
+    run_for(f, 1.2)
+    assert not f.inflight
+    assert not f.sessions
+
+
+def test_forwarder_coalesce_edns(make_forwarder, client):
+    f = make_forwarder()
+    reqs = []
+    for txid, edns, cd in ((1, None, False), (2, None, True),
+                           (3, dnslib.EDNS0(udp_len=1232), False),
+                           (4, dnslib.EDNS0(udp_len=4096), False),
+                           (5, dnslib.EDNS0(udp_len=1232, flags="do"), False),
+                           (6, dnslib.EDNS0(udp_len=1200), False)):
+        q = dnslib.DNSRecord.question("qq.com")
+        q.header.id = txid
+        q.header.cd = cd
+        if edns:
+            q.add_ar(edns)
+        reqs.append(bytes(q.pack()))
+    for data in reqs:
+        f.handle_request_from_client(None, client.getsockname(), data, OK)
+    # only the last one is the same as another, in the same payload class
+    assert len(f.sessions) == 5
+    assert f.coalesced == 1
+
+
+def test_forwarder_retransmit(make_forwarder, client):
+    f = make_forwarder()
+    reqs = [make_request(txid=txid) for txid in (1, 2)]
+    for data in (reqs[0], reqs[0], reqs[1], reqs[1], reqs[0]):
+        f.handle_request_from_client(None, client.getsockname(), data, OK)
+    assert len(f.sessions) == 1
+    assert f.coalesced == 1
+    assert f.retransmits == 3
+    query = list(f.sessions)[0]
+    query.close()
+    f.handle_upstream_response(query, reqs[0])
+    assert sorted(client.recvfrom(1024)[0] for _ in range(2)) == reqs
+    with pytest.raises(socket.timeout):
+        client.recvfrom(1024)
+    assert not f.client_reqs
+    # answered, it is a new request now
+    f.handle_request_from_client(None, client.getsockname(), reqs[0], OK)
+    assert f.retransmits == 3
+    assert len(f.client_reqs) == 1
+
+
+class CachedHandler(QuickestHandler):
+    '''every request is a cache hit which needs prefetch'''
+    def on_client_request(self, sess):
+        if sess.prefetch:
+            return (True, None)
+        sess.refresh = True
+        return (False, sess.req_data)
+
+
+def test_forwarder_prefetch(make_forwarder, client):
+    f = make_forwarder(CachedHandler(), max_prefetches=1)
+    reqs = [make_request("qq.com", 1), make_request("baidu.com", 2)]
+    for data in reqs:
+        f.handle_request_from_client(None, client.getsockname(), data, OK)
+    assert [client.recvfrom(1024)[0] for _ in range(2)] == reqs
+    # the second one is over the limit
+    assert f.prefetched == 1
+    assert len(f.sessions) == 1
+    query, sess = list(f.sessions.items())[0]
+    assert sess.prefetch and not sess.client_addr
+    query.close()
+    f.handle_upstream_response(query, reqs[0])
+    with pytest.raises(socket.timeout):
+        client.recvfrom(1024)
+    assert not f.prefetches
+    assert not f.inflight
+
+
+class StaleHandler(QuickestHandler):
+    '''the request itself is the stale answer'''
+    def on_timeout(self, sess):
+        return sess.req_data
+
+
+@pytest.mark.parametrize("stale_timeout", [0.1, 0])
+def test_forwarder_stale(make_forwarder, client, stale_timeout):
+    f = make_forwarder(StaleHandler(), timeout=0.3,
+                       stale_timeout=stale_timeout)
+    reqs = [make_request(txid=txid) for txid in (1, 2)]
+    for data in reqs:
+        f.handle_request_from_client(None, client.getsockname(), data, OK)
+    run_for(f, 0.2)
+    if stale_timeout:
+        # answered, and still resolving without client
+        assert sorted(client.recvfrom(1024)[0] for _ in range(2)) == reqs
+        assert len(f.sessions) == 1
+        assert list(f.sessions.values())[0].prefetch
+    else:
+        assert f.stale_answers == 0
+    run_for(f, 0.2)
+    if not stale_timeout:
+        assert sorted(client.recvfrom(1024)[0] for _ in range(2)) == reqs
+    with pytest.raises(socket.timeout):
+        client.recvfrom(1024)
+    assert f.stale_answers == 1
+    assert not f.sessions
+    assert not f.inflight
+    assert not f.client_reqs
+
+
+class RoutedHandler(QuickestHandler):
+    '''ask the first upstream only'''
+    def route(self, sess):
+        return self.servers[:1]
+
+
+def test_forwarder_route(make_forwarder):
+    handler = RoutedHandler()
+    handler.servers = NOBODY
+    f = make_forwarder(handler, NOBODY, timeout=0.2)
+    f.handle_request_from_client(None, ("127.0.0.1", 1), b"hello\n", OK)
+    assert [q.addr for q in f.sessions] == NOBODY[:1]
+    # no answer in time, the others are asked
+    run_for(f, 0.3)
+    assert [q.addr for q in f.sessions] == NOBODY[1:]
+    assert f.fanouts == 1
+    run_for(f, 0.3)
+    assert not f.sessions
+    assert f.fanouts == 1
+    assert f.timeouts == 2
+    assert [handler.scores[addr].timeouts for addr in NOBODY] == [1, 1]
+    assert handler.scores is f.scores
+
+
+def test_forwarder_hedge(make_forwarder):
+    f = make_forwarder(upstreams=NOBODY, hedge=90)
+    q = dnslib.DNSRecord.question("qq.com")
+    # no rtt yet, all at once
+    f.handle_request_from_client(None, ("127.0.0.1", 1), bytes(q.pack()), OK)
+    assert len(f.sessions) == 2
+    for query in list(f.sessions):
+        f.handle_upstream_response(query, bytes(q.reply().pack()))
+    for _ in range(10):
+        f.scores.answered(NOBODY[0], 0.05)
+        f.scores.answered(NOBODY[1], 0.01)
+    # the best one answers in time
+    q.header.id += 1
+    f.handle_request_from_client(None, ("127.0.0.1", 1), bytes(q.pack()), OK)
+    assert [query.addr for query in f.sessions] == NOBODY[1:]
+    f.handle_upstream_response(list(f.sessions)[0], bytes(q.reply().pack()))
+    assert not f.sessions
+    assert f.hedged == 0
+    # it does not, the other one is asked and wins
+    q.header.id += 1
+    f.handle_request_from_client(None, ("127.0.0.1", 1), bytes(q.pack()), OK)
+    run_for(f, 0.1)
+    assert sorted(query.addr for query in f.sessions) == NOBODY
+    assert f.hedged == 1
+    query = [query for query in f.sessions if query.addr == NOBODY[0]][0]
+    f.handle_upstream_response(query, bytes(q.reply().pack()))
+    assert f.hedge_wins == 1
+    assert f.stats()["hedged"] == 1
+    for query in list(f.sessions):
+        query.close()
+
+
+class GroupHandler(QuickestHandler):
+    '''answers once both groups of 2 upstreams answered, like greendns'''
+    def hedge_groups(self, sess, addrs):
+        return [[addr for addr in addrs if addr in GROUPS[0]],
+                [addr for addr in addrs if addr in GROUPS[1]]]
+
+    def on_upstream_response(self, sess, addr):
+        if all(set(group) & set(sess.server_resps) for group in GROUPS):
+            return sess.server_resps[addr]
+        return None
+
+
+GROUPS = [NOBODY, [Addr("udp", "127.0.0.1", 1236),
+                   Addr("udp", "127.0.0.1", 1237)]]
+
+
+def test_forwarder_hedge_groups(make_forwarder):
+    handler = GroupHandler()
+    f = make_forwarder(handler, upstreams=GROUPS[0] + GROUPS[1], hedge=90)
+    for addr, rtt in zip(f.upstreams, (0.05, 0.01, 0.1, 0.2)):
+        for _ in range(10):
+            f.scores.answered(addr, rtt)
+    q = dnslib.DNSRecord.question("qq.com")
+    f.handle_request_from_client(None, ("127.0.0.1", 1), bytes(q.pack()), OK)
+    # the best of both groups at once
+    assert sorted(query.addr for query in f.sessions) == \
+        [GROUPS[0][1], GROUPS[1][0]]
+    sess = list(f.sessions.values())[0]
+    assert sorted(sess.hedges) == [GROUPS[0][0], GROUPS[1][1]]
+    # the first group answered, only the second one is hedged
+    query = [query for query in f.sessions if query.addr == GROUPS[0][1]][0]
+    f.handle_upstream_response(query, bytes(q.reply().pack()))
+    assert sess.hedges == [GROUPS[1][1]]
+    run_for(f, 0.2)
+    assert f.hedged == 1
+    assert sorted(query.addr for query in f.sessions) == GROUPS[1]
+    query = [query for query in f.sessions if query.addr == GROUPS[1][1]][0]
+    f.handle_upstream_response(query, bytes(q.reply().pack()))
+    assert sess.responsed
+    assert f.hedge_wins == 1
+    for query in list(f.sessions):
+        query.close()
+
+
+class HealthHandler(QuickestHandler):
+    def __init__(self):
+        super(HealthHandler, self).__init__()
+        self.states = []
+
+    def on_upstream_state(self, addr, state):
+        self.states.append((addr, state))
+
+
+@pytest.fixture
+def upstream_socks():
+    '''two upstreams answered by the test'''
+    socks = []
+    for _ in range(2):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("127.0.0.1", 0))
+        s.settimeout(1)
+        socks.append(s)
+    yield socks
+    for s in socks:
+        s.close()
+
+
+def test_forwarder_health(make_forwarder, upstream_socks):
+    socks = upstream_socks
+    upstreams = [Addr("udp", "127.0.0.1", s.getsockname()[1]) for s in socks]
+    handler = HealthHandler()
+    f = make_forwarder(handler, upstreams, timeout=0.2, open_failures=1)
+    f.handle_request_from_client(None, ("127.0.0.1", 1), make_request(), OK)
+    # the second one answers, the first one is down
+    socks[0].recvfrom(512)
+    data, addr = socks[1].recvfrom(512)
+    socks[1].sendto(data, addr)
+    run_for(f, 0.3)
+    assert handler.states == [(upstreams[0], "open")]
+    assert f.stats()["upstreams_open"] == 1
+    assert "health udp:127.0.0.1:%d open failures=1" % upstreams[0].port \
+        in f.dump()
+    f.handle_request_from_client(None, ("127.0.0.1", 1), make_request(txid=2),
+                                 OK)
+    assert [query.addr for query in f.sessions] == upstreams[1:]
+    for query in list(f.sessions):
+        query.close()
+    # it answers the probe
+    f.probe_upstreams()
+    assert f.probed == 1
+    data, addr = socks[0].recvfrom(512)
+    assert dnslib.DNSRecord.parse(data).q.qname == "example.com."
+    socks[0].sendto(data, addr)
+    run_for(f, 0.1)
+    assert handler.states[-1] == (upstreams[0], "healthy")
+    assert f.stats()["upstreams_open"] == 0
+
+
+def open_fds():
+    gc.collect()    # sockets left by the other tests
+    return len(os.listdir("/proc/self/fd"))
+
+
+def answer(sock):
+    '''the upstream sock echoes a query'''
+    data, addr = sock.recvfrom(512)
+    sock.sendto(data, addr)
+
+
+def test_forwarder_udp_pool_reused(make_forwarder, upstream_socks):
+    if not os.path.isdir("/proc/self/fd"):
+        pytest.skip("no /proc")
+    sock = upstream_socks[0]
+    addr = Addr("udp", "127.0.0.1", sock.getsockname()[1])
+    f = make_forwarder(upstreams=[addr])
+    fds = None
+    for txid in range(1, 11):
+        f.handle_request_from_client(None, ("127.0.0.1", 1),
+                                     make_request(txid=txid), OK)
+        answer(sock)
+        run_for(f, 0.02)
+        assert not f.sessions
+        if fds is None:
+            pool, fds = f.get_upstream(addr), open_fds()
+    assert f.get_upstream(addr) is pool
+    assert open_fds() == fds
+
+
+def test_forwarder_tcp_conn_reused(make_forwarder):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+    listener.settimeout(1)
+    addr = Addr("tcp", "127.0.0.1", listener.getsockname()[1])
+    f = make_forwarder(upstreams=[addr])
+    conn = None
+    for txid in range(1, 6):
+        f.handle_request_from_client(None, ("127.0.0.1", 1),
+                                     make_request(txid=txid), OK)
+        run_for(f, 0.02)
+        if conn is None:
+            conn, _ = listener.accept()
+            conn.settimeout(1)
+        data = conn.recv(2048)
+        conn.sendall(data)
+        run_for(f, 0.02)
+        assert not f.sessions
+    # sequential queries are on the one connection
+    listener.settimeout(0.1)
+    with pytest.raises(socket.timeout):
+        listener.accept()
+    assert len(f.get_upstream(addr).streams) == 1
+    conn.close()
+    listener.close()
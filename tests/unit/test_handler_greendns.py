@@ -6,7 +6,11 @@ import pytest
 import dnslib
 from greendns.handler_greendns import GreenDNSHandler
 from greendns.handler_greendns import GreenDNSSession
+from greendns.handler_greendns import registrable_domain
 from greendns.connection import Addr
+from greendns.wire import PackedResponse
+from greendns import health
+from greendns import cache
 
 mydir = os.path.dirname(os.path.abspath(__file__))
 local_dns1 = Addr("udp", "223.5.5.5", 53)
@@ -22,14 +26,14 @@ def init_greendns_session(greendns, qname, qtype, id=1234):
     q = dnslib.DNSRecord.question(qname)
     q.header.id = id
     s = greendns.new_session()
-    s.qname = qname
+    s.qname = (qname.lower() + ".").encode()
     s.qtype = qtype
     s.client_addr = ("127.0.0.1", 50453)
     s.send_ts = time.time()
     s.req_data = bytes(q.pack())
     return s
 
-def make_handler():
+def make_handler(*args):
     h = GreenDNSHandler()
     parser = argparse.ArgumentParser()
     h.add_arg(parser)
@@ -39,7 +43,7 @@ def make_handler():
                       "--rds",
                       "%s:%s:%d" %
                       (foreign_dns[0], foreign_dns[1], foreign_dns[2])]
-    h.parse_arg(parser, remaining_argv)
+    h.parse_arg(parser, remaining_argv + list(args))
     return h
 
 @pytest.fixture
@@ -87,7 +91,7 @@ def test_on_client_request_with_cached(greendns):
                            a=dnslib.RR(qname,
                                        rdata=dnslib.A("101.226.103.106"),
                                        ttl=3))
-    greendns.cache.add(("qq.com.", 1), res, 3)
+    greendns.cache.add((b"qq.com.", 1), PackedResponse(bytes(res.pack())), 3)
     is_continue, raw_resp = greendns.on_client_request(s)
     assert not is_continue
     assert raw_resp
@@ -95,6 +99,84 @@ def test_on_client_request_with_cached(greendns):
     assert d.header.id == id
 
 
+def test_on_client_request_prefetch(greendns, monkeypatch):
+    qname = "qq.com"
+    res = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, aa=1, ra=1),
+                           q=dnslib.DNSQuestion(qname),
+                           a=dnslib.RR(qname,
+                                       rdata=dnslib.A("101.226.103.106"),
+                                       ttl=10))
+    # 90% of the ttl has passed
+    packed = PackedResponse(bytes(res.pack()), time.time() - 9)
+    greendns.cache.add((b"qq.com.", 1), packed, 10)
+    refresh = []
+    for _ in range(4):
+        s = init_greendns_session(greendns, qname, dnslib.QTYPE.A)
+        is_continue, raw_resp = greendns.on_client_request(s)
+        assert raw_resp
+        refresh.append(s.refresh)
+    assert refresh == [False, False, True, True]
+    s = init_greendns_session(greendns, qname, dnslib.QTYPE.A)
+    s.prefetch = True
+    is_continue, raw_resp = greendns.on_client_request(s)
+    assert is_continue
+    assert not raw_resp
+    # the prefetched answer is a new entry
+    s.server_resps[local_dns1] = bytes(res.pack())
+    assert greendns.on_upstream_response(s, local_dns1)
+    s = init_greendns_session(greendns, qname, dnslib.QTYPE.A)
+    greendns.on_client_request(s)
+    assert not s.refresh
+    assert greendns.hot.find((b"qq.com.", 1))[1] == 1
+    # expired with the entry
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 11)
+    greendns.validate()
+    assert not len(greendns.hot)
+
+
+def test_on_timeout_stale():
+    h = make_handler("--cache-stale", "60")
+    h.init(IOEngineMock())
+    qname = "qq.com"
+    s = init_greendns_session(h, qname, dnslib.QTYPE.A, 77)
+    assert h.on_timeout(s) is None
+    res = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, aa=1, ra=1),
+                           q=dnslib.DNSQuestion(qname),
+                           a=dnslib.RR(qname,
+                                       rdata=dnslib.A("101.226.103.106"),
+                                       ttl=300))
+    h.cache.add((b"qq.com.", 1), PackedResponse(bytes(res.pack())), -1)
+    is_continue, raw_resp = h.on_client_request(s)
+    assert is_continue
+    d = dnslib.DNSRecord.parse(h.on_timeout(s))
+    assert d.header.id == 77
+    assert d.rr[0].ttl == 30
+    assert str(d.rr[0].rdata) == "101.226.103.106"
+
+
+def test_on_client_request_with_shm_cache(tmpdir):
+    path = str(tmpdir.join("cache"))
+    h = make_handler("--cache-backend", "shm", "--cache-shm", path)
+    h.init(IOEngineMock())
+    qname = "qq.com"
+    s = init_greendns_session(h, qname, dnslib.QTYPE.A, 1024)
+    res = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, aa=1, ra=1),
+                           q=dnslib.DNSQuestion(qname),
+                           a=dnslib.RR(qname,
+                                       rdata=dnslib.A("101.226.103.106"),
+                                       ttl=3))
+    s.server_resps[local_dns1] = bytes(res.pack())
+    assert h.on_upstream_response(s, local_dns1)
+    # seen by another process
+    other = make_handler("--cache-backend", "shm", "--cache-shm", path)
+    is_continue, raw_resp = other.on_client_request(s)
+    assert not is_continue
+    d = dnslib.DNSRecord.parse(raw_resp)
+    assert d.header.id == 1024
+    assert str(d.rr[0].rdata) == "101.226.103.106"
+
+
 def test_on_client_request_with_cache_expired(greendns):
     qname = "qqq.com"
     id = 1024
@@ -104,7 +186,7 @@ def test_on_client_request_with_cache_expired(greendns):
                            a=dnslib.RR(qname,
                                        rdata=dnslib.A("101.226.103.106"),
                                        ttl=3))
-    greendns.cache.add(("qqq.com.", 1), res, 3)
+    greendns.cache.add((b"qqq.com.", 1), PackedResponse(bytes(res.pack())), 3)
     time.sleep(4)
     is_continue, raw_resp = greendns.on_client_request(s)
     assert is_continue
@@ -226,6 +308,31 @@ def test_on_upstream_response_not_A(greendns):
     assert str(d.rr[0].rdata) == qresult
 
 
+def test_on_upstream_response_negative(greendns):
+    qname = "nx.qq.com"
+    s = init_greendns_session(greendns, qname, dnslib.QTYPE.A)
+    res = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, aa=1, ra=1, rcode=3),
+                           q=dnslib.DNSQuestion(qname),
+                           auth=[dnslib.RR("qq.com", dnslib.QTYPE.SOA,
+                                           ttl=600,
+                                           rdata=dnslib.SOA(
+                                               "ns.qq.com", "admin.qq.com",
+                                               (1, 2, 3, 4, 900)))])
+    s.server_resps[local_dns1] = bytes(res.pack())
+    assert not greendns.on_upstream_response(s, local_dns1)
+    s.server_resps[foreign_dns] = bytes(res.pack())
+    assert greendns.on_upstream_response(s, foreign_dns)
+    # capped by --cache-neg-ttl
+    _, expire_ts = dict(greendns.cache.iteritems())[(b"nx.qq.com.", 1)]
+    assert 299 < expire_ts - time.time() <= 300
+    s = init_greendns_session(greendns, qname, dnslib.QTYPE.A)
+    is_continue, raw_resp = greendns.on_client_request(s)
+    assert not is_continue
+    assert dnslib.DNSRecord.parse(raw_resp).header.rcode == 3
+    stats = greendns.stats()
+    assert (stats["cache_neg_hits"], stats["cache_neg_misses"]) == (1, 1)
+
+
 def test_on_upstream_response_invalid_not_A(greendns):
     qname = "www.x.net"
     s = init_greendns_session(greendns, qname, dnslib.QTYPE.CNAME)
@@ -249,7 +356,7 @@ def test_shuffer_A(greendns):
     res.add_answer(dnslib.RR(qname,
                              rdata=dnslib.A("101.226.103.107"),
                              ttl=3))
-    greendns.cache.add(("qq.com.", 1), res, 3)
+    greendns.cache.add((b"qq.com.", 1), PackedResponse(bytes(res.pack())), 3)
     d = None
     for i in range(10):
         is_continue, raw_resp = greendns.on_client_request(s)
@@ -260,3 +367,192 @@ def test_shuffer_A(greendns):
             break
     assert d.rr[0].rtype == dnslib.QTYPE.CNAME
     assert str(d.rr[1].rdata) == "101.226.103.107"
+
+
+def test_on_upstream_response_passthrough(greendns):
+    qname = "www.coding.net"
+    s = init_greendns_session(greendns, qname, dnslib.QTYPE.A)
+    res = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, aa=1, ra=1),
+                           q=dnslib.DNSQuestion(qname),
+                           a=dnslib.RR(qname,
+                                       rdata=dnslib.A("219.146.244.91"),
+                                       ttl=3))
+    data = bytes(res.pack())
+    s.server_resps[local_dns1] = data
+    resp = greendns.on_upstream_response(s, local_dns1)
+    assert resp is data
+
+
+def test_registrable_domain():
+    assert registrable_domain(b"www.qq.com.") == b"qq.com."
+    assert registrable_domain(b"qq.com.") == b"qq.com."
+    assert registrable_domain(b"a.b.sina.com.cn.") == b"sina.com.cn."
+    assert registrable_domain(b"www.example.de.") == b"example.de."
+    assert registrable_domain(b"com.") == b"com."
+
+
+def answer(greendns, qname, ip, addr):
+    s = init_greendns_session(greendns, qname, dnslib.QTYPE.A)
+    servers = greendns.route(s)
+    res = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, aa=1, ra=1),
+                           q=dnslib.DNSQuestion(qname),
+                           a=dnslib.RR(qname, rdata=dnslib.A(ip), ttl=3))
+    s.server_resps[addr] = bytes(res.pack())
+    return servers, greendns.on_upstream_response(s, addr)
+
+
+def test_route_local(greendns):
+    for i in range(3):
+        servers, resp = answer(greendns, "www%d.microsoft.com" % i,
+                               "183.136.212.50", local_dns1)
+        assert servers is None
+        assert resp
+    servers, _ = answer(greendns, "microsoft.com", "183.136.212.50",
+                        local_dns1)
+    assert servers == [local_dns1]
+    assert greendns.stats()["routed"] == 1
+    # the routed one does not confirm the route
+    assert greendns.dump()[0].startswith("route microsoft.com. local "
+                                         "confidence=3")
+    # the local server answers a foreign ip, all are asked again
+    servers, resp = answer(greendns, "microsoft.com", "172.217.24.14",
+                           local_dns1)
+    assert servers == [local_dns1]
+    assert not resp
+    assert greendns.route(init_greendns_session(
+        greendns, "microsoft.com", dnslib.QTYPE.A)) == [local_dns1]
+    s = init_greendns_session(greendns, "microsoft.com", dnslib.QTYPE.A)
+    greendns.route(s)
+    res = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, aa=1, ra=1),
+                           q=dnslib.DNSQuestion("microsoft.com"),
+                           a=dnslib.RR("microsoft.com",
+                                       rdata=dnslib.A("172.217.24.14")))
+    s.server_resps[local_dns1] = bytes(res.pack())
+    assert not greendns.on_upstream_response(s, local_dns1)
+    s.server_resps[foreign_dns] = bytes(res.pack())
+    assert greendns.on_upstream_response(s, foreign_dns)
+    assert greendns.route_changes == 1
+    assert not greendns.routes
+
+
+def test_route_foreign():
+    h = make_handler("--route-confidence", "1", "--route-size", "1")
+    h.init(IOEngineMock())
+    s = init_greendns_session(h, "google.com", dnslib.QTYPE.A)
+    res = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, aa=1, ra=1),
+                           q=dnslib.DNSQuestion("google.com"),
+                           a=dnslib.RR("google.com",
+                                       rdata=dnslib.A("172.217.24.14")))
+    s.server_resps[local_dns1] = bytes(res.pack())
+    s.server_resps[foreign_dns] = bytes(res.pack())
+    assert not h.on_upstream_response(s, local_dns1)
+    assert h.on_upstream_response(s, foreign_dns)
+    # only the unpoisoned one is asked and its answer is used at once
+    learned = h.routes[b"google.com."]
+    servers, resp = answer(h, "www.google.com", "172.217.24.14",
+                           foreign_dns)
+    assert servers == [foreign_dns]
+    assert resp
+    # and it does not refresh the route
+    assert h.routes[b"google.com."] == learned
+    # bounded
+    answer(h, "www.coding.net", "183.136.212.50", local_dns1)
+    assert list(h.routes) == [b"coding.net."]
+
+
+def test_route_static(tmpdir):
+    local = tmpdir.join("local.txt")
+    local.write("server=/baidu.com/114.114.114.114\nmail.google.com\n")
+    foreign = tmpdir.join("foreign.txt")
+    foreign.write("# foreign\ngoogle.com\n")
+    h = make_handler("--local-domains", str(local),
+                     "--foreign-domains", str(foreign))
+    h.init(IOEngineMock())
+    assert len(h.domains) == 3
+    # the foreign answer of the unpoisoned server is used at once
+    servers, resp = answer(h, "www.google.com", "172.217.24.14",
+                           foreign_dns)
+    assert servers == [foreign_dns]
+    assert resp
+    # the longest suffix wins
+    servers, resp = answer(h, "mail.google.com", "183.136.212.50",
+                           local_dns1)
+    assert servers == [local_dns1]
+    assert resp
+    # not A
+    s = init_greendns_session(h, "www.google.com", dnslib.QTYPE.AAAA)
+    assert h.route(s) == [foreign_dns]
+    res = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, aa=1, ra=1),
+                           q=dnslib.DNSQuestion("www.google.com",
+                                                 dnslib.QTYPE.AAAA),
+                           a=dnslib.RR("www.google.com", dnslib.QTYPE.AAAA,
+                                       rdata=dnslib.AAAA("2404:6800::1")))
+    s.server_resps[foreign_dns] = bytes(res.pack())
+    assert h.on_upstream_response(s, foreign_dns)
+    assert h.route(init_greendns_session(h, "qq.com",
+                                         dnslib.QTYPE.A)) is None
+    assert h.stats()["static_routed"] == 3
+    assert not h.routes
+
+
+def test_on_upstream_response_unpoisoned_down(greendns):
+    qname = "www.google.com"
+    s = init_greendns_session(greendns, qname, dnslib.QTYPE.A)
+    res = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, aa=1, ra=1),
+                           q=dnslib.DNSQuestion(qname),
+                           a=dnslib.RR(qname, rdata=dnslib.A("172.217.24.14")))
+    s.server_resps[local_dns1] = bytes(res.pack())
+    greendns.on_upstream_state(foreign_dns, health.OPEN)
+    assert greendns.on_upstream_response(s, local_dns1)
+    assert greendns.stats()["local_fallbacks"] == 1
+    greendns.on_upstream_state(foreign_dns, health.HEALTHY)
+    s = init_greendns_session(greendns, qname, dnslib.QTYPE.A)
+    s.server_resps[local_dns1] = bytes(res.pack())
+    assert not greendns.on_upstream_response(s, local_dns1)
+
+
+def test_hedge_groups(greendns):
+    s = init_greendns_session(greendns, "www.qq.com", dnslib.QTYPE.A)
+    assert greendns.hedge_groups(s, [foreign_dns, local_dns1]) == \
+        [[local_dns1], [foreign_dns]]
+    assert greendns.hedge_groups(s, [foreign_dns]) == [[], [foreign_dns]]
+
+
+@pytest.mark.parametrize("qtype, rdata", [
+    (dnslib.QTYPE.A, dnslib.A("183.136.212.50")),
+    (dnslib.QTYPE.AAAA, dnslib.AAAA("2404:6800::1")),
+])
+def test_on_upstream_response_local_down(greendns, qtype, rdata):
+    qname = "www.qq.com"
+    res = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, aa=1, ra=1),
+                           q=dnslib.DNSQuestion(qname, qtype),
+                           a=dnslib.RR(qname, qtype, rdata=rdata))
+    s = init_greendns_session(greendns, qname, qtype)
+    s.server_resps[foreign_dns] = bytes(res.pack())
+    assert not greendns.on_upstream_response(s, foreign_dns)
+    # only the unpoisoned servers are asked now
+    greendns.on_upstream_state(local_dns1, health.OPEN)
+    s = init_greendns_session(greendns, qname, qtype)
+    s.server_resps[foreign_dns] = bytes(res.pack())
+    assert greendns.on_upstream_response(s, foreign_dns)
+    if qtype == dnslib.QTYPE.A:
+        assert greendns.stats()["unpoisoned_fallbacks"] == 1
+
+
+@pytest.mark.parametrize("args, message", [
+    (["--cache-size", "0"], "--cache-size of at least 1"),
+    (["--cache-size", "0", "--cache-bytes", "100"], "--cache-bytes of at least"),
+])
+def test_shm_cache_unlimited(tmpdir, capsys, args, message):
+    with pytest.raises(SystemExit):
+        make_handler("--cache-backend", "shm",
+                     "--cache-shm", str(tmpdir.join("cache")), *args)
+    assert message in capsys.readouterr().err
+
+
+def test_shm_cache_unsupported(tmpdir, capsys, monkeypatch):
+    monkeypatch.setattr(cache, "fcntl", None)
+    with pytest.raises(SystemExit):
+        make_handler("--cache-backend", "shm",
+                     "--cache-shm", str(tmpdir.join("cache")))
+    assert "not supported" in capsys.readouterr().err
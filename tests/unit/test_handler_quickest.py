@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
+import argparse
 import pytest
 from greendns.handler_quickest import QuickestHandler
 from greendns.handler_quickest import QuickestSession
+from greendns.scoreboard import Scoreboard
 
 
 @pytest.fixture
@@ -21,3 +23,27 @@ def test_on_upstream_response(quickest):
     s.server_resps[addr] = "123456"
     resp = quickest.on_upstream_response(s, addr)
     assert resp == "123456"
+
+
+def test_route():
+    h = QuickestHandler()
+    parser = argparse.ArgumentParser()
+    h.add_arg(parser)
+    h.parse_arg(parser, ["--upstreams", "1.1.1.1:53,2.2.2.2:53,3.3.3.3:53",
+                         "--explore", "0"])
+    servers = h.init(None)
+    s = h.new_session()
+    assert h.route(s) == servers[:1]
+    scores = Scoreboard()
+    h.use_scores(scores)
+    scores.timed_out(servers[0], 1.5)
+    scores.answered(servers[1], 0.05)
+    scores.answered(servers[2], 0.01)
+    assert h.route(s) == servers[2:]
+    h.explore = 1
+    route = h.route(s)
+    assert route[0] == servers[2] and route[1] in servers[:2]
+    assert h.stats() == {"explored": 1}
+    assert len(h.dump()) == 3
+    h.top = 0
+    assert h.route(s) is None
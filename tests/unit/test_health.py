@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from greendns import health
+
+
+def test_health():
+    h = health.UpstreamHealth(2, 3)
+    assert h.state == health.HEALTHY
+    assert not h.failed()
+    assert h.failed()
+    assert h.state == health.DEGRADED
+    assert h.failed()
+    assert h.state == health.OPEN
+    assert not h.failed()
+    assert h.failures == 4
+    assert h.succeeded()
+    assert h.state == health.HEALTHY
+    assert h.failures == 0
+    assert not h.succeeded()
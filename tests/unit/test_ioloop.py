@@ -11,9 +11,9 @@ from greendns import ioloop
 
 
 if sys.platform.startswith('linux'):
-    engines = ["select", "epoll"]
+    engines = ["select", "epoll", "poll", "selectors"]
 else:
-    engines = ["select"]
+    engines = ["select", "selectors"]
 
 
 class UdpEchoHandler(socketserver.BaseRequestHandler):
@@ -74,6 +74,34 @@ class TestIOLoop:
         os.kill(p.pid, signal.SIGINT)
         p.join()
 
+    def test_timer(self, iol):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        iol.register(sock, ioloop.EV_READ, self.read_func)
+        fired = []
+        t = iol.add_timer(True, 0.1, fired.append, 1)
+        iol.add_timer(True, 0.2, iol.stop)
+        iol.cancel_timer(t)
+        start = iol.time()
+        iol.run()
+        assert not fired
+        assert iol.time() - start >= 0.2
+        assert iol.poll_timeout() is None
+        iol.on_close_sock(sock)
+        sock.close()
+
+    def test_callback(self, iol):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        iol.register(sock, ioloop.EV_READ, self.read_func)
+        called = []
+        iol.add_callback(called.append, 1)
+        assert iol.poll_timeout() == 0
+        iol.add_timer(True, 0.1, iol.stop)
+        iol.run()
+        assert called == [1]
+        assert iol.poll_timeout() is None
+        iol.on_close_sock(sock)
+        sock.close()
+
     def write_func(self, sock, iol, server_addr, child_conn):
         sock.sendto(b"hello\n", server_addr)
         iol.unregister(sock, ioloop.EV_WRITE)
@@ -86,3 +114,19 @@ class TestIOLoop:
         sock.close()
         child_conn.send(True)
         child_conn.close()
+
+
+def test_select_esocks():
+    iol = ioloop.get_ioloop("select")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    iol.register(sock, ioloop.EV_READ | ioloop.EV_WRITE, None)
+    assert sock in iol.esocks
+    iol.unregister(sock, ioloop.EV_READ)
+    assert sock in iol.esocks
+    iol.unregister(sock, ioloop.EV_WRITE)
+    assert sock not in iol.esocks
+    sock.close()
+
+
+def test_get_ioloop_invalid():
+    assert ioloop.get_ioloop("notexist") is None
@@ -55,3 +55,22 @@ def test_is_in_local():
     assert cnet_rfc1918.is_in_local("192.168.2.3")
     assert cnet_rfc1918.is_in_local("10.2.3.4")
     assert cnet_rfc1918.is_in_local("172.23.2.3")
+
+
+def test_is_ip_in_local():
+    localroutes = ["10.0.0.0/8", "10.1.0.0/24", "11.0.0.0/8", "1.1.8.0/24"]
+    cnet = LocalNet(localroutes, [], False)
+    assert cnet.lows == [0x01010800, 0x0A000000]
+    assert cnet.highs == [0x010108FF, 0x0BFFFFFF]
+    assert cnet.is_ip_in_local(0x0A020000)
+    assert cnet.is_ip_in_local(0x0B000001)
+    assert cnet.is_ip_in_local(0x010108FF)
+    assert not cnet.is_ip_in_local(0x01010900)
+    assert not cnet.is_ip_in_local(0)
+    assert not cnet.is_ip_in_local(0xFFFFFFFF)
+
+
+def test_is_ip_in_blacklist():
+    cnet = LocalNet([], ["1.2.3.4"], False)
+    assert cnet.is_ip_in_blacklist(0x01020304)
+    assert not cnet.is_ip_in_blacklist(0x01020305)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import pytest
+from greendns.scoreboard import Scoreboard
+from greendns.connection import Addr
+
+
+def test_score():
+    sb = Scoreboard()
+    a, b, c = [Addr("udp", "127.0.0.%d" % i, 53) for i in range(1, 4)]
+    assert sb.best([a, b, c], 3) == [a, b, c]
+    for _ in range(10):
+        sb.answered(a, 0.05)
+        sb.answered(b, 0.01)
+    assert sb[a].srtt == pytest.approx(0.05)
+    assert sb[b].srtt == pytest.approx(0.01)
+    # c is never asked
+    assert sb.best([a, b, c], 2) == [c, b]
+    sb.answered(c, 0.02)
+    assert sb.best([a, b, c], 2) == [b, c]
+    # b loses some, it costs the timeout
+    sb.timed_out(b, 1.5)
+    sb.timed_out(b, 1.5)
+    assert sb[b].timeouts == 2
+    assert sb[b].loss == pytest.approx(1 - 0.875 ** 2)
+    assert sb.best([a, b, c], 3) == [c, a, b]
+    # and back
+    for _ in range(30):
+        sb.answered(b, 0.01)
+    assert sb.best([a, b, c], 1) == [b]
+    assert sb.dump()[0].startswith("upstream udp:127.0.0.1:53 srtt=")
+
+
+def test_percentile():
+    sb = Scoreboard()
+    a = Addr("udp", "127.0.0.1", 53)
+    assert sb.percentile(a, 90) is None
+    for i in range(1, 101):
+        sb.answered(a, i / 1000.0)
+    # the recent ones only
+    assert len(sb[a].rtts) == sb[a].SAMPLES
+    assert sb.percentile(a, 0) == 0.037
+    assert sb.percentile(a, 90) == 0.094
+    assert sb.percentile(a, 100) == 0.1
+    assert sb.percentile(a, 90, min_samples=65) is None
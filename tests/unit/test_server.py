@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import signal
 import time
 import random
@@ -9,7 +10,9 @@ import argparse
 import dnslib
 import pytest
 from six.moves import socketserver
+from six.moves import reload_module
 from greendns import server
+from greendns import supervisor
 from greendns.handler_greendns import GreenDNSHandler
 
 
@@ -228,3 +231,57 @@ def test_run_with_quickest_handler(udp_server_process):
     client.close()
     os.kill(p.pid, signal.SIGINT)
     p.join()
+
+
+def test_run_with_workers(udp_server_process):
+    addr1, addr2 = udp_server_process
+    forward_addr = ("127.0.0.1", 42355)
+    argv = ["-p", "%s:%d" % (forward_addr[0], forward_addr[1]),
+            "-r", "greendns",
+            "-l", "debug",
+            "-w", "2",
+            "--stats-interval", "0.2",
+            "-f", "%s/localroute_test.txt" % (mydir),
+            "-b", "%s/iplist_test.txt" % (mydir),
+            "--lds", "%s:%d" % (addr1[0], addr1[1]),
+            "--rds", "%s:%d" % (addr2[0], addr2[1])]
+    p = Process(target=server.run, args=(argv,))
+    p.start()
+    time.sleep(1)
+    for i in range(4):
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        q = dnslib.DNSRecord.question(qname)
+        client.sendto(bytes(q.pack()), forward_addr)
+        client.settimeout(2)
+        data, _ = client.recvfrom(1024)
+        d = dnslib.DNSRecord.parse(data)
+        assert str(d.rr[0].rdata) == "101.226.103.106"
+        client.close()
+    time.sleep(0.6)
+    os.kill(p.pid, signal.SIGINT)
+    p.join()
+    assert p.exitcode == 0
+
+
+def test_parse_config_workers(dns):
+    dns.parse_config(["-r", "quickest", "-w", "4", "--cpus", "0,2"])
+    assert dns.args.workers == 4
+    assert dns.args.cpus == [0, 2]
+    assert dns.args.stats_interval == 0
+    with pytest.raises(SystemExit):
+        dns.parse_config(["-r", "quickest", "--cpus", "a,b"])
+
+
+def test_run_without_fcntl(monkeypatch):
+    '''like on windows, only the workers need it'''
+    monkeypatch.setitem(sys.modules, "fcntl", None)
+    reload_module(supervisor)
+    try:
+        assert not supervisor.available
+        with pytest.raises(SystemExit) as e:
+            server.run(["-r", "quickest", "-w", "2"])
+        assert e.value.code == 1
+    finally:
+        monkeypatch.undo()
+        reload_module(supervisor)
+    assert supervisor.available
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import tempfile
+import pytest
+from greendns import supervisor
+
+
+@pytest.fixture
+def counter():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    yield path
+    os.remove(path)
+
+
+def bump(path):
+    '''count the runs across the forked workers'''
+    with open(path, "a") as f:
+        f.write("x")
+    with open(path) as f:
+        return len(f.read())
+
+
+def test_stats():
+    def run_worker(wid, report):
+        report({"requests": wid + 1, "inflight": 1})
+        report({"requests": wid + 2, "inflight": 0})
+
+    sup = supervisor.Supervisor(3, run_worker)
+    assert sup.run() == 0
+    assert sup.stats() == {"requests": 9, "inflight": 0}
+
+
+def test_restart(counter):
+    def run_worker(wid, report):
+        if bump(counter) < 3:
+            os._exit(1)
+
+    sup = supervisor.Supervisor(1, run_worker)
+    sup.RESTART_DELAY = 0
+    assert sup.run() == 0
+    assert bump(counter) == 4
+
+
+def test_give_up(counter):
+    def run_worker(wid, report):
+        bump(counter)
+        raise ValueError("crash")
+
+    sup = supervisor.Supervisor(2, run_worker)
+    sup.RESTART_DELAY = 0
+    sup.MAX_FAILURES = 2
+    assert sup.run() == 1
+    assert bump(counter) <= 5
+
+
+def test_stop():
+    def run_worker(wid, report):
+        time.sleep(30)
+
+    sup = supervisor.Supervisor(2, run_worker)
+    sup.running = False
+    start = time.time()
+    assert sup.run() == 0
+    assert time.time() - start < 5
+    assert not any(w.pid for w in sup.workers)
+
+
+def test_pin():
+    if not hasattr(os, "sched_getaffinity"):
+        pytest.skip("no cpu affinity")
+    cpu = sorted(os.sched_getaffinity(0))[-1]
+
+    def run_worker(wid, report):
+        report({"cpu%d" % c: 1 for c in os.sched_getaffinity(0)})
+
+    sup = supervisor.Supervisor(1, run_worker, cpus=[cpu])
+    assert sup.run() == 0
+    assert sup.stats() == {"cpu%d" % cpu: 1}
@@ -33,9 +33,9 @@ class TestTimerManager(object):
         tm.add_timer(True, 5, self.callback)
         tm.add_timer(True, 3, self.callback)
         tm.add_timer(True, 8, self.callback)
-        t1 = tm.timers.queue[0]
-        t2 = tm.timers.queue[1]
-        t3 = tm.timers.queue[2]
+        t1 = tm.timers[0]
+        t2 = tm.timers[1]
+        t3 = tm.timers[2]
         assert t1.interval == 3
         assert t1 < t2 < t3
 
@@ -46,7 +46,7 @@ class TestTimerManager(object):
         self.run = False
         tm.check_timer()
         assert self.run is True
-        assert len(tm.timers.queue) == 0
+        assert len(tm.timers) == 0
 
     def test_check_timer_cron(self):
         tm = TimerManager()
@@ -55,9 +55,66 @@ class TestTimerManager(object):
         self.run = False
         tm.check_timer()
         assert self.run is True
-        assert len(tm.timers.queue) == 1
+        assert len(tm.timers) == 1
         time.sleep(2)
         self.run = False
         tm.check_timer()
         assert self.run is True
-        assert len(tm.timers.queue) == 1
+        assert len(tm.timers) == 1
+
+    def test_cancel_timer(self):
+        tm = TimerManager()
+        t = tm.add_timer(True, 1, self.callback)
+        tm.cancel_timer(t)
+        tm.cancel_timer(t)
+        assert tm.cancelled == 1
+        time.sleep(1)
+        self.run = False
+        tm.check_timer()
+        assert self.run is False
+        assert len(tm.timers) == 0
+        assert tm.cancelled == 0
+
+    def test_cancel_after_run(self):
+        tm = TimerManager()
+        t = tm.add_timer(True, 0, self.callback)
+        tm.check_timer()
+        tm.cancel_timer(t)
+        assert tm.cancelled == 0
+
+    def test_cancel_compact(self):
+        tm = TimerManager()
+        timers = [tm.add_timer(True, 10, self.callback) for _ in range(100)]
+        for t in timers[:70]:
+            tm.cancel_timer(t)
+        assert len(tm.timers) < 100
+        assert len(tm.timers) - tm.cancelled == 30
+
+    def test_next_timeout(self):
+        tm = TimerManager()
+        assert tm.next_timeout() is None
+        t = tm.add_timer(True, 5, self.callback)
+        tm.add_timer(False, 8, self.callback)
+        assert 4 < tm.next_timeout() <= 5
+        tm.cancel_timer(t)
+        assert 7 < tm.next_timeout() <= 8
+
+    def test_cancel_compact_in_callback(self):
+        tm = TimerManager()
+        runs = []
+        tm.add_timer(False, 0.01, runs.append, 1)
+        pending = [tm.add_timer(True, 10, self.callback) for _ in range(100)]
+
+        def cancel_all():
+            for t in pending:
+                tm.cancel_timer(t)
+        tm.add_timer(True, 0, cancel_all)
+        time.sleep(0.02)
+        tm.check_timer()
+        assert runs == [1]
+        assert tm.cancelled == 0
+        # the recurring timer is still in the heap
+        assert len(tm.timers) == 1
+        time.sleep(0.02)
+        tm.check_timer()
+        assert runs == [1, 1]
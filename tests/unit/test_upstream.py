@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+import time
+import socket
+import struct
+import random
+from multiprocessing import Process
+import pytest
+from six.moves import socketserver
+import dnslib
+from greendns import ioloop
+from greendns import upstream
+from greendns import session
+from greendns import connection
+from greendns.connection import Addr
+
+
+def make_query(qname, id=1234):
+    q = dnslib.DNSRecord.question(qname)
+    q.header.id = id
+    return bytes(q.pack())
+
+
+@pytest.fixture
+def server():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(1)
+    yield sock
+    sock.close()
+
+
+class TestUDPUpstream(object):
+    def on_response(self, q, data):
+        self.responses.append((q, data))
+        q.upstream.io_engine.stop()
+
+    def run(self, io_engine):
+        io_engine.running = True
+        io_engine.add_timer(True, 1, io_engine.stop)
+        io_engine.run()
+
+    def make(self, server):
+        self.responses = []
+        io_engine = ioloop.get_ioloop("select")
+        addr = Addr("udp", *server.getsockname())
+        return upstream.UDPUpstream(io_engine, addr, self.on_response, 2)
+
+    def test_query(self, server):
+        u = self.make(server)
+        assert len(u.conns) == 2
+        q1 = u.query(session.Session(), make_query("qq.com", 1), b"qq.com.")
+        q2 = u.query(session.Session(), make_query("qq.com", 1), b"qq.com.")
+        assert len(u) == 2
+        for _ in range(2):
+            data, addr = server.recvfrom(1024)
+            server.sendto(data, addr)
+        self.run(u.io_engine)
+        self.run(u.io_engine)
+        assert len(u) == 0
+        assert set(q for q, _ in self.responses) == set([q1, q2])
+        for _, data in self.responses:
+            assert data == make_query("qq.com", 1)
+        u.close()
+
+    def test_wrong_name(self, server):
+        u = self.make(server)
+        q = u.query(session.Session(), make_query("qq.com"), b"qq.com.")
+        data, addr = server.recvfrom(1024)
+        server.sendto(data[:2] + make_query("qq.net")[2:], addr)
+        self.run(u.io_engine)
+        assert not self.responses
+        assert len(u) == 1
+        u.cancel(q)
+        assert len(u) == 0
+        u.close()
+
+    def test_unknown_id(self, server):
+        u = self.make(server)
+        u.query(session.Session(), make_query("qq.com"), b"qq.com.")
+        data, addr = server.recvfrom(1024)
+        txid = (dnslib.DNSRecord.parse(data).header.id + 1) % 65536
+        server.sendto(make_query("qq.com", txid), addr)
+        self.run(u.io_engine)
+        assert not self.responses
+        u.close()
+
+    def test_rotate(self, server):
+        self.responses = []
+        io_engine = ioloop.get_ioloop("select")
+        addr = Addr("udp", *server.getsockname())
+        u = upstream.UDPUpstream(io_engine, addr, self.on_response, 1, 2)
+        old = u.conns[0]
+        u.query(session.Session(), make_query("qq.com", 1), b"qq.com.")
+        q = u.query(session.Session(), make_query("qq.com", 2), b"qq.com.")
+        assert u.rotated == 1
+        assert u.conns[0] is not old
+        assert u.conns[0].bind_addr[1] != old.bind_addr[1]
+        assert not old.closed
+        for _ in range(2):
+            data, raddr = server.recvfrom(1024)
+            assert raddr[1] == old.bind_addr[1]
+            if dnslib.DNSRecord.parse(data).header.id == q.txid:
+                continue
+            server.sendto(data, raddr)
+        self.run(u.io_engine)
+        assert len(self.responses) == 1
+        assert not old.closed
+        u.cancel(q)
+        assert old.closed
+        assert list(u.pending) == u.conns
+        u.query(session.Session(), make_query("qq.com", 3), b"qq.com.")
+        data, raddr = server.recvfrom(1024)
+        assert raddr[1] == u.conns[0].bind_addr[1]
+        u.close()
+
+
+class TcpReverseHandler(socketserver.BaseRequestHandler):
+    '''reply 2 pipelined queries in reverse order'''
+    def handle(self):
+        sock = self.request
+        buf = b''
+        msgs = []
+        while len(msgs) < 2:
+            data = sock.recv(2048)
+            if not data:
+                return
+            buf += data
+            while len(buf) >= 2:
+                length = struct.unpack(">H", buf[:2])[0]
+                if len(buf) < length + 2:
+                    break
+                msgs.append(buf[:length + 2])
+                buf = buf[length + 2:]
+        sock.sendall(b''.join(reversed(msgs)))
+
+
+@pytest.fixture
+def tcp_server():
+    s = socketserver.TCPServer(("127.0.0.1", random.randint(20000, 30000)),
+                               TcpReverseHandler)
+    p = Process(target=s.serve_forever)
+    p.start()
+    yield s.server_address
+    p.terminate()
+    p.join()
+    s.server_close()
+
+
+class TestTCPUpstream(object):
+    def on_response(self, q, data):
+        self.responses.append((q, data))
+        if len(self.responses) == self.expected:
+            q.upstream.io_engine.stop()
+
+    def make(self, server_addr, **kwargs):
+        self.responses = []
+        self.expected = 2
+        io_engine = ioloop.get_ioloop("select")
+        addr = Addr("tcp", *server_addr)
+        return upstream.TCPUpstream(io_engine, addr, self.on_response,
+                                    **kwargs)
+
+    def run(self, io_engine, seconds=2):
+        io_engine.running = True
+        io_engine.add_timer(True, seconds, io_engine.stop)
+        io_engine.run()
+
+    def test_pipeline(self, tcp_server):
+        u = self.make(tcp_server, max_conns=1)
+        q1 = u.query(session.Session(), make_query("qq.com", 1), b"qq.com.")
+        q2 = u.query(session.Session(), make_query("qq.net", 2), b"qq.net.")
+        assert len(u.streams) == 1
+        assert q1.conn is q2.conn
+        self.run(u.io_engine)
+        assert [q for q, _ in self.responses] == [q2, q1]
+        assert self.responses[0][1] == make_query("qq.net", 2)
+        assert self.responses[1][1] == make_query("qq.com", 1)
+        assert len(u) == 0
+        u.close()
+
+    def test_max_inflight(self, tcp_server):
+        u = self.make(tcp_server, max_conns=1, max_inflight=1)
+        q1 = u.query(session.Session(), make_query("qq.com", 1), b"qq.com.")
+        q2 = u.query(session.Session(), make_query("qq.net", 2), b"qq.net.")
+        assert q1.conn
+        assert q2.conn is None
+        assert list(u.waiting) == [q2]
+        u.cancel(q2)
+        assert len(u) == 1
+        u.close()
+
+    def test_connect_failed(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        server_addr = sock.getsockname()
+        sock.close()
+        u = self.make(server_addr)
+        q = u.query(session.Session(), make_query("qq.com", 1), b"qq.com.")
+        self.run(u.io_engine, 0.3)
+        assert u.failures >= 1
+        assert u.next_connect_ts > 0
+        assert not u.streams
+        assert q.retried
+        assert list(u.waiting) == [q]
+        u.close()
+
+    def test_connect_timeout(self, monkeypatch):
+        def aconnect(conn, remote_addr, on_connected, *args):
+            # the connection is never established
+            conn.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        monkeypatch.setattr(connection.TCPConnection, "aconnect", aconnect)
+        u = self.make(("127.0.0.1", 53), connect_timeout=0.1)
+        q = u.query(session.Session(), make_query("qq.com", 1), b"qq.com.")
+        st = q.conn
+        assert st.connect_timer
+        time.sleep(0.2)
+        u.io_engine.update_time()
+        u.io_engine.check_timer()
+        assert st.conn.closed
+        assert u.failures == 1
+        assert u.next_connect_ts > u.io_engine.time()
+        assert not u.streams
+        assert q.retried
+        assert list(u.waiting) == [q]
+        u.close()
+
+    def test_idle_timeout(self, tcp_server):
+        u = self.make(tcp_server, idle_timeout=0)
+        u.query(session.Session(), make_query("qq.com", 1), b"qq.com.")
+        u.query(session.Session(), make_query("qq.net", 2), b"qq.net.")
+        self.run(u.io_engine)
+        assert len(self.responses) == 2
+        self.run(u.io_engine, 1.5)
+        assert not u.streams
+        u.close()
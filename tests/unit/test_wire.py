@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+import pytest
+import dnslib
+from greendns import wire
+
+
+def make_query(qname, qtype="A", id=1234):
+    q = dnslib.DNSRecord.question(qname, qtype)
+    q.header.id = id
+    return bytes(q.pack())
+
+
+def test_parse_header():
+    h = wire.parse_header(make_query("qq.com", id=4321))
+    assert h.id == 4321
+    assert h.qdcount == 1
+    assert h.ancount == 0
+    with pytest.raises(wire.WireError):
+        wire.parse_header(b'123456')
+
+
+def test_parse_request():
+    header, question = wire.parse_request(make_query("WWW.QQ.com", "AAAA", 7))
+    assert header.id == 7
+    assert question.qname == b"www.qq.com."
+    assert question.qtype == dnslib.QTYPE.AAAA
+    assert question.qclass == 1
+
+
+def test_parse_request_root():
+    _, question = wire.parse_request(make_query(".", "NS"))
+    assert question.qname == b"."
+    assert question.qtype == dnslib.QTYPE.NS
+
+
+def test_parse_request_no_question():
+    d = dnslib.DNSRecord(dnslib.DNSHeader(id=1))
+    header, question = wire.parse_request(bytes(d.pack()))
+    assert header.qdcount == 0
+    assert question is None
+
+
+def test_parse_request_invalid():
+    data = make_query("qq.com")
+    for bad in (data[:-1], data[:15], data[:12] + b'\x40abc'):
+        with pytest.raises(wire.WireError):
+            wire.parse_request(bad)
+
+
+def test_edns():
+    q = dnslib.DNSRecord.question("qq.com")
+    q.add_ar(dnslib.EDNS0(flags="do", udp_len=1400))
+    for data, edns in ((make_query("qq.com"), None),
+                       (bytes(q.pack()), (1400, True))):
+        header, question = wire.parse_request(data)
+        assert wire.edns(data, header, question.end) == edns
+
+
+def test_payload_class():
+    assert wire.payload_class(0) == 512
+    assert wire.payload_class(512) == 512
+    assert wire.payload_class(1232) == 1232
+    assert wire.payload_class(1400) == 4096
+    assert wire.payload_class(8192) == 65535
+
+
+def test_reply_to():
+    req = make_query("WwW.qq.com", id=7)
+    a = dnslib.DNSRecord.question("www.qq.com").reply()
+    a.add_answer(dnslib.RR("www.qq.com", rdata=dnslib.A("1.2.3.4")))
+    resp = bytes(a.pack())
+    _, question = wire.parse_request(req)
+    data = wire.reply_to(resp, req, question.end)
+    d = dnslib.DNSRecord.parse(data)
+    assert d.header.id == 7
+    assert str(d.q.qname) == "WwW.qq.com."
+    assert str(d.rr[0].rdata) == "1.2.3.4"
+    # another question, only the id is changed
+    data = wire.reply_to(resp, make_query("qq.com", id=8), question.end)
+    assert data[2:] == resp[2:]
+    assert wire.parse_header(data).id == 8
+
+
+def test_read_name_pointer():
+    # qq.com at 12, www -> qq.com at 20
+    data = b'\x00' * 12 + b'\x02qq\x03com\x00' + b'\x03www\xc0\x0c'
+    name, end = wire.read_name(data, 20)
+    assert name == b"www.qq.com."
+    assert end == len(data)
+
+
+def test_read_name_pointer_loop():
+    data = b'\x00' * 12 + b'\xc0\x0c'
+    with pytest.raises(wire.WireError):
+        wire.read_name(data, 12)
+
+
+def make_response(qname="www.qq.com"):
+    d = dnslib.DNSRecord(dnslib.DNSHeader(qr=1, aa=1, ra=1),
+                         q=dnslib.DNSQuestion(qname))
+    d.add_answer(dnslib.RR(qname, dnslib.QTYPE.CNAME,
+                           rdata=dnslib.CNAME("https.qq.com"), ttl=3))
+    d.add_answer(dnslib.RR("https.qq.com", rdata=dnslib.A("1.2.3.4"), ttl=3))
+    d.add_answer(dnslib.RR("https.qq.com", rdata=dnslib.A("5.6.7.8"), ttl=3))
+    d.add_auth(dnslib.RR("qq.com", dnslib.QTYPE.NS,
+                         rdata=dnslib.NS("ns1.qq.com"), ttl=3))
+    d.add_ar(dnslib.RR("ns1.qq.com", rdata=dnslib.A("9.9.9.9"), ttl=3))
+    return bytes(d.pack())
+
+
+def test_scan_A():
+    ips = wire.scan_A(make_response())
+    assert ips == [0x01020304, 0x05060708]
+    assert wire.ip_to_str(ips[1]) == "5.6.7.8"
+
+
+def test_scan_A_invalid():
+    data = make_response()
+    with pytest.raises(wire.WireError):
+        wire.scan_A(data[:40])
+    with pytest.raises(wire.WireError):
+        wire.scan_A(b'123456')
+
+
+def test_scan_answers():
+    header, rrs = wire.scan_answers(make_response())
+    assert header.ancount == 3
+    assert [rr.rtype for rr in rrs] == [dnslib.QTYPE.CNAME,
+                                        dnslib.QTYPE.A, dnslib.QTYPE.A]
+    assert rrs[1].ttl == 3
+    assert rrs[1].rdlength == 4
+    with pytest.raises(wire.WireError):
+        wire.scan_answers(b'123456')
+
+
+def test_packed_response():
+    data = make_response()
+    p = wire.PackedResponse(data, 100.0)
+    assert list(p.ttls) == [3] * 5
+    assert p.min_ttl() == 3
+    assert p.a_count == 2
+    resp = p.make(4321)
+    d = dnslib.DNSRecord.parse(resp)
+    assert d.header.id == 4321
+    assert [str(rr.rdata) for rr in d.rr[1:]] == ["1.2.3.4", "5.6.7.8"]
+
+    d = dnslib.DNSRecord.parse(p.make(1, 101.5, rotate=True))
+    assert [rr.ttl for rr in d.rr + d.auth + d.ar] == [2] * 5
+    assert str(d.rr[0].rdata) == "https.qq.com."
+    assert [str(rr.rdata) for rr in d.rr[1:]] == ["5.6.7.8", "1.2.3.4"]
+    d = dnslib.DNSRecord.parse(p.make(1, 110, rotate=True))
+    assert [rr.ttl for rr in d.rr + d.auth + d.ar] == [0] * 5
+    assert [str(rr.rdata) for rr in d.rr[1:]] == ["1.2.3.4", "5.6.7.8"]
+
+
+def test_packed_response_not_rotated():
+    d = dnslib.DNSRecord(dnslib.DNSHeader(qr=1), q=dnslib.DNSQuestion("qq.com"))
+    d.add_answer(dnslib.RR("qq.com", rdata=dnslib.A("1.2.3.4"), ttl=3))
+    d.add_answer(dnslib.RR("qq.com", dnslib.QTYPE.CNAME,
+                           rdata=dnslib.CNAME("x.qq.com"), ttl=3))
+    d.add_ar(dnslib.EDNS0())
+    p = wire.PackedResponse(bytes(d.pack()))
+    assert p.a_count == 0
+    assert len(p.ttls) == 2
+    d = dnslib.DNSRecord.parse(p.make(1, rotate=True))
+    assert str(d.rr[0].rdata) == "1.2.3.4"
+
+
+def test_packed_response_invalid():
+    with pytest.raises(wire.WireError):
+        wire.PackedResponse(make_response()[:-1])
+
+
+def test_packed_response_ttl():
+    a = dnslib.DNSRecord.question("qq.com").reply()
+    a.add_answer(dnslib.RR("qq.com", rdata=dnslib.A("1.2.3.4"), ttl=600))
+    a.add_auth(dnslib.RR("qq.com", dnslib.QTYPE.NS,
+                         rdata=dnslib.NS("ns.qq.com"), ttl=3600))
+    p = wire.PackedResponse(bytes(a.pack()), 100)
+    d = dnslib.DNSRecord.parse(p.make(9, 10000, ttl=30))
+    assert d.header.id == 9
+    assert [rr.ttl for rr in d.rr + d.auth] == [30, 30]
+
+
+def test_packed_response_bytes():
+    p = wire.PackedResponse(make_response(), 100.0)
+    q = wire.PackedResponse.frombytes(p.tobytes())
+    assert q.data == p.data
+    assert q.ts == 100.0
+    assert list(q.offsets) == list(p.offsets)
+    assert list(q.ttls) == list(p.ttls)
+    assert (q.a_beg, q.a_count) == (p.a_beg, p.a_count)
+    assert q.make(1, 101.5) == p.make(1, 101.5)
+
+
+def make_negative(rcode, soa_ttl=600, minimum=60):
+    r = dnslib.DNSRecord.question("nx.qq.com").reply()
+    r.header.rcode = rcode
+    if soa_ttl is not None:
+        r.add_auth(dnslib.RR("qq.com", dnslib.QTYPE.SOA, ttl=soa_ttl,
+                             rdata=dnslib.SOA("ns.qq.com", "admin.qq.com",
+                                              (1, 2, 3, 4, minimum))))
+    return bytes(r.pack())
+
+
+def test_negative_ttl():
+    assert wire.negative_ttl(make_negative(dnslib.RCODE.NXDOMAIN)) == 60
+    assert wire.negative_ttl(make_negative(dnslib.RCODE.NOERROR, 30)) == 30
+    assert wire.negative_ttl(make_negative(dnslib.RCODE.NXDOMAIN, None)) \
+        is None
+    assert wire.negative_ttl(make_negative(dnslib.RCODE.SERVFAIL)) is None
+    a = dnslib.DNSRecord.question("qq.com").reply()
+    a.add_answer(dnslib.RR("qq.com", rdata=dnslib.A("1.2.3.4")))
+    assert wire.negative_ttl(bytes(a.pack())) is None
+    assert not wire.PackedResponse(bytes(a.pack())).is_negative()
+    assert wire.PackedResponse(
+        make_negative(dnslib.RCODE.NXDOMAIN)).is_negative()
+
+
+def test_make_query():
+    data = wire.make_query("QQ.com.", dnslib.QTYPE.AAAA, 7)
+    d = dnslib.DNSRecord.parse(data)
+    assert d.header.id == 7
+    assert d.header.rd == 1
+    assert str(d.q.qname) == "qq.com."
+    assert d.q.qtype == dnslib.QTYPE.AAAA